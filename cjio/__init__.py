@@ -16,3 +16,9 @@ MODULE_PANDAS_AVAILABLE = loader is not None
 
 loader = importlib.util.find_spec("cjvalpy")
 MODULE_CJVAL_AVAILABLE = loader is not None
+
+loader = importlib.util.find_spec("orjson")
+MODULE_ORJSON_AVAILABLE = loader is not None
+
+loader = importlib.util.find_spec("simdjson")
+MODULE_SIMDJSON_AVAILABLE = loader is not None
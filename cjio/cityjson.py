@@ -1,32 +1,39 @@
 import copy
+import functools
 import json
 import math
 import os
 import random
 import re
 import shutil
-import sys
 import urllib.request
 import uuid
+from collections import Counter, namedtuple
 from datetime import datetime
 from io import StringIO
+from itertools import chain
 from pathlib import Path
 
 import numpy as np
 from click import progressbar
 
-from cjio import errors, convert, geom_help, subset
+from cjio import (
+    errors,
+    convert,
+    featureindex,
+    geom_help,
+    jsonio,
+    spatialindex,
+    subset,
+    utils,
+)
 from cjio.errors import CJInvalidOperation
-from cjio.floatEncoder import FloatEncoder
 
 from cjio import (
     MODULE_PYPROJ_AVAILABLE,
     MODULE_CJVAL_AVAILABLE,
 )
 
-json.encoder.c_make_encoder = None
-json.encoder.float = FloatEncoder
-
 if MODULE_PYPROJ_AVAILABLE:
     from pyproj import CRS
     from pyproj.transformer import TransformerGroup
@@ -49,36 +56,218 @@ CITYJSON_PROPERTIES = [
     "geometry-templates",
 ]
 
+# -- row i is for the CityObject ids[i], see CityJSON.get_cityobjects_table()
+CityObjectsTable = namedtuple("CityObjectsTable", ["ids", "count", "centroid", "bbox"])
 
-def read_stdin():
-    lcount = 1
+# -- number of CityJSONFeatures sent at once to a worker process
+FEATURES_CHUNK_SIZE = 256
+
+# -- number of vertices serialised at once by the writers
+VERTICES_CHUNK_SIZE = 10000
+
+# -- number of vertices reprojected at once (and sent to a worker process)
+REPROJECT_CHUNK_SIZE = 100000
+
+# -- number of CityObjects sent at once to a worker process that triangulates
+TRIANGULATE_CHUNK_SIZE = 64
+
+
+def read_stdin(ignore_duplicate_keys=False):
+    return read_jsonl(utils.open_stdin(), ignore_duplicate_keys)
+
+
+def read_jsonl(file, ignore_duplicate_keys=False, read_filter=None, index=None):
+    """Read a CityJSONSeq (stdin, or a file in text or binary mode): the
+    CityJSONFeatures are added to the city model of the first line.
+
+    With a :py:class:`ReadFilter`, only the features with a CityObject kept are
+    added. With a :py:class:`featureindex.FeatureIndex` of the file, the features
+    selected by IDs, by bbox or randomly are read directly, the others not at all.
+    """
+    check = not ignore_duplicate_keys
     # -- read first line
-    j1 = json.loads(sys.stdin.readline())
+    j1 = jsonio.loads(file.readline(), check)
     cm = CityJSON(j=j1)
     if "CityObjects" not in cm.j:
         cm.j["CityObjects"] = {}
     if "vertices" not in cm.j:
         cm.j["vertices"] = []
-    while True:
+    transform = cm.j.get("transform")
+    positions = None
+    if index is not None and read_filter is not None:
+        positions = read_filter.features(index)
+    if positions is None:
+        lines = enumerate(file, start=2)
+    else:
+        lines = zip([i + 2 for i in positions], index.read(file, positions))
+    for lcount, line in lines:
+        if not line.strip():
+            continue
+        j1 = jsonio.loads(line, check)
+        if not ("type" in j1 and j1["type"] == "CityJSONFeature"):
+            raise OSError(f"Line {lcount} is not of type 'CityJSONFeature'.")
+        if read_filter is None or read_filter.keep_feature(j1, transform):
+            cm.add_cityjsonfeature(j1)
+    cm.clean_vertices()
+    cm.update_bbox()
+    name = getattr(file, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        cm.path = os.path.abspath(name)
+    return cm
+
+
+def read_stdin_features():
+    """Read a CityJSONSeq from stdin, one CityJSONFeature at a time.
+
+    Unlike :py:func:`read_stdin`, the features are not folded into one city model:
+    each CityJSONFeature is returned as a small CityJSON object holding the
+    first-line CityJSON object and that single feature, so memory stays flat
+    whatever the size of the stream.
+
+    Returns a generator over the CityJSON objects.
+    """
+    return read_jsonl_features(utils.open_stdin())
+
+
+def read_jsonl_features(file):
+    """Read a CityJSONSeq file one CityJSONFeature at a time, see
+    :py:func:`read_stdin_features`."""
+    lcount = 1
+    header = json.loads(file.readline())
+    for line in file:
         lcount += 1
-        line = sys.stdin.readline()
-        if line != "":
-            j1 = json.loads(line)
-            if not ("type" in j1 and j1["type"] == "CityJSONFeature"):
-                raise IOError(
-                    "Line {} is not of type 'CityJSONFeature'.".format(lcount)
+        if not line.strip():
+            continue
+        j1 = json.loads(line)
+        if not ("type" in j1 and j1["type"] == "CityJSONFeature"):
+            raise OSError(f"Line {lcount} is not of type 'CityJSONFeature'.")
+        yield cityjson_from_feature(header, j1)
+
+
+def read_file_features(file, ignore_duplicate_keys=False):
+    """Read a CityJSON file one CityJSONFeature at a time, like
+    :py:func:`read_stdin_features`, without loading the whole file.
+
+    The file is parsed twice: first for the members of the root, the vertices
+    (kept in a NumPy array) and the hierarchy of the CityObjects, then for the
+    CityObjects themselves. These are kept only until the features they are in
+    are complete, the features are generated in the order of
+    :py:func:`CityJSON.generate_features`.
+
+    Returns a generator over the CityJSON objects.
+    """
+    if not file.seekable():
+        cm = CityJSON(file=file, ignore_duplicate_keys=ignore_duplicate_keys)
+        header = {k: v for k, v in cm.j.items() if k != "appearance"}
+        for feature in cm.generate_features():
+            yield cityjson_from_feature(header, feature.j)
+        return
+    # -- 1st pass: all but the CityObjects, of which only the ids referenced
+    header = {}
+    chunks = []
+    refs = {}
+    position = {}
+    roots = []
+    for member, key, value in jsonio.iterparse(file):
+        if member == "CityObjects":
+            if key in refs and not ignore_duplicate_keys:
+                raise ValueError(
+                    f"Invalid CityJSON file, duplicate key for City Object IDs: {key!r}"
                 )
-            cm.add_cityjsonfeature(j1)
+            position[key] = len(position)
+            refs[key] = value.get("children", [])
+            if "parents" not in value:
+                roots.append(key)
+                if value.get("type") == "CityObjectGroup":
+                    refs[key] = value.get("members", []) + refs[key]
+        elif member == "vertices":
+            chunks.append(value)
         else:
-            cm.remove_duplicate_vertices()
-            cm.remove_orphan_vertices()
-            cm.update_bbox()
+            header[key] = value
+    if header.get("type") != "CityJSON":
+        raise ValueError("Not a CityJSON file")
+    vertices = np.concatenate(chunks) if chunks else np.zeros((0, 3), np.int64)
+    del chunks
+    # -- the CityObjects of each feature, as CityJSON.get_cityjsonfeature() does
+    features = []
+    count = Counter()
+    for root in roots:
+        todo = [root]
+        selected = {}
+        for coid in todo:
+            if coid in refs and coid not in selected:
+                selected[coid] = None
+                todo += refs[coid]
+        features.append((max(position[coid] for coid in selected), root, selected))
+        count.update(selected.keys())
+    del refs, position
+    # -- 2nd pass: a feature is generated as soon as its CityObjects are read
+    j = dict(header)
+    j["CityObjects"] = {}
+    j["vertices"] = vertices
+    cm = CityJSON(j=j)
+    header.pop("appearance", None)
+    nextf = 0
+    file.seek(0)
+    for i, (member, coid, co) in enumerate(
+        e for e in jsonio.iterparse(file) if e[0] == "CityObjects"
+    ):
+        if count[coid] > 0:
+            j["CityObjects"][coid] = co
+        while nextf < len(features) and features[nextf][0] <= i:
+            _, root, selected = features[nextf]
+            yield cityjson_from_feature(header, cm.get_cityjsonfeature(root).j)
+            for each in selected:
+                count[each] -= 1
+                if count[each] == 0:
+                    del j["CityObjects"][each]
+            nextf += 1
+        if nextf == len(features):
             break
-    return cm
 
 
-def reader(file, ignore_duplicate_keys=False):
-    return CityJSON(file=file, ignore_duplicate_keys=ignore_duplicate_keys)
+def cityjson_from_feature(header, feature):
+    """Create a CityJSON object with one CityJSONFeature.
+
+    The 'header' is the first CityJSON object of the CityJSONSeq, its members are
+    copied so that operators can modify each feature independently (except the
+    'geometry-templates', which are shared).
+    """
+    j = {}
+    for p in header:
+        if p == "geometry-templates":
+            j[p] = header[p]
+        elif p not in ["CityObjects", "vertices"]:
+            j[p] = copy.deepcopy(header[p])
+    j["CityObjects"] = feature["CityObjects"]
+    j["vertices"] = feature["vertices"]
+    if "appearance" in feature:
+        j["appearance"] = feature["appearance"]
+    return CityJSON(j=j)
+
+
+def reader(file, ignore_duplicate_keys=False, read_filter=None, path=None):
+    return CityJSON(
+        file=file,
+        ignore_duplicate_keys=ignore_duplicate_keys,
+        read_filter=read_filter,
+        path=path,
+    )
+
+
+def read_files(paths, jobs=1, ignore_duplicate_keys=False):
+    """Read several CityJSON files (possibly compressed), in parallel by a pool of
+    processes with jobs > 1. Returns the CityJSON objects in the order of the
+    paths."""
+    read = functools.partial(_read_path, ignore_duplicate_keys=ignore_duplicate_keys)
+    if jobs > 1 and len(paths) > 1:
+        return list(utils.parallel_map(read, paths, min(jobs, len(paths))))
+    return [read(path) for path in paths]
+
+
+def _read_path(path, ignore_duplicate_keys=False):
+    with utils.open_file(path, mode="rb") as f:
+        return reader(f, ignore_duplicate_keys, path=path)
 
 
 def off2cj(file):
@@ -193,6 +382,76 @@ def update_geom_indices(a, offset):
                 a[i] = each + offset
 
 
+def update_boundaries_indices(geoms, offset):
+    """Add 'offset' to all the vertex indices of the boundaries of the geometries."""
+    flat, layout = geom_help.pack_boundaries(geoms)
+    geom_help.unpack_boundaries(geoms, flat + offset, layout)
+
+
+def merge_transform(transforms):
+    """The transform of city models merged: the finest of their scales (as a
+    number of digits, the same for x, y and z) and the smallest translation."""
+    imp_digits = 3
+    translate = [0.0, 0.0, 0.0]
+    if len(transforms) > 0:
+        imp_digits = max(math.ceil(abs(math.log10(t["scale"][0]))) for t in transforms)
+        translate = np.min([t["translate"] for t in transforms], axis=0).tolist()
+    ss = 1.0 / (math.pow(10, imp_digits))
+    return {"scale": [ss, ss, ss], "translate": translate}
+
+
+def quantize(vertices, transform, target):
+    """The vertices (NumPy array (N, 3), integers in 'transform', or real-world
+    coordinates if it is None) as integers in the 'target' transform, rescaled
+    with array arithmetic.
+
+    They are exact when the scale and the translation are multiples of the
+    target scale, otherwise rounded to the nearest integer.
+    """
+    s0 = np.ones(3)
+    t0 = np.zeros(3)
+    if transform is not None:
+        s0 = np.asarray(transform["scale"], dtype=np.float64)
+        t0 = np.asarray(transform["translate"], dtype=np.float64)
+    scale = np.asarray(target["scale"], dtype=np.float64)
+    shift = (t0 - np.asarray(target["translate"], dtype=np.float64)) / scale
+    return np.rint(vertices * (s0 / scale) + shift).astype(np.int64)
+
+
+def round_decimal(a, digits):
+    """The floats of 'a' times 10^digits as int64, rounded like
+    int(("%.3f" % x).replace(".", "")) for digits=3: the exact value of the
+    float, half to even.
+
+    The product is done with NumPy, its rounding error can change the result
+    only close to a half: these values are formatted one by one.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    y = a * (10.0**digits)
+    r = np.rint(y)
+    # -- the error of the product is at most half an ulp, 2^-53 relative; the
+    # -- temporary arrays are reused, this is the bulk of the time
+    d = y - r
+    np.abs(d, out=d)
+    d -= 0.5
+    np.abs(d, out=d)
+    np.abs(y, out=y)
+    with np.errstate(invalid="ignore"):
+        doubtful = ~(y < 2.0**53)
+        y *= 4.5e-16
+        doubtful |= d <= y
+        re = r.astype(np.int64)
+    if doubtful.any():
+        p = "%." + str(digits) + "f"
+        exact = [int((p % x).replace(".", "")) for x in a[doubtful].tolist()]
+        if any(abs(x) >= 2**63 for x in exact):
+            raise ValueError(
+                f"Coordinates too large to be stored as integers with {digits} digits"
+            )
+        re[doubtful] = exact
+    return re
+
+
 def update_texture_indices(a, toffset, voffset):
     for i, each in enumerate(a):
         if isinstance(each, list):
@@ -205,14 +464,246 @@ def update_texture_indices(a, toffset, voffset):
                     a[i] = each + voffset
 
 
+def copy_cityobject(co):
+    """Deep copy of a CityObject, except the boundaries that are shared.
+
+    For when the boundaries are going to be replaced anyway (eg by
+    :py:func:`subset.process_geometry`), copying them is the bulk of the work.
+    """
+    co2 = {}
+    for k, v in co.items():
+        if k == "geometry":
+            co2[k] = [
+                {
+                    k2: v2 if k2 == "boundaries" else copy.deepcopy(v2)
+                    for k2, v2 in g.items()
+                }
+                for g in v
+            ]
+        else:
+            co2[k] = copy.deepcopy(v)
+    return co2
+
+
+# -- the city model of a worker process of export2jsonl()
+_features_cm = None
+
+
+def _init_features_worker(cm):
+    global _features_cm
+    _features_cm = cm
+
+
+def _features_to_jsonl(ids):
+    lines = []
+    for theid in ids:
+        feature = _features_cm.get_cityjsonfeature(theid)
+        lines.append(jsonio.dumps(feature.j) + "\n")
+    return "".join(lines)
+
+
+# -- the city model of a worker process that triangulates, and the arguments
+# -- given to CityJSON.map_cityobjects()
+_triangulate_cm = None
+_triangulate_args = ()
+
+
+def _init_triangulate_worker(cm, args):
+    global _triangulate_cm, _triangulate_args
+    _triangulate_cm = cm
+    _triangulate_args = args
+
+
+def _triangulate_chunk(ids):
+    cm = _triangulate_cm
+    cm._triangulate_cityobjects(ids, *_triangulate_args)
+    return [(theid, cm.j["CityObjects"][theid]["geometry"]) for theid in ids]
+
+
+def _obj_chunk(ids):
+    out = StringIO()
+    for theid in ids:
+        _triangulate_cm._write_obj_cityobject(out, theid, *_triangulate_args)
+    return out.getvalue()
+
+
+def _stl_chunk(ids):
+    out = StringIO()
+    for theid in ids:
+        _triangulate_cm._write_stl_cityobject(out, theid, *_triangulate_args)
+    return out.getvalue()
+
+
+@functools.lru_cache(maxsize=16)
+def get_transformer(epsg_in, epsg_out):
+    """Get the pyproj transformer from one EPSG to another (3D).
+
+    The transformer is created (and its grids downloaded) only once, so that
+    several city models can be reprojected cheaply, eg each CityJSONFeature of
+    a stream.
+    """
+    crs_in = CRS(f"EPSG:{epsg_in:d}").to_3d()
+    crs_out = CRS(f"EPSG:{epsg_out:d}").to_3d()
+    # Using TransformerGroup instead of Transformer, because we cannot retrieve the
+    # transformer defintion from it.
+    # See https://github.com/pyproj4/pyproj/issues/753#issuecomment-737249093
+    tg = TransformerGroup(crs_in, crs_out, always_xy=False)
+    tg.download_grids(verbose=True)
+    return tg.transformers[0]
+
+
+def _transform_vertices(transformer, vertices):
+    """The vertices (NumPy array (N, 3)) transformed with pyproj, all at once."""
+    x, y, z = transformer.transform(vertices[:, 0], vertices[:, 1], vertices[:, 2])
+    return np.column_stack((x, y, z))
+
+
+# -- the transformer of a worker process of reproject()
+_reproject_transformer = None
+
+
+def _init_reproject_worker(epsg_in, epsg_out):
+    global _reproject_transformer
+    # -- a forked process creates its own, the PROJ objects are not shared
+    get_transformer.cache_clear()
+    _reproject_transformer = get_transformer(epsg_in, epsg_out)
+
+
+def _reproject_chunk(vertices):
+    return _transform_vertices(_reproject_transformer, vertices)
+
+
+class ReadFilter:
+    """What the first operators of a pipeline discard anyway, the reader then
+    does not keep it (see :py:func:`CityJSON.read`).
+
+    It keeps a superset of what the operators keep (eg the children of the
+    CityObjects selected), they still have to be run on the city model read.
+    """
+
+    def __init__(self):
+        # -- None: all the CityObjects are kept
+        self.ids = None
+        self.cotypes = None
+        # -- only for a CityJSONSeq, the features are selected (read_jsonl())
+        self.bbox = None
+        self.random = None
+        self.lods = None
+        self.attributes = set()
+        self.textures = True
+        self.materials = True
+
+    def __bool__(self):
+        return (
+            self.ids is not None
+            or self.cotypes is not None
+            or self.lods is not None
+            or len(self.attributes) > 0
+            or not self.textures
+            or not self.materials
+        )
+
+    def select(self, ids=None, cotypes=None, bbox=None, random=None):
+        # -- only the first selection, a second one is done on the first one
+        if (self.ids, self.cotypes, self.bbox, self.random) == (None,) * 4:
+            self.ids = None if ids is None else set(ids)
+            self.cotypes = None if cotypes is None else set(cotypes)
+            self.bbox = None if bbox is None else list(bbox)
+            self.random = random
+
+    def filter_lod(self, lod):
+        self.lods = {lod} if self.lods is None else self.lods & {lod}
+
+    def remove_attribute(self, attr):
+        self.attributes.add(attr)
+
+    def remove_textures(self):
+        self.textures = False
+
+    def remove_materials(self):
+        self.materials = False
+
+    def skip(self):
+        """The members of the root not read."""
+        if not self.textures and not self.materials:
+            return {"appearance"}
+        return set()
+
+    def keep(self, coid, co):
+        """Removes from the CityObject what is discarded, and returns whether it
+        is kept."""
+        if len(self.attributes) > 0 and isinstance(co.get("attributes"), dict):
+            for attr in self.attributes:
+                co["attributes"].pop(attr, None)
+        if self.lods is not None and "geometry" in co:
+            co["geometry"] = [
+                g
+                for g in co["geometry"]
+                if "lod" not in g or str(g["lod"]) in self.lods
+            ]
+        for g in co.get("geometry", []):
+            if not self.textures:
+                g.pop("texture", None)
+            if not self.materials:
+                g.pop("material", None)
+        if self.ids is not None and coid not in self.ids:
+            return False
+        return self.cotypes is None or co.get("type") in self.cotypes
+
+    def keep_feature(self, feature, transform=None):
+        """Like :py:meth:`keep` for the CityObjects of a CityJSONFeature, which is
+        kept if one of them is, and if it overlaps the bbox selected."""
+        kept = [self.keep(coid, co) for coid, co in feature["CityObjects"].items()]
+        if not any(kept):
+            return False
+        if self.bbox is not None:
+            bbox = featureindex.feature_bbox(feature, transform)
+            return bbox is not None and featureindex.bbox_overlaps(bbox, self.bbox)
+        return True
+
+    def features(self, index):
+        """The positions in a :py:class:`featureindex.FeatureIndex` of the
+        features to read, None for all of them."""
+        if self.random is not None:
+            return index.sample(self.random)
+        if self.ids is not None:
+            return index.lookup_ids(self.ids)
+        if self.bbox is not None:
+            return index.query_bbox(self.bbox)
+        return None
+
+    def needed(self, cityobjects):
+        """The IDs the CityObjects kept refer to: children, members of groups."""
+        re = set()
+        for co in cityobjects.values():
+            re.update(co.get("children", []))
+            if co.get("type") == "CityObjectGroup":
+                re.update(co.get("members", []))
+        return re
+
+
 class CityJSON:
-    def __init__(self, file=None, j=None, ignore_duplicate_keys=False):
+    def __init__(
+        self,
+        file=None,
+        j=None,
+        ignore_duplicate_keys=False,
+        read_filter=None,
+        path=None,
+    ):
         if file is not None:
-            self.read(file, ignore_duplicate_keys)
-            self.path = os.path.abspath(file.name)
-            self.reference_date = datetime.fromtimestamp(
-                os.path.getmtime(file.name)
-            ).strftime("%Y-%m-%d")
+            self.read(file, ignore_duplicate_keys, read_filter)
+            # -- the decompressed files (.bz2, .xz) have no name, thus 'path'
+            if path is None:
+                path = getattr(file, "name", None)
+            if isinstance(path, str) and os.path.isfile(path):
+                self.path = os.path.abspath(path)
+                self.reference_date = datetime.fromtimestamp(
+                    os.path.getmtime(path)
+                ).strftime("%Y-%m-%d")
+            else:
+                self.path = None
+                self.reference_date = datetime.now().strftime("%Y-%m-%d")
             self.cityobjects = {}
         elif j is not None:
             self.j = j
@@ -228,6 +719,7 @@ class CityJSON:
             self.cityobjects = {}
             self.path = None
             self.reference_date = datetime.now().strftime("%Y-%m-%d")
+        self._spatialindex = None
 
     def __repr__(self):
         return os.linesep.join(self.get_info())
@@ -287,19 +779,48 @@ class CityJSON:
     def is_transform(self):
         return "transform" in self.j
 
-    def read(self, file, ignore_duplicate_keys=False):
-        if ignore_duplicate_keys:
-            try:
-                self.j = json.loads(file.read())
-            except json.decoder.JSONDecodeError as err:
-                raise err
+    def vertices_array(self):
+        """Returns the vertices as a (N, 3) NumPy array.
+
+        The array is int64 when the city model has a "transform", float64 otherwise.
+        It is a copy: modifying it does not modify the city model.
+        """
+        dtype = np.int64 if "transform" in self.j else np.float64
+        vertices = self.j["vertices"]
+        if isinstance(vertices, np.ndarray):
+            return vertices.astype(dtype).reshape(-1, 3)
+        # -- the coordinates are copied one by one, without the intermediate
+        # -- arrays np.array() creates for each vertex
+        if set(map(len, vertices)) <= {3}:
+            flat = chain.from_iterable(vertices)
+            return np.fromiter(flat, dtype, count=3 * len(vertices)).reshape(-1, 3)
+        return np.array(vertices, dtype=dtype).reshape(-1, 3)
+
+    def real_vertices(self):
+        """Returns the vertices as a (N, 3) float64 NumPy array of real-world
+        coordinates, the "transform" (if any) applied to a copy.
+
+        The city model is not modified, unlike with :py:meth:`decompress`.
+        """
+        vnp = self.vertices_array()
+        if "transform" not in self.j:
+            return vnp
+        s = np.array(self.j["transform"]["scale"])
+        t = np.array(self.j["transform"]["translate"])
+        return (vnp * s) + t
+
+    def read(self, file, ignore_duplicate_keys=False, read_filter=None):
+        self._spatialindex = None
+        # -- only the IDs of the CityObjects are checked for duplicates
+        if read_filter:
+            self.j = jsonio.load(
+                file,
+                check_duplicates=not ignore_duplicate_keys,
+                cityobjects=read_filter,
+                skip=read_filter.skip(),
+            )
         else:
-            try:
-                self.j = json.loads(
-                    file.read(), object_pairs_hook=self.dict_raise_on_duplicates
-                )
-            except ValueError as err:
-                raise ValueError(err)
+            self.j = jsonio.load(file, check_duplicates=not ignore_duplicate_keys)
         # -- a CityJSON file?
         if "type" in self.j and self.j["type"] == "CityJSON":
             pass
@@ -365,8 +886,8 @@ class CityJSON:
         """
         if len(self.j["vertices"]) == 0:
             return [0, 0, 0, 0, 0, 0]
-        x, y, z = zip(*self.j["vertices"])
-        bbox = [min(x), min(y), min(z), max(x), max(y), max(z)]
+        vnp = self.vertices_array()
+        bbox = vnp.min(axis=0).tolist() + vnp.max(axis=0).tolist()
         if "transform" in self.j:
             s = self.j["transform"]["scale"]
             t = self.j["transform"]["translate"]
@@ -419,38 +940,47 @@ class CityJSON:
         return True
 
     def update_bbox_each_cityobjects(self, addifmissing=False):
-        def recusionvisit(a, vs):
-            for each in a:
-                if isinstance(each, list):
-                    recusionvisit(each, vs)
-                else:
-                    vs.append(each)
+        table = self.get_cityobjects_table()
+        for i, co in enumerate(self.j["CityObjects"].values()):
+            if table.count[i] > 0 and (addifmissing or "geographicalExtent" in co):
+                co["geographicalExtent"] = table.bbox[i].tolist()
 
-        for co in self.j["CityObjects"]:
-            if addifmissing or "geographicalExtent" in self.j["CityObjects"][co]:
-                vs = []
-                bbox = [9e9, 9e9, 9e9, -9e9, -9e9, -9e9]
-                if "geometry" in self.j["CityObjects"][co]:
-                    for g in self.j["CityObjects"][co]["geometry"]:
-                        recusionvisit(g["boundaries"], vs)
-                        for each in vs:
-                            v = self.j["vertices"][each]
-                            for i in range(3):
-                                if v[i] < bbox[i]:
-                                    bbox[i] = v[i]
-                            for i in range(3):
-                                if v[i] > bbox[i + 3]:
-                                    bbox[i + 3] = v[i]
-                        if "transform" in self.j:
-                            for i in range(3):
-                                bbox[i] = (
-                                    bbox[i] * self.j["transform"]["scale"][i]
-                                ) + self.j["transform"]["translate"][i]
-                            for i in range(3):
-                                bbox[i + 3] = (
-                                    bbox[i + 3] * self.j["transform"]["scale"][i]
-                                ) + self.j["transform"]["translate"][i]
-                        self.j["CityObjects"][co]["geographicalExtent"] = bbox
+    def get_cityobjects_table(self):
+        """Number of vertices, centroid and bbox of all the CityObjects at once.
+
+        The vertices of the boundaries of all the geometries of a CityObject are
+        counted with repetitions, as :py:meth:`get_centroid` does. The bbox is
+        [minx, miny, minz, maxx, maxy, maxz], real-world coordinates. Centroid
+        and bbox are NaN for the CityObjects without vertices.
+
+        :return: a CityObjectsTable, row i is for the CityObject ids[i]
+        """
+        ids = list(self.j["CityObjects"])
+        geoms = []
+        ngeoms = []
+        for co in self.j["CityObjects"].values():
+            geoms += co.get("geometry", [])
+            ngeoms.append(len(co.get("geometry", [])))
+        flat, layout = geom_help.pack_boundaries(geoms)
+        # -- the vertices of CityObject i are flat[start[i]:start[i + 1]]
+        gstart = np.cumsum([0] + [n for n, _ in layout])
+        start = gstart[np.cumsum([0, *ngeoms])]
+        count = np.diff(start)
+        centroid = np.full((len(ids), 3), np.nan)
+        bbox = np.full((len(ids), 6), np.nan)
+        has = count > 0
+        if has.any():
+            pts = self.vertices_array()[flat]
+            segments = start[:-1][has]
+            centroid[has] = np.add.reduceat(pts, segments) / count[has][:, None]
+            bbox[has, :3] = np.minimum.reduceat(pts, segments)
+            bbox[has, 3:] = np.maximum.reduceat(pts, segments)
+            if "transform" in self.j:
+                s = np.array(self.j["transform"]["scale"])
+                t = np.array(self.j["transform"]["translate"])
+                centroid = centroid * s + t
+                bbox = bbox * np.tile(s, 2) + np.tile(t, 2)
+        return CityObjectsTable(ids, count, centroid, bbox)
 
     def get_centroid(self, coid):
         def recusionvisit(a, vs):
@@ -461,35 +991,19 @@ class CityJSON:
                     vs.append(each)
 
         # -- find the 3D centroid
-        centroid = [0, 0, 0]
-        total = 0
+        vs = []
         if "geometry" in self.j["CityObjects"][coid]:
             for g in self.j["CityObjects"][coid]["geometry"]:
-                vs = []
                 recusionvisit(g["boundaries"], vs)
-                for each in vs:
-                    v = self.j["vertices"][each]
-                    total += 1
-                    centroid[0] += v[0]
-                    centroid[1] += v[1]
-                    centroid[2] += v[2]
-        if total != 0:
-            centroid[0] /= total
-            centroid[1] /= total
-            centroid[2] /= total
-            if "transform" in self.j:
-                centroid[0] = (centroid[0] * self.j["transform"]["scale"][0]) + self.j[
-                    "transform"
-                ]["translate"][0]
-                centroid[1] = (centroid[1] * self.j["transform"]["scale"][1]) + self.j[
-                    "transform"
-                ]["translate"][1]
-                centroid[2] = (centroid[2] * self.j["transform"]["scale"][2]) + self.j[
-                    "transform"
-                ]["translate"][2]
-            return centroid
-        else:
+        if len(vs) == 0:
             return None
+        a = np.array([self.j["vertices"][each] for each in vs])
+        centroid = (a.sum(axis=0) / len(vs)).tolist()
+        if "transform" in self.j:
+            s = self.j["transform"]["scale"]
+            t = self.j["transform"]["translate"]
+            centroid = [a * b + c for a, b, c in zip(centroid, s, t)]
+        return centroid
 
     def get_identifier(self):
         """
@@ -526,30 +1040,53 @@ class CityJSON:
 
         return self.get_identifier()
 
+    def get_spatial_index(self):
+        """Spatial index on the 2D centroids of the top-level CityObjects.
+
+        Only those can be selected by a subset, the children follow their parent.
+        The index is built at the first query and kept until a method modifies the
+        CityObjects, their geometries, the vertices or the transform. After
+        modifying ``self.j`` directly, set ``self._spatialindex = None``.
+        """
+        if self._spatialindex is None:
+            table = self.get_cityobjects_table()
+            keep = table.count > 0
+            for i, co in enumerate(self.j["CityObjects"].values()):
+                keep[i] &= self.is_co_toplevel(co)
+            keep = np.nonzero(keep)[0]
+            ids = [table.ids[i] for i in keep.tolist()]
+            points = table.centroid[keep, :2]
+            self._spatialindex = spatialindex.GridIndex(ids, points)
+        return self._spatialindex
+
+    def _ids_from_index(self, indices):
+        ids = self.get_spatial_index().ids
+        return {ids[i] for i in indices.tolist()}
+
     def get_subset_bbox(self, bbox, exclude=False):
-        re = set()
-        for coid in self.j["CityObjects"]:
-            centroid = self.get_centroid(coid)
-            if (
-                (centroid is not None)
-                and (centroid[0] >= bbox[0])
-                and (centroid[1] >= bbox[1])
-                and (centroid[0] < bbox[2])
-                and (centroid[1] < bbox[3])
-            ):
-                re.add(coid)
+        re = self._ids_from_index(self.get_spatial_index().query_bbox(bbox))
         return self.subset(lsIDs=re, exclude=exclude)
 
     def get_subset_radius(self, x, y, radius, exclude=False):
-        re = set()
-        for coid in self.j["CityObjects"]:
-            centroid = self.get_centroid(coid)
-            if centroid is not None:
-                dist = ((centroid[0] - x) ** 2) + ((centroid[1] - y) ** 2)
-                if dist < radius**2:
-                    re.add(coid)
+        re = self._ids_from_index(self.get_spatial_index().query_radius(x, y, radius))
+        return self.subset(lsIDs=re, exclude=exclude)
+
+    def get_subset_polygon(self, polygon, exclude=False):
+        """Subset with the CityObjects whose centroid is inside a 2D polygon.
+
+        :param polygon: list of (x, y), the ring is closed implicitly
+        """
+        re = self._ids_from_index(self.get_spatial_index().query_polygon(polygon))
         return self.subset(lsIDs=re, exclude=exclude)
 
+    def get_nearest(self, x, y, k=1):
+        """IDs of the k top-level CityObjects nearest to (x, y), the nearest first."""
+        idx = self.get_spatial_index()
+        return [idx.ids[i] for i in idx.query_nearest(x, y, k).tolist()]
+
+    def get_subset_nearest(self, x, y, k=1, exclude=False):
+        return self.subset(lsIDs=set(self.get_nearest(x, y, k)), exclude=exclude)
+
     def is_co_toplevel(self, co):
         return "parents" not in co
 
@@ -878,80 +1415,55 @@ class CityJSON:
                     d[s] += 1
                 self.info_children_dfs(c, s, d)
 
-    def remove_orphan_vertices(self):
-        def visit_geom(a, oldnewids, newvertices):
-            for i, each in enumerate(a):
-                if isinstance(each, list):
-                    visit_geom(each, oldnewids, newvertices)
-                else:
-                    if each not in oldnewids:
-                        oldnewids[each] = len(newvertices)
-                        newvertices.append(each)
+    def clean_vertices(self):
+        """Remove the duplicate and the orphan vertices, in one pass.
 
-        def update_face(a, oldnewids):
-            for i, each in enumerate(a):
-                if isinstance(each, list):
-                    update_face(each, oldnewids)
-                else:
-                    a[i] = oldnewids[each]
+        Gives the same result as remove_duplicate_vertices() followed by
+        remove_orphan_vertices(), but each boundary is rewritten only once.
 
-        # --
+        :return: (number of duplicate vertices, number of orphan vertices)
+        """
+        self._spatialindex = None
         totalinput = len(self.j["vertices"])
-        oldnewids = {}
-        newvertices = []
-        # -- visit each geom to gather used ids
-        for theid in self.j["CityObjects"]:
-            if "geometry" in self.j["CityObjects"][theid]:
-                for g in self.j["CityObjects"][theid]["geometry"]:
-                    visit_geom(g["boundaries"], oldnewids, newvertices)
-        # -- update the faces ids
-        for theid in self.j["CityObjects"]:
-            if "geometry" in self.j["CityObjects"][theid]:
-                for g in self.j["CityObjects"][theid]["geometry"]:
-                    update_face(g["boundaries"], oldnewids)
+        vnp = self.vertices_array()
+        newids, first = geom_help.unique_rows(vnp)
+        geoms = [
+            g for co in self.j["CityObjects"].values() for g in co.get("geometry", [])
+        ]
+        # -- deduplicate then renumber the used ids in the order they appear
+        flat, layout = geom_help.pack_boundaries(geoms)
+        newflat, used = geom_help.compact_indices(newids[flat])
+        geom_help.unpack_boundaries(geoms, newflat, layout)
+        self.j["vertices"] = vnp[first[used]].tolist()
+        return totalinput - len(first), len(first) - len(used)
+
+    def remove_orphan_vertices(self):
+        self._spatialindex = None
+        totalinput = len(self.j["vertices"])
+        geoms = [
+            g for co in self.j["CityObjects"].values() for g in co.get("geometry", [])
+        ]
+        # -- renumber the used ids in the order they appear
+        flat, layout = geom_help.pack_boundaries(geoms)
+        newflat, used = geom_help.compact_indices(flat)
+        geom_help.unpack_boundaries(geoms, newflat, layout)
         # -- replace the vertices, innit?
-        newv2 = []
-        for v in newvertices:
-            newv2.append(self.j["vertices"][v])
-        self.j["vertices"] = newv2
+        self.j["vertices"] = [self.j["vertices"][i] for i in used.tolist()]
         return totalinput - len(self.j["vertices"])
 
     def remove_duplicate_vertices(self):
-        def update_geom_indices(a, newids):
-            for i, each in enumerate(a):
-                if isinstance(each, list):
-                    update_geom_indices(each, newids)
-                else:
-                    a[i] = newids[each]
-
-        # --
+        self._spatialindex = None
         totalinput = len(self.j["vertices"])
-        h = {}
-        newids = [-1] * len(self.j["vertices"])
-        newvertices = []
-        for i, v in enumerate(self.j["vertices"]):
-            s = "{x} {y} {z}".format(x=v[0], y=v[1], z=v[2])
-            if s not in h:
-                newid = len(h)
-                newids[i] = newid
-                h[s] = newid
-                newvertices.append(s)
-            else:
-                newids[i] = h[s]
+        vnp = self.vertices_array()
+        newids, first = geom_help.unique_rows(vnp)
         # -- update indices
-        for theid in self.j["CityObjects"]:
-            if "geometry" in self.j["CityObjects"][theid]:
-                for g in self.j["CityObjects"][theid]["geometry"]:
-                    update_geom_indices(g["boundaries"], newids)
+        geoms = [
+            g for co in self.j["CityObjects"].values() for g in co.get("geometry", [])
+        ]
+        flat, layout = geom_help.pack_boundaries(geoms)
+        geom_help.unpack_boundaries(geoms, newids[flat], layout)
         # -- replace the vertices, innit?
-        newv2 = []
-        for v in newvertices:
-            if "transform" in self.j:
-                a = list(map(int, v.split()))
-            else:
-                a = list(map(float, v.split()))
-            newv2.append(a)
-        self.j["vertices"] = newv2
+        self.j["vertices"] = vnp[first].tolist()
         return totalinput - len(self.j["vertices"])
 
     def compress(self, important_digits=3, translate=None):
@@ -964,23 +1476,26 @@ class CityJSON:
         """
         if "transform" in self.j:
             return False
+        self.set_vertices(self.vertices_array(), important_digits, translate)
+        return True
+
+    def set_vertices(self, vertices, important_digits=3, translate=None):
+        """Replace the vertices by 'vertices', real-world coordinates (NumPy array
+        (N, 3)), stored as integers with a new "transform" like :py:meth:`compress`
+        does.
+        """
+        self._spatialindex = None
         # -- find the minx/miny/minz or set from translate
         if translate:
             bbox = translate
-        else:
+        elif len(vertices) == 0:
             bbox = [9e9, 9e9, 9e9]
-            for v in self.j["vertices"]:
-                for i in range(3):
-                    if v[i] < bbox[i]:
-                        bbox[i] = v[i]
+        else:
+            bbox = vertices.min(axis=0).tolist()
         # convert vertices in self.j to int
-        n = [0, 0, 0]
-        p = "%." + str(important_digits) + "f"
-        for v in self.j["vertices"]:
-            for i in range(3):
-                n[i] = v[i] - bbox[i]
-            for i in range(3):
-                v[i] = int((p % n[i]).replace(".", ""))
+        vnp = vertices - np.asarray(bbox, dtype=np.float64)
+        # -- an array, clean_vertices() makes it the list of the city model
+        self.j["vertices"] = round_decimal(vnp, important_digits)
 
         # put transform
         ss = 1.0 / (math.pow(10, important_digits))
@@ -989,36 +1504,27 @@ class CityJSON:
         self.j["transform"]["scale"] = [ss, ss, ss]
         self.j["transform"]["translate"] = [bbox[0], bbox[1], bbox[2]]
         # -- clean the file
-        _ = self.remove_duplicate_vertices()
-        _ = self.remove_orphan_vertices()
-        return True
+        self.clean_vertices()
 
     def decompress(self):
+        self._spatialindex = None
         if "transform" in self.j:
-            for v in self.j["vertices"]:
-                v[0] = (v[0] * self.j["transform"]["scale"][0]) + self.j["transform"][
-                    "translate"
-                ][0]
-                v[1] = (v[1] * self.j["transform"]["scale"][1]) + self.j["transform"][
-                    "translate"
-                ][1]
-                v[2] = (v[2] * self.j["transform"]["scale"][2]) + self.j["transform"][
-                    "translate"
-                ][2]
+            self.j["vertices"] = self.real_vertices().tolist()
             del self.j["transform"]
             return True
         else:
             return False
 
     def add_cityjsonfeature(self, j):
+        self._spatialindex = None
         offset = len(self.j["vertices"])
         self.j["vertices"] += j["vertices"]
         # -- add each CityObjects
-        for theid in j["CityObjects"]:
-            self.j["CityObjects"][theid] = j["CityObjects"][theid]
-            if "geometry" in self.j["CityObjects"][theid]:
-                for g in self.j["CityObjects"][theid]["geometry"]:
-                    update_geom_indices(g["boundaries"], offset)
+        self.j["CityObjects"].update(j["CityObjects"])
+        update_boundaries_indices(
+            [g for co in j["CityObjects"].values() for g in co.get("geometry", [])],
+            offset,
+        )
 
         # -- materials
         if ("appearance" in j) and ("materials" in j["appearance"]):
@@ -1084,7 +1590,7 @@ class CityJSON:
         # self.update_bbox()
 
     def merge(self, lsCMs):
-        # decompress() everything
+        # rescales the integer vertices to a common transform
         # updates CityObjects
         # updates vertices
         # updates geometry-templates
@@ -1092,18 +1598,17 @@ class CityJSON:
         # updates materials
         #############################
 
-        # -- decompress current CM
-        imp_digits = math.ceil(abs(math.log(self.j["transform"]["scale"][0], 10)))
-        self.decompress()
+        self._spatialindex = None
+        transform = merge_transform(
+            [cm.j["transform"] for cm in [self, *lsCMs] if "transform" in cm.j]
+        )
+        vertices = [self.quantized_vertices(transform)]
+        nvertices = len(vertices[0])
 
         for cm in lsCMs:
-            # -- decompress
-            if math.ceil(abs(math.log(cm.j["transform"]["scale"][0], 10))) > imp_digits:
-                imp_digits = math.ceil(abs(math.log(cm.j["transform"]["scale"][0], 10)))
-            cm.decompress()
-            offset = len(self.j["vertices"])
-            self.j["vertices"] += cm.j["vertices"]
-            # -- add each CityObjects
+            vertices.append(cm.quantized_vertices(transform))
+            # -- add each CityObjects, the indices are updated at once afterwards
+            newgeoms = []
             for theid in cm.j["CityObjects"]:
                 if theid in self.j["CityObjects"]:
                     # -- merge attributes if not present (based on the property name only)
@@ -1124,18 +1629,12 @@ class CityJSON:
                                     break
                             if not b:
                                 self.j["CityObjects"][theid]["geometry"].append(g)
-                                update_geom_indices(
-                                    self.j["CityObjects"][theid]["geometry"][-1][
-                                        "boundaries"
-                                    ],
-                                    offset,
-                                )
+                                newgeoms.append(g)
                 else:
                     # -- copy the CO
                     self.j["CityObjects"][theid] = cm.j["CityObjects"][theid]
-                    if "geometry" in self.j["CityObjects"][theid]:
-                        for g in self.j["CityObjects"][theid]["geometry"]:
-                            update_geom_indices(g["boundaries"], offset)
+                    newgeoms += self.j["CityObjects"][theid].get("geometry", [])
+            update_boundaries_indices(newgeoms, nvertices)
             # -- templates
             if "geometry-templates" in cm.j:
                 if "geometry-templates" in self.j:
@@ -1150,20 +1649,20 @@ class CityJSON:
                     notemplates = 0
                     novtemplate = 0
                 # -- copy templates
-                for t in cm.j["geometry-templates"]["templates"]:
-                    self.j["geometry-templates"]["templates"].append(t)
-                    tmp = self.j["geometry-templates"]["templates"][-1]
-                    update_geom_indices(tmp["boundaries"], novtemplate)
+                self.j["geometry-templates"]["templates"] += cm.j["geometry-templates"][
+                    "templates"
+                ]
+                update_boundaries_indices(
+                    cm.j["geometry-templates"]["templates"], novtemplate
+                )
                 # -- copy vertices
                 self.j["geometry-templates"]["vertices-templates"] += cm.j[
                     "geometry-templates"
                 ]["vertices-templates"]
-                # -- update the "template" in each GeometryInstance
-                for theid in cm.j["CityObjects"]:
-                    if "geometry" in self.j["CityObjects"][theid]:
-                        for g in self.j["CityObjects"][theid]["geometry"]:
-                            if g["type"] == "GeometryInstance":
-                                g["template"] += notemplates
+                # -- update the "template" in each GeometryInstance added
+                for g in newgeoms:
+                    if g["type"] == "GeometryInstance":
+                        g["template"] += notemplates
             # -- materials
             if ("appearance" in cm.j) and ("materials" in cm.j["appearance"]):
                 if ("appearance" in self.j) and ("materials" in self.j["appearance"]):
@@ -1177,19 +1676,16 @@ class CityJSON:
                 # -- copy materials
                 for m in cm.j["appearance"]["materials"]:
                     self.j["appearance"]["materials"].append(m)
-                # -- update the "material" in each Geometry
-                for theid in cm.j["CityObjects"]:
-                    for g in self.j["CityObjects"][theid].get("geometry", []):
-                        if "material" in g:
-                            for m in g["material"]:
-                                if "values" in g["material"][m]:
-                                    update_geom_indices(
-                                        g["material"][m]["values"], offset
-                                    )
-                                else:
-                                    g["material"][m]["value"] = (
-                                        g["material"][m]["value"] + offset
-                                    )
+                # -- update the "material" in each Geometry added
+                for g in newgeoms:
+                    if "material" in g:
+                        for m in g["material"]:
+                            if "values" in g["material"][m]:
+                                update_geom_indices(g["material"][m]["values"], offset)
+                            else:
+                                g["material"][m]["value"] = (
+                                    g["material"][m]["value"] + offset
+                                )
             # -- textures
             if ("appearance" in cm.j) and ("textures" in cm.j["appearance"]):
                 if ("appearance" in self.j) and ("textures" in self.j["appearance"]):
@@ -1211,26 +1707,32 @@ class CityJSON:
                 # -- copy textures
                 for t in cm.j["appearance"]["textures"]:
                     self.j["appearance"]["textures"].append(t)
-                # -- update the "texture" in each Geometry
-                for theid in cm.j["CityObjects"]:
-                    for g in self.j["CityObjects"][theid].get("geometry", []):
-                        if "texture" in g:
-                            for m in g["texture"]:
-                                if "values" in g["texture"][m]:
-                                    update_texture_indices(
-                                        g["texture"][m]["values"], toffset, voffset
-                                    )
-                                else:
-                                    raise KeyError(
-                                        f"The member 'values' is missing from the texture '{m}' in CityObject {theid}"
-                                    )
+                # -- update the "texture" in each Geometry added
+                for g in newgeoms:
+                    if "texture" in g:
+                        for m in g["texture"]:
+                            if "values" in g["texture"][m]:
+                                update_texture_indices(
+                                    g["texture"][m]["values"], toffset, voffset
+                                )
+                            else:
+                                raise KeyError(
+                                    "The member 'values' is missing from the"
+                                    f" texture '{m}'"
+                                )
+            nvertices += len(vertices[-1])
 
-        self.remove_duplicate_vertices()
-        self.remove_orphan_vertices()
+        self.j["transform"] = transform
+        self.j["vertices"] = np.concatenate(vertices)
+        self.clean_vertices()
         self.update_bbox()
-        self.compress(imp_digits)
         return True
 
+    def quantized_vertices(self, transform):
+        """Returns the vertices as integers (NumPy array (N, 3)) in another
+        transform, see :py:func:`quantize`."""
+        return quantize(self.vertices_array(), self.j.get("transform"), transform)
+
     def upgrade_version_v06_v08(self):
         # -- version
         self.j["version"] = "0.8"
@@ -1442,6 +1944,7 @@ class CityJSON:
             return (True, "")
 
     def upgrade_version(self, newversion, digit):
+        self._spatialindex = None
         re = True
         reasons = ""
         if CITYJSON_VERSIONS_SUPPORTED.count(newversion) == 0:
@@ -1463,23 +1966,65 @@ class CityJSON:
             (re, reasons) = self.upgrade_version_v11_v20(reasons, digit)
         return (re, reasons)
 
-    def export2b3dm(self):
-        glb = convert.to_glb(self)
+    def export2b3dm(self, jobs=1, supervisor=None):
+        glb = self.export2glb(jobs=jobs, supervisor=supervisor)
         b3dm = convert.to_b3dm(self, glb)
         return b3dm
 
-    def export2glb(self, do_triangulate=True):
-        self.decompress()
+    def export2glb(self, do_triangulate=True, jobs=1, supervisor=None):
+        """Exports the city model to Binary glTF, returned as BytesIO.
+
+        With jobs > 1 or a supervisor, a copy of the city model is triangulated by
+        worker processes (see :py:meth:`triangulate`) before it is converted.
+        """
+        if do_triangulate and (jobs > 1 or supervisor is not None):
+            cm = copy.deepcopy(self)
+            cm.triangulate(sloppy=False, jobs=jobs, supervisor=supervisor)
+            return convert.to_glb(cm, do_triangulate=False)
         glb = convert.to_glb(self, do_triangulate=do_triangulate)
         return glb
 
-    def export2jsonl(self):
+    def export2jsonl(self, jobs=1):
+        """Exports the city model to CityJSONSeq (JSON Lines), returned as StringIO."""
         out = StringIO()
+        self.write_jsonl(out, jobs)
+        return out
+
+    def write_json(self, out, indent=None):
+        """Writes the city model to a file-like object, one CityObject and one chunk
+        of vertices at a time.
+
+        The text is the same as :py:func:`jsonio.dumps` (compact without indent).
+        """
+        for chunk in jsonio.iterencode(self.j, indent, VERTICES_CHUNK_SIZE):
+            out.write(chunk)
+
+    def write_jsonl(self, out, jobs=1):
+        """Writes the city model as CityJSONSeq (JSON Lines) to a file-like object,
+        one CityJSONFeature at a time.
+
+        With jobs > 1, the CityJSONFeatures are built and serialised in parallel by
+        a pool of processes, the lines keep the order of the CityObjects.
+        """
         out.write(self.cityjson_for_features() + "\n")
+        if jobs > 1:
+            toplevel = (
+                theid
+                for theid, co in self.j["CityObjects"].items()
+                if "parents" not in co
+            )
+            for lines in utils.parallel_map(
+                _features_to_jsonl,
+                utils.chunks(toplevel, FEATURES_CHUNK_SIZE),
+                jobs,
+                initializer=_init_features_worker,
+                initargs=(self,),
+            ):
+                out.write(lines)
+            return
         # -- take each IDs and create on CityJSONFeature
         for feature in self.generate_features():
-            out.write(json.dumps(feature.j, separators=(",", ":")) + "\n")
-        return out
+            out.write(jsonio.dumps(feature.j) + "\n")
 
     def cityjson_for_features(self):
         """Export a CityJSON object string from the city model.
@@ -1497,7 +2042,7 @@ class CityJSON:
             j2["geometry-templates"] = self.j["geometry-templates"]
         if "extensions" in self.j:
             j2["extensions"] = self.j["extensions"]
-        return json.dumps(j2, separators=(",", ":"))
+        return jsonio.dumps(j2)
 
     def generate_features(self):
         """Generates CityJSONFeatures from the city model.
@@ -1510,50 +2055,86 @@ class CityJSON:
 
         Returns a generator over the CityJSONFeatures.
         """
-        idsdone = set()
-        theallowedproperties = ["type", "id", "CityObjects", "vertices", "appearance"]
-        for theid in self.j["CityObjects"]:
-            if ("parents" not in self.j["CityObjects"][theid]) and (
-                theid not in idsdone
-            ):
-                cm2 = self.get_subset_ids([theid])
-                cm2.j["type"] = "CityJSONFeature"
-                cm2.j["id"] = theid
-                # allp = cm2.j
-                todelete = []
-                for p in cm2.j:
-                    if p not in theallowedproperties:
-                        todelete.append(p)
-                for p in todelete:
-                    del cm2.j[p]
-                yield cm2
-                for theid2 in cm2.j["CityObjects"]:
-                    idsdone.add(theid)
-
-    def export2obj(self, sloppy, mtl_fname=None):
+        for theid, co in self.j["CityObjects"].items():
+            if "parents" not in co:
+                yield self.get_cityjsonfeature(theid)
+
+    def get_cityjsonfeature(self, theid):
+        """Returns the CityJSONFeature of one top-level CityObject.
+
+        It contains the CityObject, its children (recursively), and the members if
+        it is a CityObjectGroup. Only those are visited, not the whole city model.
+        GeometryInstances keep their template index, since the templates are stored
+        in the first object of the stream (see :py:func:`cityjson_for_features`).
+        """
+        cos = self.j["CityObjects"]
+        todo = [theid]
+        if cos[theid]["type"] == "CityObjectGroup":
+            todo += cos[theid].get("members", [])
+        selected = {}
+        # -- the children are appended to the list being iterated
+        for coid in todo:
+            if coid in cos and coid not in selected:
+                selected[coid] = copy_cityobject(cos[coid])
+                todo += cos[coid].get("children", [])
+        j2 = {}
+        j2["type"] = "CityJSONFeature"
+        j2["CityObjects"] = selected
+        j2["vertices"] = []
+        subset.process_geometry(self.j, j2)
+        if "appearance" in self.j:
+            j2["appearance"] = {}
+            subset.process_appearance(self.j, j2)
+        j2["id"] = theid
+        return CityJSON(j=j2)
+
+    def export2obj(self, sloppy, mtl_fname=None, jobs=1, supervisor=None):
         """Exports the city model to a Wavefront OBJ file. If the model has textures and `mtl_fname` is not None, a MTL
         file is also created. The obj file will refer to the .mtl file by the name `mtl_fname`.
 
         Both the `.obj` and the optional `.mtl` files are returned as StringIO objects.
         """
-        imp_digits = math.ceil(abs(math.log(self.j["transform"]["scale"][0], 10)))
-        ids = "." + str(imp_digits) + "f"
-        self.decompress()
         out = StringIO()
+        out_mtl = StringIO()
+        if self.write_obj(out, sloppy, mtl_fname, out_mtl, jobs, supervisor):
+            return out, out_mtl
+        return out
+
+    def has_textures(self):
+        return "appearance" in self.j and "textures" in self.j["appearance"]
+
+    def write_obj(
+        self, out, sloppy, mtl_fname=None, out_mtl=None, jobs=1, supervisor=None
+    ):
+        """Writes the city model as Wavefront OBJ to a file-like object, one
+        CityObject at a time. If the model has textures and both `mtl_fname` and
+        `out_mtl` are given, the MTL file is written to `out_mtl` and the obj file
+        refers to it by the name `mtl_fname`.
+
+        With jobs > 1, the CityObjects are triangulated and written by a pool of
+        processes, the output is the same. With a supervisor.Supervisor, the
+        workers are watched (see :py:meth:`triangulate`).
+
+        Returns True if the MTL file was written. The city model is not modified.
+        """
+        imp_digits = 3
+        if "transform" in self.j:
+            imp_digits = math.ceil(abs(math.log(self.j["transform"]["scale"][0], 10)))
+        ids = "." + str(imp_digits) + "f"
         # -- handle textures
-        out_mtl = None
-        has_textures = "appearance" in self.j and "textures" in self.j["appearance"]
         export_textures = (
-            has_textures and mtl_fname is not None
+            self.has_textures() and mtl_fname is not None and out_mtl is not None
         )  # if mtl_fname is None, we don't export textures -> for stdout output
+        textures = None
         if export_textures:
-            out_mtl = StringIO()
             mtl_name = mtl_fname
             out.write("mtllib " + mtl_name + "\n")
             # Create .mtl file
-            textures = self.j["appearance"]["textures"]
+            textures = [
+                dict(t, name=Path(t["image"]).stem)
+                for t in self.j["appearance"]["textures"]
+            ]
             for t in textures:
-                t["name"] = Path(t["image"]).stem
                 out_mtl.write("newmtl {}\n".format(t["name"]))
                 out_mtl.write("Ka 1.000 1.000 1.000\n")
                 out_mtl.write("Kd 1.000 1.000 1.000\n")
@@ -1563,25 +2144,11 @@ class CityJSON:
                 out_mtl.write("map_Kd {}\n".format(t["image"]))
                 out_mtl.write("\n")
         # -- write vertices
-        for v in self.j["vertices"]:
-            s = format(
-                "v {} {} {}\n".format(
-                    format(v[0], ids), format(v[1], ids), format(v[2], ids)
-                )
-            )
-            out.write(s)
-        vnp = np.array(self.j["vertices"])
+        vnp = self.real_vertices()
+        np.savetxt(out, vnp, fmt=f"v %{ids} %{ids} %{ids}")
         # -- translate to minx,miny
-        minx = 9e9
-        miny = 9e9
-        for each in vnp:
-            if each[0] < minx:
-                minx = each[0]
-            if each[1] < miny:
-                miny = each[1]
-        for each in vnp:
-            each[0] -= minx
-            each[1] -= miny
+        if len(vnp) > 0:
+            vnp[:, :2] -= vnp[:, :2].min(axis=0)
 
         # -- write texture vertices
         if (
@@ -1593,71 +2160,128 @@ class CityJSON:
                 s = format("vt {} {}\n".format(format(v[0], ids), format(v[1], ids)))
                 out.write(s)
         # -- start with the CO
-        for theid in self.j["CityObjects"]:
-            if "geometry" not in self.j["CityObjects"][theid]:
-                continue
-            for geom in self.j["CityObjects"][theid]["geometry"]:
-                out.write("o " + str(theid) + "\n")
-                if export_textures and "texture" in geom and len(geom["texture"]) > 0:
-                    theme = list(geom["texture"].keys())[
-                        0
-                    ]  # Use the first theme in the dict
-                    texture_values = geom["texture"][theme]["values"]
-                    if (geom["type"] == "MultiSurface") or (
-                        geom["type"] == "CompositeSurface"
-                    ):
-                        convert.faces_to_obj(
-                            geom["boundaries"],
-                            out,
-                            sloppy,
-                            vnp,
-                            texture_values,
-                            textures,
-                        )
-                    elif (
-                        geom["type"] == "Solid"
-                    ):  # depth of geom['texture'] will be one more than for MultiSurface
-                        for shell, tex in zip(geom["boundaries"], texture_values):
-                            convert.faces_to_obj(shell, out, sloppy, vnp, tex, textures)
-                else:
-                    if (geom["type"] == "MultiSurface") or (
-                        geom["type"] == "CompositeSurface"
-                    ):
-                        convert.faces_to_obj(geom["boundaries"], out, sloppy, vnp)
-                    elif geom["type"] == "Solid":
-                        for shell in geom["boundaries"]:
-                            convert.faces_to_obj(shell, out, sloppy, vnp)
+        ids = [theid for theid, co in self.j["CityObjects"].items() if "geometry" in co]
+        if jobs > 1 or supervisor is not None:
+            args = (sloppy, vnp, textures)
+            for lines in self.map_cityobjects(_obj_chunk, ids, jobs, args, supervisor):
+                out.write(lines)
+        else:
+            for theid in ids:
+                self._write_obj_cityobject(out, theid, sloppy, vnp, textures)
+        return export_textures
+
+    def _write_obj_cityobject(self, out, theid, sloppy, vnp, textures=None):
+        """Writes the geometries of a CityObject as OBJ objects, with the textures
+        (see :py:meth:`write_obj`) if they are given."""
+        for geom in self.j["CityObjects"][theid]["geometry"]:
+            out.write("o " + str(theid) + "\n")
+            if textures is not None and "texture" in geom and len(geom["texture"]) > 0:
+                theme = list(geom["texture"].keys())[
+                    0
+                ]  # Use the first theme in the dict
+                texture_values = geom["texture"][theme]["values"]
+                if (geom["type"] == "MultiSurface") or (
+                    geom["type"] == "CompositeSurface"
+                ):
+                    convert.faces_to_obj(
+                        geom["boundaries"],
+                        out,
+                        sloppy,
+                        vnp,
+                        texture_values,
+                        textures,
+                    )
+                elif (
+                    geom["type"] == "Solid"
+                ):  # depth of geom['texture'] will be one more than for MultiSurface
+                    for shell, tex in zip(geom["boundaries"], texture_values):
+                        convert.faces_to_obj(shell, out, sloppy, vnp, tex, textures)
+            else:
+                if (geom["type"] == "MultiSurface") or (
+                    geom["type"] == "CompositeSurface"
+                ):
+                    convert.faces_to_obj(geom["boundaries"], out, sloppy, vnp)
+                elif geom["type"] == "Solid":
+                    for shell in geom["boundaries"]:
+                        convert.faces_to_obj(shell, out, sloppy, vnp)
 
-        self.compress(imp_digits)
-        if export_textures:
-            return out, out_mtl
+    def export2stl(self, sloppy, jobs=1, supervisor=None):
+        out = StringIO()
+        self.write_stl(out, sloppy, jobs, supervisor)
         return out
 
-    def export2stl(self, sloppy):
-        # TODO: refectoring, duplicated code from 2obj()
-        out = StringIO()
+    def write_stl(self, out, sloppy, jobs=1, supervisor=None):
+        """Writes the city model as STL to a file-like object, one face at a time.
+
+        With jobs > 1, the CityObjects are triangulated and written by a pool of
+        processes, the output is the same. With a supervisor.Supervisor, the
+        workers are watched (see :py:meth:`triangulate`).
+        """
         out.write("solid\n")
 
         # -- translate to minx,miny
-        vnp = np.array(self.j["vertices"])
-        minx = 9e9
-        miny = 9e9
-        for each in vnp:
-            if each[0] < minx:
-                minx = each[0]
-            if each[1] < miny:
-                miny = each[1]
-        for each in vnp:
-            each[0] -= minx
-            each[1] -= miny
+        vnp = self.vertices_array()
+        if len(vnp) > 0:
+            vnp[:, :2] -= vnp[:, :2].min(axis=0)
+        # -- the real-world coordinates, the city model is not modified
+        vertices = self.real_vertices()
+        if "transform" in self.j:
+            imp_digits = math.ceil(abs(math.log10(self.j["transform"]["scale"][0])))
+            vertices = vertices.round(imp_digits)
+        vertices = vertices.tolist()
 
         # -- start with the CO
-        for theid in self.j["CityObjects"]:
-            for geom in self.j["CityObjects"][theid]["geometry"]:
-                if (geom["type"] == "MultiSurface") or (
-                    geom["type"] == "CompositeSurface"
-                ):
-                    for face in geom["boundaries"]:
+        ids = [theid for theid, co in self.j["CityObjects"].items() if "geometry" in co]
+        if jobs > 1 or supervisor is not None:
+            args = (sloppy, vnp, vertices)
+            for lines in self.map_cityobjects(_stl_chunk, ids, jobs, args, supervisor):
+                out.write(lines)
+        else:
+            for theid in ids:
+                self._write_stl_cityobject(out, theid, sloppy, vnp, vertices)
+        out.write("endsolid")
+
+    def _write_stl_cityobject(self, out, theid, sloppy, vnp, vertices):
+        """Writes the triangles of the geometries of a CityObject as STL facets."""
+        for geom in self.j["CityObjects"][theid]["geometry"]:
+            if (geom["type"] == "MultiSurface") or (geom["type"] == "CompositeSurface"):
+                for face in geom["boundaries"]:
+                    re, b = geom_help.triangulate_face(face, vnp, sloppy)
+                    n, bb = geom_help.get_normal_newell(face)
+                    if b:
+                        for t in re:
+                            out.write(
+                                "facet normal %f %f %f\nouter loop\n"
+                                % (n[0], n[1], n[2])
+                            )
+                            out.write(
+                                "vertex %s %s %s\n"
+                                % (
+                                    str(vertices[t[0]][0]),
+                                    str(vertices[t[0]][1]),
+                                    str(vertices[t[0]][2]),
+                                )
+                            )
+                            out.write(
+                                "vertex %s %s %s\n"
+                                % (
+                                    str(vertices[t[1]][0]),
+                                    str(vertices[t[1]][1]),
+                                    str(vertices[t[1]][2]),
+                                )
+                            )
+                            out.write(
+                                "vertex %s %s %s\n"
+                                % (
+                                    str(vertices[t[2]][0]),
+                                    str(vertices[t[2]][1]),
+                                    str(vertices[t[2]][2]),
+                                )
+                            )
+                            out.write("endloop\nendfacet\n")
+            elif geom["type"] == "Solid":
+                for shell in geom["boundaries"]:
+                    for i, face in enumerate(shell):
                         re, b = geom_help.triangulate_face(face, vnp, sloppy)
                         n, bb = geom_help.get_normal_newell(face)
                         if b:
@@ -1669,75 +2293,42 @@ class CityJSON:
                                 out.write(
                                     "vertex %s %s %s\n"
                                     % (
-                                        str(self.j["vertices"][t[0]][0]),
-                                        str(self.j["vertices"][t[0]][1]),
-                                        str(self.j["vertices"][t[0]][2]),
+                                        str(vertices[t[0]][0]),
+                                        str(vertices[t[0]][1]),
+                                        str(vertices[t[0]][2]),
                                     )
                                 )
                                 out.write(
                                     "vertex %s %s %s\n"
                                     % (
-                                        str(self.j["vertices"][t[1]][0]),
-                                        str(self.j["vertices"][t[1]][1]),
-                                        str(self.j["vertices"][t[1]][2]),
+                                        str(vertices[t[1]][0]),
+                                        str(vertices[t[1]][1]),
+                                        str(vertices[t[1]][2]),
                                     )
                                 )
                                 out.write(
                                     "vertex %s %s %s\n"
                                     % (
-                                        str(self.j["vertices"][t[2]][0]),
-                                        str(self.j["vertices"][t[2]][1]),
-                                        str(self.j["vertices"][t[2]][2]),
+                                        str(vertices[t[2]][0]),
+                                        str(vertices[t[2]][1]),
+                                        str(vertices[t[2]][2]),
                                     )
                                 )
                                 out.write("endloop\nendfacet\n")
-                elif geom["type"] == "Solid":
-                    for shell in geom["boundaries"]:
-                        for i, face in enumerate(shell):
-                            re, b = geom_help.triangulate_face(face, vnp, sloppy)
-                            n, bb = geom_help.get_normal_newell(face)
-                            if b:
-                                for t in re:
-                                    out.write(
-                                        "facet normal %f %f %f\nouter loop\n"
-                                        % (n[0], n[1], n[2])
-                                    )
-                                    out.write(
-                                        "vertex %s %s %s\n"
-                                        % (
-                                            str(self.j["vertices"][t[0]][0]),
-                                            str(self.j["vertices"][t[0]][1]),
-                                            str(self.j["vertices"][t[0]][2]),
-                                        )
-                                    )
-                                    out.write(
-                                        "vertex %s %s %s\n"
-                                        % (
-                                            str(self.j["vertices"][t[1]][0]),
-                                            str(self.j["vertices"][t[1]][1]),
-                                            str(self.j["vertices"][t[1]][2]),
-                                        )
-                                    )
-                                    out.write(
-                                        "vertex %s %s %s\n"
-                                        % (
-                                            str(self.j["vertices"][t[2]][0]),
-                                            str(self.j["vertices"][t[2]][1]),
-                                            str(self.j["vertices"][t[2]][2]),
-                                        )
-                                    )
-                                    out.write("endloop\nendfacet\n")
-        out.write("endsolid")
-        return out
 
-    def reproject(self, epsg, digit=None):
+    def reproject(self, epsg, digit=None, translate=None, jobs=1):
         """
         Project from one CRS to another.
-        First the vertices are decompressed and then they are recompressed.
+        The real-world coordinates are reprojected in an array, by chunks of
+        REPROJECT_CHUNK_SIZE vertices (with jobs > 1 by a pool of processes), and
+        stored again as integers with a new "transform".
         Previously we used to recompress by using the same number of digits
         as in the original file. This does not work when switching from projected
         to geographic and vise verse. When the reprojection is such, the
         important digits are set based on the type of CRS.
+        The 'translate' of the new transform can be fixed (eg to reproject
+        several CityJSONFeatures of the same stream), otherwise the minimum
+        coordinates are used.
         """
         if not MODULE_PYPROJ_AVAILABLE:
             raise ModuleNotFoundError(
@@ -1760,23 +2351,31 @@ class CityJSON:
                 print(imp_digits)
         else:
             imp_digits = digit
-        self.decompress()
-        # Using TransformerGroup instead of Transformer, because we cannot retrieve the
-        # transformer defintion from it.
-        # See https://github.com/pyproj4/pyproj/issues/753#issuecomment-737249093
-        tg = TransformerGroup(crs_in, crs_out, always_xy=False)
-        tg.download_grids(verbose=True)
-
-        with progressbar(self.j["vertices"]) as vertices:
-            for v in vertices:
-                x, y, z = tg.transformers[0].transform(v[0], v[1], v[2])
-                v[0] = x
-                v[1] = y
-                v[2] = z
+        vnp = self.real_vertices()
+        # -- the grids are downloaded once, before the workers start
+        transformer = get_transformer(self.get_epsg(), epsg)
+        chunks = [
+            vnp[i : i + REPROJECT_CHUNK_SIZE]
+            for i in range(0, len(vnp), REPROJECT_CHUNK_SIZE)
+        ]
+        if jobs > 1:
+            results = utils.parallel_map(
+                _reproject_chunk,
+                chunks,
+                jobs,
+                initializer=_init_reproject_worker,
+                initargs=(self.get_epsg(), epsg),
+            )
+        else:
+            results = (_transform_vertices(transformer, c) for c in chunks)
+        with progressbar(length=len(vnp)) as bar:
+            for chunk, re in zip(chunks, results):
+                chunk[:] = re
+                bar.update(len(chunk))
+        self.set_vertices(vnp, imp_digits, translate)
         self.set_epsg(epsg)
         self.update_bbox()
         self.update_bbox_each_cityobjects(False)
-        self.compress(imp_digits)
 
     def remove_attribute(self, attr):
         for co in self.j["CityObjects"]:
@@ -1806,6 +2405,7 @@ class CityJSON:
                     del self.j["CityObjects"][co]["attributes"][oldattr]
 
     def filter_lod(self, thelod):
+        self._spatialindex = None
         for co in self.j["CityObjects"]:
             re = []
             if "geometry" in self.j["CityObjects"][co]:
@@ -1814,11 +2414,11 @@ class CityJSON:
                         re.append(g)
                 for each in re:
                     self.j["CityObjects"][co]["geometry"].remove(each)
-        self.remove_duplicate_vertices()
-        self.remove_orphan_vertices()
+        self.clean_vertices()
         self.update_bbox()
 
     def translate(self, minxyz: list = None):
+        self._spatialindex = None
         if minxyz is None:
             bbox = self.get_bbox()
             self.j["transform"]["translate"][0] -= bbox[0]
@@ -1858,15 +2458,54 @@ class CityJSON:
         if "extensions" in self.j and "MetadataExtended" in self.j["extensions"]:
             del self.j["extensions"]["MetadataExtended"]
 
-    def triangulate(self, sloppy):
+    def map_cityobjects(self, func, ids, jobs, args=(), supervisor=None):
+        """Runs func on chunks of TRIANGULATE_CHUNK_SIZE of the CityObjects 'ids' with
+        a pool of processes, or with the workers of a supervisor.Supervisor; the
+        results are yielded in the order of the chunks.
+
+        The workers get the city model and 'args' once, in the module globals
+        _triangulate_cm and _triangulate_args.
+        """
+        chunks = utils.chunks(ids, TRIANGULATE_CHUNK_SIZE)
+        if supervisor is not None:
+            return supervisor.map(
+                func, chunks, jobs, _init_triangulate_worker, (self, args)
+            )
+        return utils.parallel_map(
+            func,
+            chunks,
+            jobs,
+            initializer=_init_triangulate_worker,
+            initargs=(self, args),
+        )
+
+    def triangulate(self, sloppy, jobs=1, supervisor=None):
         """Triangulate the CityJSON file face by face together with the texture information.
 
+        With jobs > 1, the CityObjects are triangulated by a pool of processes, the
+        result is the same. With a supervisor.Supervisor, the worker processes are
+        watched: a face that crashes the triangulator or times out is retried with
+        mapbox-earcut or dropped, and recorded in the report of the supervisor.
+
         :param sloppy: A boolean, True=mapbox-earcut False=Shewchuk-robust
+        :param jobs: Number of processes
+        :param supervisor: None, or a supervisor.Supervisor
         """
-        vnp = np.array(self.j["vertices"])
-        for theid in self.j["CityObjects"]:
-            if "geometry" not in self.j["CityObjects"][theid]:
-                continue
+        self._spatialindex = None
+        vnp = self.vertices_array()
+        ids = [theid for theid, co in self.j["CityObjects"].items() if "geometry" in co]
+        if jobs > 1 or supervisor is not None:
+            args = (vnp, sloppy)
+            for re in self.map_cityobjects(
+                _triangulate_chunk, ids, jobs, args, supervisor
+            ):
+                for theid, geoms in re:
+                    self.j["CityObjects"][theid]["geometry"] = geoms
+            return
+        self._triangulate_cityobjects(ids, vnp, sloppy)
+
+    def _triangulate_cityobjects(self, ids, vnp, sloppy):
+        for theid in ids:
             for geom in self.j["CityObjects"][theid]["geometry"]:
                 sflag = False
                 mflag = False
@@ -1,4 +1,5 @@
 import copy
+import functools
 import glob
 import json
 import os.path
@@ -13,16 +14,16 @@ import cjio
 from cjio import (
     cityjson,
     errors,
+    featureindex,
+    jsonio,
+    mergefiles,
+    supervisor,
     utils,
     MODULE_TRIANGLE_AVAILABLE,
     MODULE_PYPROJ_AVAILABLE,
     MODULE_EARCUT_AVAILABLE,
     MODULE_CJVAL_AVAILABLE,
 )
-from cjio.floatEncoder import FloatEncoder
-
-json.encoder.c_make_encoder = None
-json.encoder.float = FloatEncoder
 
 
 # -- https://stackoverflow.com/questions/47437472/in-python-click-how-do-i-see-help-for-subcommands-whose-parents-have-required
@@ -42,6 +43,19 @@ class PerCommandArgWantSubCmdHelp(click.Argument):
         )
 
 
+def streamable(f):
+    """Mark an operator that works one CityJSONFeature at a time (see --stream)."""
+
+    @functools.wraps(f)
+    def new_func(*args, **kwargs):
+        processor = f(*args, **kwargs)
+        processor.streamable = True
+        return processor
+
+    new_func.streamable = True
+    return new_func
+
+
 @click.group(chain=True)
 @click.version_option(
     version=cjio.__version__,
@@ -55,8 +69,20 @@ class PerCommandArgWantSubCmdHelp(click.Argument):
     help="Load a CityJSON file even if some City Objects have the same IDs (technically invalid file).",
 )
 @click.option("--suppress_msg", is_flag=True, help="Suppress all information/messages.")
+@click.option(
+    "--stream",
+    is_flag=True,
+    help="Process the input one CityJSONFeature at a time, without loading it all"
+    " in memory (only for operators working per feature).",
+)
+@click.option(
+    "--index",
+    is_flag=True,
+    help="With a CityJSONSeq file as input, use an index of its features (built and"
+    " saved next to it if needed), so that 'subset' reads only the features selected.",
+)
 @click.pass_context
-def cli(context, input, ignore_duplicate_keys, suppress_msg):
+def cli(context, input, ignore_duplicate_keys, suppress_msg, stream, index):
     """Process and manipulate a CityJSON model, and allow
     different outputs. The different operators can be chained
     to perform several processing in one step, the CityJSON model
@@ -76,24 +102,43 @@ def cli(context, input, ignore_duplicate_keys, suppress_msg):
         cjio myfile.city.json subset --id house12 save out.city.json
         cjio myfile.city.json crs_assign 7145 textures_remove export --format obj output.obj
         cat mystream.city.jsonl | cjio stdin info
+        cat my.city.jsonl | cjio --stream stdin lod_filter 2.2 export jsonl out.jsonl
+        cjio --stream myfile.city.json export jsonl out.city.jsonl
+        cjio --index mystream.city.jsonl subset --bbox 0 0 1000 1000 save out.city.json
     """
     context.ensure_object(dict)
-    context.obj = {"argument": input, "suppress_msg": suppress_msg}
+    context.obj = {
+        "argument": input,
+        "suppress_msg": suppress_msg,
+        "stream": stream,
+        "supervisor_report": [],
+    }
 
 
 @cli.result_callback()
-def process_pipeline(processors, input, ignore_duplicate_keys, suppress_msg):
+def process_pipeline(
+    processors, input, ignore_duplicate_keys, suppress_msg, stream, index
+):
+    if stream:
+        process_stream(processors, input, ignore_duplicate_keys, suppress_msg)
+        return
     extensions = [".json", ".jsonl", ".off", ".poly"]  # -- input allowed
     try:
         if input == "stdin":
-            cm = cityjson.read_stdin()
+            cm = cityjson.read_stdin(ignore_duplicate_keys)
         else:
-            f = click.open_file(input, mode="r", encoding="utf-8-sig")
-            extension = os.path.splitext(input)[1].lower()
+            base = utils.split_compression(input)[0]
+            extension = os.path.splitext(base)[1].lower()
             if extension not in extensions:
                 raise IOError(
-                    "File type not supported (only .json, .jsonl, .off, and .poly)."
+                    "File type not supported (only .json, .jsonl, .off, and .poly,"
+                    " possibly compressed with .gz, .bz2, or .xz)."
                 )
+            # -- CityJSON is parsed from the bytes (memory-mapped if uncompressed)
+            if extension in [".off", ".poly"]:
+                f = utils.open_file(input, mode="r", encoding="utf-8-sig")
+            else:
+                f = utils.open_file(input, mode="rb")
             # -- OFF file
             if extension == ".off":
                 print_cmd_status("Converting %s to CityJSON" % (input))
@@ -102,11 +147,25 @@ def process_pipeline(processors, input, ignore_duplicate_keys, suppress_msg):
             elif extension == ".poly":
                 print_cmd_status("Converting %s to CityJSON" % (input))
                 cm = cityjson.poly2cj(f)
+            # -- CityJSONSeq file
+            elif extension == ".jsonl":
+                print_cmd_status(f"Parsing {input}")
+                features = None
+                if index:
+                    print_cmd_status("Index of the features")
+                    features = featureindex.FeatureIndex.open(input, f)
+                    f.seek(0)
+                cm = cityjson.read_jsonl(
+                    f, ignore_duplicate_keys, read_filter(processors), features
+                )
             # -- CityJSON file
             else:
                 print_cmd_status("Parsing %s" % (input))
                 cm = cityjson.reader(
-                    file=f, ignore_duplicate_keys=ignore_duplicate_keys
+                    file=f,
+                    ignore_duplicate_keys=ignore_duplicate_keys,
+                    read_filter=read_filter(processors),
+                    path=input,
                 )
                 try:
                     with warnings.catch_warnings(record=True) as w:
@@ -122,12 +181,76 @@ def process_pipeline(processors, input, ignore_duplicate_keys, suppress_msg):
         cm = processor(cm)
 
 
+def read_filter(processors):
+    """What the first operators discard, so that it is not kept when reading."""
+    rf = cityjson.ReadFilter()
+    for processor in processors:
+        if not hasattr(processor, "pushdown"):
+            break
+        processor.pushdown(rf)
+    return rf
+
+
+def process_stream(processors, input, ignore_duplicate_keys=False, suppress_msg=False):
+    """Push each CityJSONFeature of the input through the chain of operators."""
+    for processor in processors:
+        if not getattr(processor, "streamable", False):
+            allowed = sorted(
+                name
+                for name, command in cli.commands.items()
+                if getattr(command.callback, "streamable", False)
+            )
+            raise click.ClickException(
+                "With --stream, only operators working per feature can be used:"
+                f" {', '.join(allowed)}."
+            )
+    extension = os.path.splitext(utils.split_compression(input)[0])[1].lower()
+    if input != "stdin" and extension not in [".json", ".jsonl"]:
+        raise click.ClickException(
+            "--stream is only possible with 'stdin', a CityJSON or a CityJSONSeq"
+            " file as input."
+        )
+    ctx = click.get_current_context()
+    try:
+        if input == "stdin":
+            features = cityjson.read_stdin_features()
+        else:
+            print_cmd_status(f"Parsing {input}")
+            f = utils.open_file(input, mode="rb")
+            ctx.call_on_close(f.close)
+            if extension == ".jsonl":
+                features = cityjson.read_jsonl_features(f)
+            else:
+                features = cityjson.read_file_features(f, ignore_duplicate_keys)
+        for i, cm in enumerate(features):
+            for processor in processors:
+                cm = processor(cm)
+                # -- a feature emptied (eg by subset) is dropped
+                if cm.is_empty():
+                    break
+            # -- report each operator once, not for every feature
+            if i == 0:
+                ctx.obj["suppress_msg"] = True
+        # -- but the faces of all the features a supervised triangulation failed
+        ctx.obj["suppress_msg"] = suppress_msg
+        print_triangulation_report(ctx.obj["supervisor_report"])
+    except ValueError as e:
+        raise click.ClickException(f'{e}: "{input}".')
+    except OSError as e:
+        raise click.ClickException(f'Invalid file: "{input}".\n{e}')
+
+
+@click.pass_context
+def is_stream_mode(ctx):
+    return ctx.obj["stream"]
+
+
 @cli.command("print")
 def print_cmd():
     """Print the (pretty formatted) JSON to the console."""
 
     def processor(cm):
-        json_str = json.dumps(cm.j, indent="  ")
+        json_str = jsonio.dumps(cm.j, indent="  ")
         print_cmd_info(json_str)
         return cm
 
@@ -159,12 +282,54 @@ def info_cmd(long):
     is_flag=True,
     help="Use a more lenient triangulator (mapbox-earcut), which is also less robust.",
 )
-def export_cmd(filename, format, sloppy):
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes used to create the CityJSONFeatures (jsonl) or to"
+    " triangulate the faces (obj, stl, glb, b3dm).",
+)
+@click.option(
+    "--compress_level",
+    type=click.IntRange(1, 9),
+    default=None,
+    help="Level of the compression if the file ends with .gz, .bz2 or .xz.",
+)
+@click.option(
+    "--compress_thread",
+    is_flag=True,
+    help="Compress the file in a background thread.",
+)
+@click.option(
+    "--supervised",
+    is_flag=True,
+    help="Triangulate in watched processes: a face that crashes the triangulator or"
+    " times out is retried with mapbox-earcut (or dropped), and reported.",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="With --supervised, the seconds after which the triangulation of a face is"
+    " stopped.",
+)
+@streamable
+def export_cmd(
+    filename,
+    format,
+    sloppy,
+    jobs,
+    compress_level,
+    compress_thread,
+    supervised,
+    timeout,
+):
     """Export to another format.
 
     CityJSONSeq (JSONL/JSON Lines for streaming), OBJ, Binary glTF (glb), Batched 3DModel (b3dm), STL.
     The result can be stored either in a file, out piped to stdout (by choosing 'stdout' instead
-    of a file).
+    of a file). The CityJSONSeq, OBJ and STL files are compressed if their name ends
+    with .gz, .bz2 or .xz.
 
     Currently, textures are only supported for CityJSONSeq and OBJ export.
 
@@ -174,7 +339,38 @@ def export_cmd(filename, format, sloppy):
         cjio myfile.city.json export obj myfile.obj
         cjio myfile.city.json export --sloppy obj myfile.obj
         cjio --suppress_msg myfile.city.json export jsonl stdout
+        cjio myfile.city.json export --jobs 8 jsonl myfile.city.jsonl
+        cjio myfile.city.json export --jobs 8 obj myfile.obj
+        cjio myfile.city.json export --compress_thread jsonl myfile.city.jsonl.gz
     """
+    # -- with --stream: the output, opened with the first CityJSONFeature
+    fo = None
+    sup = new_supervisor(supervised, timeout)
+
+    def stream_exporter(cm):
+        nonlocal fo
+        if fo is None:
+            if filename == "stdout":
+                fo = sys.stdout
+            else:
+                output = utils.verify_filename(filename)
+                if output["dir"]:
+                    raise click.ClickException(
+                        "With --stream, a file name must be given for the output."
+                    )
+                os.makedirs(os.path.dirname(output["path"]), exist_ok=True)
+                print_cmd_status(f"Exporting CityJSON to JSON Lines ({output['path']})")
+                fo = utils.open_file(
+                    output["path"], "w", compress_level, compress_thread
+                )
+                click.get_current_context().call_on_close(fo.close)
+            # -- the extent of the whole stream is not known yet
+            header = json.loads(cm.cityjson_for_features())
+            if "metadata" in header:
+                header["metadata"].pop("geographicalExtent", None)
+            fo.write(jsonio.dumps(header) + "\n")
+        for feature in cm.generate_features():
+            fo.write(jsonio.dumps(feature.j) + "\n")
 
     def exporter(cm, sloppy):
         stdoutoutput = False
@@ -193,26 +389,22 @@ def export_cmd(filename, format, sloppy):
         # ---------- OBJ ----------
         if format.lower() == "obj":
             if stdoutoutput:
-                buf = cm.export2obj(sloppy)
-                buf.seek(0)
-                for line in buf.readlines():
-                    sys.stdout.write(line)
+                cm.write_obj(sys.stdout, sloppy, jobs=jobs, supervisor=sup)
             else:
                 print_cmd_status("Exporting CityJSON to OBJ (%s)" % (output["path"]))
                 try:
-                    mtl_path = Path(output["path"]).with_suffix(".mtl")
-                    re = cm.export2obj(sloppy, mtl_path.name)
-                    if isinstance(re, tuple):  # MTL file returned
-                        obj, mtl = re[0], re[1]
-                    else:
-                        obj, mtl = re, None
-                    # Write .obj
-                    with click.open_file(output["path"], mode="w") as fo:
-                        fo.write(obj.getvalue())
-                    if mtl is not None:
-                        # Write optional .mtl
-                        with click.open_file(str(mtl_path), mode="w") as fmtl:
-                            fmtl.write(mtl.getvalue())
+                    with utils.open_file(
+                        output["path"], "w", compress_level, compress_thread
+                    ) as fo:
+                        if cm.has_textures():
+                            # Write the optional .mtl along (never compressed,
+                            # the viewers look for it by name)
+                            base = utils.split_compression(output["path"])[0]
+                            mtl_path = Path(base).with_suffix(".mtl")
+                            with click.open_file(str(mtl_path), mode="w") as fmtl:
+                                cm.write_obj(fo, sloppy, mtl_path.name, fmtl, jobs, sup)
+                        else:
+                            cm.write_obj(fo, sloppy, jobs=jobs, supervisor=sup)
                 except IOError as e:
                     raise click.ClickException(
                         'Invalid output file: "%s".\n%s' % (output["path"], e)
@@ -220,16 +412,14 @@ def export_cmd(filename, format, sloppy):
         # ---------- STL ----------
         elif format.lower() == "stl":
             if stdoutoutput:
-                buf = cm.export2stl(sloppy)
-                buf.seek(0)
-                for line in buf.readlines():
-                    sys.stdout.write(line)
+                cm.write_stl(sys.stdout, sloppy, jobs, sup)
             else:
                 print_cmd_status("Exporting CityJSON to STL (%s)" % (output["path"]))
                 try:
-                    with click.open_file(output["path"], mode="w") as fo:
-                        re = cm.export2stl(sloppy)
-                        fo.write(re.getvalue())
+                    with utils.open_file(
+                        output["path"], "w", compress_level, compress_thread
+                    ) as fo:
+                        cm.write_stl(fo, sloppy, jobs, sup)
                 except IOError as e:
                     raise click.ClickException(
                         'Invalid output file: "%s".\n%s' % (output["path"], e)
@@ -241,7 +431,7 @@ def export_cmd(filename, format, sloppy):
             bufferbin = "{}.glb".format(fname)
             binfile = os.path.join(os.path.dirname(output["path"]), bufferbin)
             print_cmd_status("Exporting CityJSON to glb %s" % binfile)
-            glb = cm.export2glb()
+            glb = cm.export2glb(jobs=jobs, supervisor=sup)
             # TODO B: how many buffer can there be in the 'buffers'?
             try:
                 glb.seek(0)
@@ -257,7 +447,7 @@ def export_cmd(filename, format, sloppy):
             fname = os.path.splitext(os.path.basename(output["path"]))[0]
             b3dmbin = "{}.b3dm".format(fname)
             binfile = os.path.join(os.path.dirname(output["path"]), b3dmbin)
-            b3dm = cm.export2b3dm()
+            b3dm = cm.export2b3dm(jobs, sup)
             print_cmd_status("Exporting CityJSON to b3dm %s" % binfile)
             print_cmd_warning(
                 "Although the conversion works, the output is probably incorrect."
@@ -274,27 +464,32 @@ def export_cmd(filename, format, sloppy):
         elif format.lower() == "jsonl":
             if stdoutoutput:
                 with warnings.catch_warnings(record=True) as w:
-                    buf = cm.export2jsonl()
+                    cm.write_jsonl(sys.stdout, jobs)
                     print_cmd_warning(w)
-                buf.seek(0)
-                for line in buf.readlines():
-                    sys.stdout.write(line)
             else:
                 print_cmd_status(
                     "Exporting CityJSON to JSON Lines (%s)" % (output["path"])
                 )
                 try:
-                    with click.open_file(output["path"], mode="w") as fo:
-                        with warnings.catch_warnings(record=True) as w:
-                            re = cm.export2jsonl()
-                            print_cmd_warning(w)
-                        fo.write(re.getvalue())
+                    fo = utils.open_file(
+                        output["path"], "w", compress_level, compress_thread
+                    )
+                    with fo, warnings.catch_warnings(record=True) as w:
+                        cm.write_jsonl(fo, jobs)
+                        print_cmd_warning(w)
                 except IOError as e:
                     raise click.ClickException(
                         'Invalid output file: "%s".\n%s' % (output["path"], e)
                     )
 
     def processor(cm):
+        if is_stream_mode():
+            if format != "jsonl":
+                raise click.ClickException(
+                    "With --stream, only the export to 'jsonl' is possible."
+                )
+            stream_exporter(cm)
+            return cm
         if (format != "jsonl") and (not MODULE_TRIANGLE_AVAILABLE):
             str = "OBJ|glTF|b3dm export skipped: Python module 'triangle' missing (to triangulate faces)"
             print_cmd_alert(str)
@@ -303,6 +498,7 @@ def export_cmd(filename, format, sloppy):
             raise click.ClickException("Abort.")
         else:
             exporter(cm, sloppy)
+            print_supervisor_report(sup)
         return cm
 
     return processor
@@ -321,16 +517,29 @@ def export_cmd(filename, format, sloppy):
     type=str,
     help="Path to the new textures directory. This command copies the textures to a new location. Useful when creating an independent subset of a CityJSON file.",
 )
-def save_cmd(filename, indent, textures):
+@click.option(
+    "--compress_level",
+    type=click.IntRange(1, 9),
+    default=None,
+    help="Level of the compression if the file ends with .gz, .bz2 or .xz.",
+)
+@click.option(
+    "--compress_thread",
+    is_flag=True,
+    help="Compress the file in a background thread.",
+)
+def save_cmd(filename, indent, textures, compress_level, compress_thread):
     """Save to a CityJSON file.
 
     Save to a file on disk, or 'stdout' pipes the file to the standart output.
+    The file is compressed if its name ends with .gz, .bz2 or .xz.
 
     Usage examples:
 
     \b
         cjio myfile.city.json metadata_update save myfile.city.json
         cjio myfile.json upgrade save stdout
+        cjio myfile.json save --compress_level 6 myfile.city.json.xz
     """
 
     def saver(cm):
@@ -348,23 +557,16 @@ def save_cmd(filename, indent, textures):
             else:
                 os.makedirs(os.path.dirname(output["path"]), exist_ok=True)
         if stdoutoutput:
-            if indent:
-                json_str = json.dumps(cm.j, indent="\t")
-                sys.stdout.write(json_str)
-            else:
-                json_str = json.dumps(cm.j, separators=(",", ":"))
-                sys.stdout.write(json_str)
+            cm.write_json(sys.stdout, "\t" if indent else None)
         else:
             print_cmd_status("Saving CityJSON to a file %s" % output["path"])
             try:
-                fo = click.open_file(output["path"], mode="w")
-                if textures:
-                    cm.copy_textures(textures)
-                if indent:
-                    json_str = json.dumps(cm.j, indent="\t")
-                else:
-                    json_str = json.dumps(cm.j, separators=(",", ":"))
-                fo.write(json_str)
+                with utils.open_file(
+                    output["path"], "w", compress_level, compress_thread
+                ) as fo:
+                    if textures:
+                        cm.copy_textures(textures)
+                    cm.write_json(fo, "\t" if indent else None)
             except IOError as e:
                 raise click.ClickException(
                     "Invalid output file: %s \n%s" % (output["path"], e)
@@ -415,7 +617,20 @@ def validate_cmd():
 
 @cli.command("merge")
 @click.argument("filepattern")
-def merge_cmd(filepattern):
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes used to read the files.",
+)
+@click.option(
+    "--output",
+    default=None,
+    help="Write the merged CityJSON straight to this file, reading the files one City"
+    " Object at a time so that memory stays bounded (the next operators get the"
+    " current city model, not merged).",
+)
+def merge_cmd(filepattern, jobs, output):
     """
     Merge the current CityJSON with other ones.
     All City Objects with their textures/materials/templates are handled.
@@ -423,18 +638,34 @@ def merge_cmd(filepattern):
     Possible to give a wildcard but put it between quotes:
 
         $ cjio myfile.city.json merge '/home/elvis/temp/*.json' save merged.city.json
+        $ cjio myfile.city.json merge --jobs 4 '/home/elvis/temp/*.json' save m.json
+        $ cjio myfile.city.json merge --output m.city.json '/home/elvis/temp/*.json'
+
+    The vertices are merged as integers, rescaled to the finest scale of the files.
     """
 
+    def merge_to_file(cm, g):
+        path = utils.verify_filename(output)
+        if path["dir"]:
+            raise click.ClickException("A file name must be given for the output.")
+        os.makedirs(os.path.dirname(path["path"]), exist_ok=True)
+        print_cmd_status(f"Merging files to {path['path']}")
+        try:
+            with utils.open_file(path["path"], mode="w") as fo:
+                mergefiles.merge_files(cm, g, fo)
+        except OSError as err:
+            raise click.ClickException(f'{err}: "{filepattern}".')
+
     def processor(cm):
-        print_cmd_status("Merging files")
-        lsCMs = []
         g = glob.glob(filepattern)
-        for i in g:
-            try:
-                f = click.open_file(i, mode="r", encoding="utf-8-sig")
-                lsCMs.append(cityjson.reader(f))
-            except IOError as err:
-                raise click.ClickException('%s: "%s".' % (err, input))
+        if output is not None:
+            merge_to_file(cm, g)
+            return cm
+        print_cmd_status("Merging files")
+        try:
+            lsCMs = cityjson.read_files(g, jobs)
+        except OSError as err:
+            raise click.ClickException(f'{err}: "{filepattern}".')
         if len(lsCMs) == 0:
             print_cmd_info("WARNING: No files to merge.")
         else:
@@ -452,6 +683,11 @@ def merge_cmd(filepattern):
 )
 @click.option("--bbox", nargs=4, type=float, help="2D bbox: minx miny maxx maxy.")
 @click.option("--radius", nargs=3, type=float, help="x y radius")
+@click.option(
+    "--nearest",
+    type=(float, float, int),
+    help="x y k: the k City Objects nearest to x y.",
+)
 @click.option("--random", type=int, help="Number of random City Objects to select.")
 @click.option(
     "--cotype", multiple=True, help="The City Object types; can be used multiple times."
@@ -461,13 +697,15 @@ def merge_cmd(filepattern):
     is_flag=True,
     help="Excludes the selection, thus delete the selected object(s).",
 )
-def subset_cmd(id, bbox, random, cotype, radius, exclude):
+@streamable
+def subset_cmd(id, bbox, random, cotype, radius, nearest, exclude):
     """
     Create a subset, City Objects can be selected by:
     (1) IDs of City Objects;
     (2) bbox;
     (3) City Object type(s);
-    (4) randomly.
+    (4) randomly;
+    (5) the nearest ones to a point.
 
     These can be combined, except random which overwrites others.
 
@@ -478,6 +716,7 @@ def subset_cmd(id, bbox, random, cotype, radius, exclude):
     \b
         cjio myfile.city.json subset --bbox 104607 490148 104703 490257 save out.city.json
         cjio myfile.city.json subset --radius 500.0 610.0 50.0 --exclude save out.city.json
+        cjio myfile.city.json subset --nearest 500.0 610.0 3 save out.city.json
         cjio myfile.city.json subset --id house12 save out.city.json
         cjio myfile.city.json subset --random 5 save out.city.json
         cjio myfile.city.json subset --cotype LandUse --cotype Building save out.city.json
@@ -485,12 +724,21 @@ def subset_cmd(id, bbox, random, cotype, radius, exclude):
 
     def processor(cm):
         print_cmd_status("Subset of CityJSON")
+        if (random is not None or nearest is not None) and is_stream_mode():
+            raise click.ClickException(
+                "With --stream, a random or nearest subset is not possible (it needs"
+                " all the City Objects)."
+            )
         s = copy.deepcopy(cm)
         if random is not None:
             s = s.get_subset_random(random, exclude=exclude)
             return s
         elif radius is not None and len(radius) > 0:
             s = s.get_subset_radius(radius[0], radius[1], radius[2], exclude=exclude)
+        elif nearest is not None and len(nearest) > 0:
+            s = s.get_subset_nearest(
+                nearest[0], nearest[1], nearest[2], exclude=exclude
+            )
         elif id is not None and len(id) > 0:
             s = s.get_subset_ids(id, exclude=exclude)
         elif bbox is not None and len(bbox) > 0:
@@ -503,10 +751,23 @@ def subset_cmd(id, bbox, random, cotype, radius, exclude):
             )
         return s
 
+    # -- the selection by IDs or types is done already when reading, and also
+    # -- by bbox or randomly for a CityJSONSeq (see cityjson.read_jsonl())
+    if exclude or radius or nearest:
+        pass
+    elif random is not None:
+        processor.pushdown = lambda rf: rf.select(random=random)
+    elif id:
+        processor.pushdown = lambda rf: rf.select(ids=id)
+    elif bbox:
+        processor.pushdown = lambda rf: rf.select(bbox=bbox)
+    elif cotype:
+        processor.pushdown = lambda rf: rf.select(cotypes=cotype)
     return processor
 
 
 @cli.command("vertices_clean")
+@streamable
 def vertices_clean_cmd():
     """
     Remove duplicate vertices + orphan vertices
@@ -514,14 +775,15 @@ def vertices_clean_cmd():
 
     def processor(cm):
         print_cmd_status("Clean the file")
-        cm.remove_duplicate_vertices()
-        cm.remove_orphan_vertices()
+        duplicates, orphans = cm.clean_vertices()
+        print_cmd_info(f"Removed {duplicates} duplicate and {orphans} orphan vertices")
         return cm
 
     return processor
 
 
 @cli.command("materials_remove")
+@streamable
 def materials_remove_cmd():
     """
     Remove all materials.
@@ -532,10 +794,12 @@ def materials_remove_cmd():
         cm.remove_materials()
         return cm
 
+    processor.pushdown = cityjson.ReadFilter.remove_materials
     return processor
 
 
 @cli.command("textures_remove")
+@streamable
 def textures_remove_cmd():
     """
     Remove all textures.
@@ -546,11 +810,13 @@ def textures_remove_cmd():
         cm.remove_textures()
         return cm
 
+    processor.pushdown = cityjson.ReadFilter.remove_textures
     return processor
 
 
 @cli.command("crs_assign")
 @click.argument("newepsg", type=int)
+@streamable
 def crs_assign_cmd(newepsg):
     """
     Assign a (new) CRS (an EPSG).
@@ -570,7 +836,14 @@ def crs_assign_cmd(newepsg):
 @cli.command("crs_reproject")
 @click.argument("epsg", type=int)
 @click.option("--digit", type=click.IntRange(1, 12), help="Number of digits to keep.")
-def crs_reproject_cmd(epsg, digit):
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes used to reproject the vertices.",
+)
+@streamable
+def crs_reproject_cmd(epsg, digit, jobs):
     """
     Reproject to a new EPSG.
     The current CityJSON must have an EPSG defined
@@ -578,9 +851,13 @@ def crs_reproject_cmd(epsg, digit):
     It is possible to define the number of digits that will be kept for the result with --digit.
 
         $ cjio myfile.city.json crs_reproject --digit 7 4979 save newfile.city.json
+        $ cjio myfile.city.json crs_reproject --jobs 4 4979 save newfile.city.json
     """
+    # -- with --stream: all the CityJSONFeatures must share the same transform
+    translate = None
 
     def processor(cm):
+        nonlocal translate
         if not MODULE_PYPROJ_AVAILABLE:
             str = "Reprojection skipped: Python module 'pyproj' missing (to reproject coordinates)"
             print_cmd_alert(str)
@@ -594,8 +871,10 @@ def crs_reproject_cmd(epsg, digit):
             )
         else:
             with warnings.catch_warnings(record=True) as w:
-                cm.reproject(epsg, digit)
+                cm.reproject(epsg, digit, translate, jobs)
                 print_cmd_warning(w)
+            if is_stream_mode():
+                translate = cm.j["transform"]["translate"]
         return cm
 
     return processor
@@ -679,6 +958,7 @@ def textures_update_cmd(newlocation, relative):
 
 @cli.command("lod_filter")
 @click.argument("lod", type=str)
+@streamable
 def lod_filter_cmd(lod):
     """
     Filter only one LoD for a dataset.
@@ -696,11 +976,13 @@ def lod_filter_cmd(lod):
         cm.filter_lod(lod)
         return cm
 
+    processor.pushdown = lambda rf: rf.filter_lod(lod)
     return processor
 
 
 @cli.command("attribute_remove")
 @click.argument("attr", type=str, nargs=1)
+@streamable
 def attribute_remove_cmd(attr):
     """
     Remove an attribute.
@@ -715,12 +997,14 @@ def attribute_remove_cmd(attr):
         cm.remove_attribute(attr)
         return cm
 
+    processor.pushdown = lambda rf: rf.remove_attribute(attr)
     return processor
 
 
 @cli.command("attribute_rename")
 @click.argument("oldattr", type=str, nargs=1)
 @click.argument("newattr", type=str, nargs=1)
+@streamable
 def attribute_rename_cmd(oldattr, newattr):
     """
     Rename an attribute.
@@ -781,13 +1065,14 @@ def metadata_get_cmd():
         j = {}
         if cm.has_metadata():
             j.update(cm.get_metadata())
-        print_cmd_info(json.dumps(j, indent=2))
+        print_cmd_info(jsonio.dumps(j, indent=2))
         return cm
 
     return processor
 
 
 @cli.command("metadata_extended_remove")
+@streamable
 def metadata_remove_cmd():
     """
     Remove the deprecated +metadata-extended properties.
@@ -808,7 +1093,27 @@ def metadata_remove_cmd():
     is_flag=True,
     help="Use a more lenient triangulator (mapbox-earcut), which is also less robust.",
 )
-def triangulate_cmd(sloppy):
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes used to triangulate the CityObjects.",
+)
+@click.option(
+    "--supervised",
+    is_flag=True,
+    help="Triangulate in watched processes: a face that crashes the triangulator or"
+    " times out is retried with mapbox-earcut (or dropped), and reported.",
+)
+@click.option(
+    "--timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    help="With --supervised, the seconds after which the triangulation of a face is"
+    " stopped.",
+)
+@streamable
+def triangulate_cmd(sloppy, jobs, supervised, timeout):
     """
     Triangulate every surface.
 
@@ -823,6 +1128,8 @@ def triangulate_cmd(sloppy):
     \b
         cjio myfile.city.json triangulate save mytriangles.city.json
         cjio myfile.city.json triangulate --sloppy save mytriangles.city.json
+        cjio myfile.city.json triangulate --jobs 4 save mytriangles.city.json
+        cjio myfile.city.json triangulate --supervised --timeout 60 save out.city.json
     """
 
     # -- mapbox_earcut available?
@@ -843,7 +1150,9 @@ def triangulate_cmd(sloppy):
                 print_cmd_warning(str)
                 raise click.ClickException("Abort.")
             else:
-                cm.triangulate(sloppy)
+                sup = new_supervisor(supervised, timeout)
+                cm.triangulate(sloppy, jobs, sup)
+                print_supervisor_report(sup)
         else:
             print_cmd_status("This file is already triangulated!")
         return cm
@@ -868,6 +1177,37 @@ def _print_cmd(s, **styles):
         )
 
 
+def new_supervisor(supervised, timeout):
+    """The supervisor.Supervisor of the triangulation with --supervised, or None."""
+    if not supervised:
+        return None
+    return supervisor.Supervisor(timeout)
+
+
+@click.pass_context
+def print_supervisor_report(ctx, sup):
+    """Prints the faces a supervised triangulation could not do normally, and
+    empties the report. With --stream, the reports of all the CityJSONFeatures
+    are collected instead, and printed once at the end by process_stream()."""
+    if sup is None:
+        return
+    if ctx.obj["stream"]:
+        ctx.obj["supervisor_report"].extend(sup.report)
+    else:
+        print_triangulation_report(sup.report)
+    sup.report.clear()
+
+
+def print_triangulation_report(report):
+    reasons = {"crash": "crashed", "timeout": "timed out"}
+    results = {"earcut": "triangulated with mapbox-earcut", "failed": "dropped"}
+    for each in report:
+        print_cmd_warning(
+            f"Triangulating a face of CityObject '{each['id']}'"
+            f" {reasons[each['reason']]}, it was {results[each['result']]}"
+        )
+
+
 @click.pass_context
 def print_cmd_info(ctx, s):
     if not ctx.obj["suppress_msg"]:
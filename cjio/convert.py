@@ -144,7 +144,7 @@ def to_glb(cm, do_triangulate=True):
     matid = 0
     material_ids = []
 
-    vertexlist = np.array(cm.j["vertices"])
+    vertexlist = cm.real_vertices()
 
     # gltf uses a right-handed coordinate system.
     # glTF defines +Y as up, +Z as forward, and -X as right, thus the front of a glTF
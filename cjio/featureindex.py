@@ -0,0 +1,148 @@
+"""Index of the CityJSONFeatures of a CityJSONSeq file"""
+
+import contextlib
+import math
+import os
+import random
+
+import numpy as np
+
+from cjio import jsonio
+
+
+def feature_bbox(feature, transform=None):
+    """2D bbox [minx, miny, maxx, maxy] of the vertices of a CityJSONFeature,
+    with the transform of the first line applied; None if it has no vertices."""
+    if len(feature.get("vertices", [])) == 0:
+        return None
+    v = np.asarray(feature["vertices"], dtype=np.float64)[:, :2]
+    if transform is not None:
+        v = v * transform["scale"][:2] + transform["translate"][:2]
+    return v.min(axis=0).tolist() + v.max(axis=0).tolist()
+
+
+def bbox_overlaps(a, b):
+    """Whether two 2D bboxes [minx, miny, maxx, maxy] overlap (touching counts)."""
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class FeatureIndex:
+    """Byte offset and length, IDs of the CityObjects and 2D bbox of each
+    CityJSONFeature of a CityJSONSeq file, to read only some of them.
+
+    It is stored next to the file (see :py:meth:`sidecar`), with the size and
+    modification time of the file, and rebuilt when these have changed.
+    """
+
+    def __init__(self, offsets, lengths, ids, bboxes, stamp=None):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        # -- for each feature, the IDs of its CityObjects
+        self.ids = [list(each) for each in ids]
+        # -- NaN for the features without vertices, they never overlap
+        self.bboxes = np.array(
+            [[math.nan] * 4 if b is None else b for b in bboxes], dtype=np.float64
+        ).reshape(-1, 4)
+        self.stamp = stamp
+        self._positions = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @staticmethod
+    def sidecar(path):
+        return path + ".idx"
+
+    @staticmethod
+    def file_stamp(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    @classmethod
+    def build(cls, file, stamp=None):
+        """Index a CityJSONSeq file opened in binary mode, from its start."""
+        file.seek(0)
+        line = file.readline()
+        header = jsonio.loads(line, check_duplicates=False)
+        transform = header.get("transform")
+        offset = len(line)
+        offsets, lengths, ids, bboxes = [], [], [], []
+        for line in file:
+            if line.strip():
+                feature = jsonio.loads(line, check_duplicates=False)
+                offsets.append(offset)
+                lengths.append(len(line))
+                ids.append(list(feature.get("CityObjects", {})))
+                bboxes.append(feature_bbox(feature, transform))
+            offset += len(line)
+        return cls(offsets, lengths, ids, bboxes, stamp)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            j = jsonio.load(f, check_duplicates=False)
+        return cls(j["offsets"], j["lengths"], j["ids"], j["bboxes"], j["stamp"])
+
+    def save(self, path):
+        bboxes = [None if math.isnan(b[0]) else b for b in self.bboxes.tolist()]
+        j = {
+            "stamp": self.stamp,
+            "offsets": self.offsets.tolist(),
+            "lengths": self.lengths.tolist(),
+            "ids": self.ids,
+            "bboxes": bboxes,
+        }
+        with open(path, "w") as f:
+            f.write(jsonio.dumps(j))
+
+    @classmethod
+    def open(cls, path, file):
+        """The index of the CityJSONSeq file at 'path' (opened as 'file'): read
+        from its sidecar file, or built and saved if there is none or it is out of
+        date."""
+        stamp = cls.file_stamp(path)
+        sidecar = cls.sidecar(path)
+        try:
+            index = cls.load(sidecar)
+            if index.stamp == stamp:
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+        index = cls.build(file, stamp)
+        # -- eg a read-only directory, the index is only not kept
+        with contextlib.suppress(OSError):
+            index.save(sidecar)
+        return index
+
+    def lookup_ids(self, ids):
+        """Positions of the features with one of the CityObjects."""
+        if self._positions is None:
+            self._positions = {}
+            for i, each in enumerate(self.ids):
+                for coid in each:
+                    self._positions.setdefault(coid, []).append(i)
+        re = set()
+        for coid in ids:
+            re.update(self._positions.get(coid, []))
+        return sorted(re)
+
+    def query_bbox(self, bbox):
+        """Positions of the features whose bbox overlaps the 2D bbox."""
+        b = self.bboxes
+        overlaps = (
+            (b[:, 0] <= bbox[2])
+            & (b[:, 1] <= bbox[3])
+            & (b[:, 2] >= bbox[0])
+            & (b[:, 3] >= bbox[1])
+        )
+        return np.flatnonzero(overlaps).tolist()
+
+    def sample(self, number):
+        """Positions of a random sample of features, without replacement."""
+        return sorted(random.sample(range(len(self)), k=min(number, len(self))))
+
+    def read(self, file, positions):
+        """The bytes of the features at the positions, in that order."""
+        for i in positions:
+            file.seek(int(self.offsets[i]))
+            yield file.read(int(self.lengths[i]))
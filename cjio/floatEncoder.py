@@ -1,2 +0,0 @@
-class FloatEncoder(float):
-    __repr__ = staticmethod(lambda x: format(x, ".6f"))
@@ -1,4 +1,5 @@
 import math
+from itertools import accumulate, chain
 
 import numpy as np
 
@@ -53,7 +54,14 @@ def get_normal_newell(poly):
     return (n, True)
 
 
+# -- set in the worker processes of a supervisor.Supervisor, it then gets the
+# -- faces to triangulate (see supervisor.FaceGuard)
+face_guard = None
+
+
 def triangulate_face(face, vnp, sloppy=False):
+    if face_guard is not None:
+        return face_guard.triangulate(face, vnp, sloppy)
     if not sloppy:
         return triangulate_face_shewchuk(face, vnp)
     else:
@@ -64,6 +72,8 @@ def triangulate_face(face, vnp, sloppy=False):
 def triangulate_face_shewchuk(face, vnp):
     # print(face)
     # -- remove duplicate vertices, which can *easily* make Triangle segfault
+    # -- (in a copy, the face of the city model is left as is)
+    face = list(face)
     for i, each in enumerate(face):
         if len(set(each)) < len(each):  # -- there are duplicates
             re = []
@@ -237,3 +247,158 @@ def average_normal(normals):
     else:
         normal_vec = s / n
     return normal_vec
+
+
+# -- depth of the nested arrays of "boundaries", per geometry type
+BOUNDARIES_DEPTH = {
+    "MultiPoint": 1,
+    "MultiLineString": 2,
+    "MultiSurface": 3,
+    "CompositeSurface": 3,
+    "Solid": 4,
+    "MultiSolid": 5,
+    "CompositeSolid": 5,
+    "GeometryInstance": 1,
+}
+
+
+def boundaries_depth(geom):
+    """Depth of the nested arrays of the "boundaries" of a geometry."""
+    if geom["type"] in BOUNDARIES_DEPTH:
+        return BOUNDARIES_DEPTH[geom["type"]]
+    depth = 1
+    a = geom["boundaries"]
+    while len(a) > 0 and isinstance(a[0], list):
+        a = a[0]
+        depth += 1
+    return depth
+
+
+def _flatten(boundaries, depth):
+    offsets = []
+    level = boundaries
+    for _ in range(depth - 1):
+        offsets.append([0, *accumulate(map(len, level))])
+        level = list(chain.from_iterable(level))
+    return level, offsets
+
+
+def _unflatten(flat, offsets):
+    level = flat
+    for off in reversed(offsets):
+        level = [level[off[i] : off[i + 1]] for i in range(len(off) - 1)]
+    return level
+
+
+def flatten_boundaries(boundaries, depth):
+    """Flatten nested "boundaries" to a compact encoding with offset arrays.
+
+    Returns (flat, offsets): 'flat' is an int64 array with all the vertex indices
+    and 'offsets' has one int64 array per nesting level, from the outermost to the
+    innermost one (eg shells, surfaces and rings for a Solid). The element i of a
+    level spans [offsets[k][i], offsets[k][i + 1]) of the level below it.
+    The conversion is lossless, see :py:func:`unflatten_boundaries`.
+    """
+    flat, offsets = _flatten(boundaries, depth)
+    return (
+        np.array(flat, dtype=np.int64),
+        [np.array(off, dtype=np.int64) for off in offsets],
+    )
+
+
+def unflatten_boundaries(flat, offsets):
+    """Rebuild the nested "boundaries" from :py:func:`flatten_boundaries`."""
+    return _unflatten(
+        np.asarray(flat).tolist(), [np.asarray(off).tolist() for off in offsets]
+    )
+
+
+def pack_boundaries(geoms):
+    """Flatten the "boundaries" of several geometries into one array.
+
+    Returns (flat, layout): 'flat' is an int64 array with all the vertex indices,
+    the layout is used to put them back with :py:func:`unpack_boundaries`. This way
+    renumbering vertices is one array operation, eg ``newids[flat]``.
+    """
+    flats = []
+    layout = []
+    for g in geoms:
+        flat, offsets = _flatten(g["boundaries"], boundaries_depth(g))
+        flats.append(flat)
+        layout.append((len(flat), offsets))
+    n = sum(each[0] for each in layout)
+    return np.fromiter(chain.from_iterable(flats), dtype=np.int64, count=n), layout
+
+
+def unpack_boundaries(geoms, flat, layout):
+    """Replace the "boundaries" of the geometries by the vertex indices in 'flat'."""
+    flat = np.asarray(flat).tolist()
+    start = 0
+    for g, (n, offsets) in zip(geoms, layout):
+        g["boundaries"] = _unflatten(flat[start : start + n], offsets)
+        start += n
+
+
+def _order_of_appearance(first, inverse):
+    # -- renumber groups sorted by value in the order of their first occurrence
+    order = np.argsort(first, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[inverse], first[order]
+
+
+def compact_indices(flat):
+    """Renumber indices from 0, in the order of their first appearance.
+
+    Returns (newflat, used): 'used[i]' is the old index of the new index i.
+    """
+    if len(flat) == 0:
+        return flat, flat
+    _, first, inverse = np.unique(flat, return_index=True, return_inverse=True)
+    newflat, firsts = _order_of_appearance(first, inverse.reshape(-1))
+    return newflat, flat[firsts]
+
+
+def _row_keys(a):
+    # -- pack each row in one int64 when the ranges allow it, otherwise None
+    cols = []
+    span = 1
+    for c in a.T:
+        if not np.issubdtype(c.dtype, np.integer):
+            c = np.unique(c, return_inverse=True)[1].reshape(-1)
+        c = c - c.min()
+        size = int(c.max()) + 1
+        span *= size
+        cols.append((c, size))
+    if span >= 2**62:
+        return None
+    keys = np.zeros(len(a), dtype=np.int64)
+    for c, size in cols:
+        keys = keys * size + c
+    return keys
+
+
+def unique_rows(a):
+    """Find the duplicate rows of a 2D array (eg the vertices).
+
+    Returns (newids, first): 'newids[i]' is the index of the unique row of the
+    row i, unique rows are numbered in the order of their first appearance and
+    'first[k]' is the first row that is equal to the unique row k.
+    """
+    n = len(a)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # -- stable sorts, the first row of each group is its first occurrence
+    keys = _row_keys(a)
+    start = np.ones(n, dtype=bool)
+    if keys is not None:
+        order = np.argsort(keys, kind="stable")
+        s = keys[order]
+        start[1:] = s[1:] != s[:-1]
+    else:
+        order = np.lexsort(a.T[::-1])
+        s = a[order]
+        start[1:] = np.any(s[1:] != s[:-1], axis=1)
+    inverse = np.empty(n, dtype=np.int64)
+    inverse[order] = np.cumsum(start) - 1
+    return _order_of_appearance(order[start], inverse)
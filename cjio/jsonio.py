@@ -0,0 +1,695 @@
+"""JSON parsing and serialisation of city models
+
+Parsing: several parsers can be used (json of the standard library, orjson,
+simdjson), the fastest one available is used by default. Only the IDs of the
+CityObjects are checked for duplicates, which is much cheaper than a hook called
+for every JSON object of the file.
+
+Serialisation: the floats are written with 6 decimals, as cjio always did, but
+without replacing the encoder of the json module for the whole process: the
+floats are formatted only where they can occur. The boundaries (only integers)
+are given to the C encoder of json, or to orjson if it is installed, and the
+lists of coordinates (eg the vertices) are formatted in bulk.
+"""
+
+import codecs
+import collections
+import gc
+import io
+import json
+import math
+import mmap
+import re
+import traceback
+import warnings
+from itertools import chain, count
+
+import numpy as np
+
+from cjio import MODULE_ORJSON_AVAILABLE, MODULE_SIMDJSON_AVAILABLE
+
+if MODULE_ORJSON_AVAILABLE:
+    import orjson
+
+if MODULE_SIMDJSON_AVAILABLE:
+    import simdjson
+
+FLOAT_FORMAT = "%.6f"
+
+
+def _float(x):
+    if math.isfinite(x):
+        return FLOAT_FORMAT % x
+    # -- like json.dumps()
+    if math.isnan(x):
+        return "NaN"
+    return "Infinity" if x > 0 else "-Infinity"
+
+
+def _key(k):
+    if isinstance(k, str):
+        return json.dumps(k)
+    if isinstance(k, float):
+        return f'"{_float(k)}"'
+    return json.dumps(json.dumps(k))
+
+
+class Encoder:
+    """Encoder of a city model, or a part of it (eg a CityObject).
+
+    :param indent: None for the compact form (no spaces), otherwise the string
+        (or the number of spaces) for one level of indentation
+    """
+
+    def __init__(self, indent=None):
+        if isinstance(indent, int):
+            indent = " " * indent
+        self.indent = indent
+        self.separators = (",", ":") if indent is None else (",", ": ")
+        # -- ids of the members that contain only integers (or null)
+        self.integers = set()
+
+    def nl(self, level):
+        if self.indent is None:
+            return ""
+        return "\n" + self.indent * level
+
+    def encode(self, o, level=0):
+        if id(o) in self.integers:
+            return self.encode_integers(o, level)
+        if isinstance(o, float):
+            return _float(o)
+        if isinstance(o, dict):
+            if len(o) == 0:
+                return "{}"
+            if "boundaries" in o:
+                self.mark_geometry(o)
+            key_sep = self.separators[1]
+            return (
+                "{"
+                + ",".join(
+                    self.nl(level + 1) + _key(k) + key_sep + self.encode(v, level + 1)
+                    for k, v in o.items()
+                )
+                + self.nl(level)
+                + "}"
+            )
+        if isinstance(o, (list, tuple)):
+            if len(o) == 0:
+                return "[]"
+            items = None
+            if isinstance(o[0], list):
+                items = self.encode_points(o, level + 1)
+            if items is None:
+                items = ",".join(
+                    self.nl(level + 1) + self.encode(v, level + 1) for v in o
+                )
+            return "[" + items + self.nl(level) + "]"
+        return json.dumps(o)
+
+    def encode_integers(self, o, level):
+        """A value without floats, the C encoder gives the right text."""
+        if self.indent is None:
+            if MODULE_ORJSON_AVAILABLE:
+                return orjson.dumps(o).decode()
+            return json.dumps(o, separators=self.separators)
+        re = json.dumps(o, indent=self.indent, separators=self.separators)
+        return re.replace("\n", self.nl(level))
+
+    def encode_points(self, points, level):
+        """The items of a list of coordinates (eg the vertices), formatted at once.
+
+        None if it is not a list of lists of numbers that have the same length.
+        """
+        if set(map(type, points)) != {list}:
+            return None
+        n = len(points[0])
+        flat = list(chain.from_iterable(points))
+        if n == 0 or len(flat) != n * len(points):
+            return None
+        types = set(map(type, flat))
+        if types == {float} and all(map(math.isfinite, flat)):
+            code = FLOAT_FORMAT
+        elif types <= {int, float}:
+            code = "%s"
+            flat = [_float(c) if type(c) is float else str(c) for c in flat]
+        else:
+            return None
+        row = (
+            self.nl(level)
+            + "["
+            + ",".join([self.nl(level + 1) + code] * n)
+            + self.nl(level)
+            + "]"
+        )
+        return ",".join([row] * len(points)) % tuple(flat)
+
+    def mark_geometry(self, g):
+        """The boundaries of a geometry, and the indices in its semantics and
+        appearances, contain only integers."""
+        self.integers.add(id(g["boundaries"]))
+        if isinstance(g.get("semantics"), dict) and "values" in g["semantics"]:
+            self.integers.add(id(g["semantics"]["values"]))
+        for m in ("material", "texture"):
+            if isinstance(g.get(m), dict):
+                for theme in g[m].values():
+                    if isinstance(theme, dict) and "values" in theme:
+                        self.integers.add(id(theme["values"]))
+
+
+def dumps(o, indent=None):
+    """Serialise to a JSON string, the floats with 6 decimals.
+
+    Without indent, the output is compact (no spaces after the separators).
+    """
+    return Encoder(indent).encode(o)
+
+
+def iterencode(j, indent=None, chunk_size=10000):
+    """Generates the text of :py:func:`dumps` for a CityJSON object in pieces.
+
+    Each CityObject and each chunk of vertices is one piece, so that the whole
+    string is never built.
+    """
+    enc = Encoder(indent)
+    nl = enc.nl
+    key_sep = enc.separators[1]
+    yield "{"
+    for i, (k, v) in enumerate(j.items()):
+        yield ("," if i > 0 else "") + nl(1) + _key(k) + key_sep
+        if k == "CityObjects" and len(v) > 0:
+            yield "{"
+            for i2, (coid, co) in enumerate(v.items()):
+                yield "{}{}{}{}{}".format(
+                    "," if i2 > 0 else "",
+                    nl(2),
+                    _key(coid),
+                    key_sep,
+                    enc.encode(co, 2),
+                )
+            yield nl(1) + "}"
+        elif k == "vertices" and len(v) > 0:
+            yield "["
+            for start in range(0, len(v), chunk_size):
+                chunk = v[start : start + chunk_size]
+                items = enc.encode_points(chunk, 2)
+                if items is None:
+                    items = ",".join(nl(2) + enc.encode(each, 2) for each in chunk)
+                yield ("," if start > 0 else "") + items
+            yield nl(1) + "]"
+        else:
+            yield enc.encode(v, 1)
+    yield nl(0) + "}"
+
+
+# -- parsing ------------------------------------------------------------------
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_VERTICES_END = re.compile(r"\][ \t\n\r]*\]")
+_DECODER = json.JSONDecoder()
+# -- the strings of a JSON text, group 2 is set when the string is a key followed
+# -- by an object (as the CityObjects are)
+_STRING = re.compile(rb'"([^"\\]*(?:\\.[^"\\]*)*)"([ \t\n\r]*:[ \t\n\r]*\{)?')
+
+
+def _duplicate_error(key):
+    return ValueError(
+        f"Invalid CityJSON file, duplicate key for City Object IDs: {key!r}"
+    )
+
+
+# -- characters decoded at once, when the json backend parses bytes
+BUFFER_SIZE = 1 << 20
+
+# -- returned by the functions given to _walk() for a value left out
+_DROPPED = object()
+
+
+class _Chunks:
+    """A str, or UTF-8 bytes (eg a memory-mapped file), read like a text file: the
+    bytes are decoded piece by piece, never all at once."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.decoder = None
+        if not isinstance(data, str):
+            self.decoder = codecs.getincrementaldecoder("utf-8-sig")()
+
+    def read(self, size):
+        piece = self.data[self.pos : self.pos + size]
+        self.pos += len(piece)
+        if self.decoder is None:
+            return piece
+        return self.decoder.decode(piece, final=self.pos >= len(self.data))
+
+
+def _parse_items(items):
+    return _DECODER.decode("[" + items + "]")
+
+
+def _skip_items(items):
+    return ()
+
+
+def _parse_member(key, buf):
+    # -- the vertices in chunks, the buffer does not grow to the whole array
+    if key == "vertices" and buf.peek() == "[":
+        return list(chain.from_iterable(buf.vertices(_parse_items)))
+    return buf.value()
+
+
+def _skip_member(key, buf):
+    if key == "vertices" and buf.peek() == "[":
+        for _ in buf.vertices(_skip_items):
+            pass
+    else:
+        buf.value()
+    return _DROPPED
+
+
+def _parse_cityobject(coid, buf):
+    return buf.value()
+
+
+def _walk(data, check_duplicates, cityobject, member):
+    """Parse the JSON text (str or bytes) piece by piece with a
+    :py:class:`_TextBuffer`: each CityObject with cityobject(coid, buf), the other
+    members of the root with member(key, buf); they return the value or _DROPPED
+    to leave it out. ValueError for a duplicate key in the root or the
+    CityObjects if check_duplicates."""
+    buf = _TextBuffer(_Chunks(data), BUFFER_SIZE)
+    if buf.peek() != "{":
+        j = buf.value()
+    else:
+        j = {}
+        keys = set()
+        for _ in buf.items("{"):
+            key = buf.key()
+            if check_duplicates and key in keys:
+                raise _duplicate_error(key)
+            keys.add(key)
+            if key == "CityObjects" and buf.peek() == "{":
+                value = {}
+                ids = set()
+                for _ in buf.items("{"):
+                    coid = buf.key()
+                    if check_duplicates and coid in ids:
+                        raise _duplicate_error(coid)
+                    ids.add(coid)
+                    co = cityobject(coid, buf)
+                    if co is _DROPPED:
+                        value.pop(coid, None)
+                    else:
+                        value[coid] = co
+            else:
+                value = member(key, buf)
+            if value is _DROPPED:
+                j.pop(key, None)
+            else:
+                j[key] = value
+    if buf.peek() != "":
+        raise json.JSONDecodeError("Extra data", buf.text, buf.pos)
+    return j
+
+
+def _loads_json(data, check_duplicates):
+    if isinstance(data, str) and not check_duplicates:
+        return json.loads(data)
+    # -- the root and the CityObjects are walked here, only their values are
+    # -- parsed by the C scanner of json
+    return _walk(data, check_duplicates, _parse_cityobject, _parse_member)
+
+
+def _loads_filtered(data, check_duplicates, cityobjects, skip):
+    """The json backend, with the CityObjects not kept (and the members of the
+    root in skip) left out as soon as they are parsed."""
+    # -- the order of the CityObjects in the file, some left out can be needed
+    # -- by the ones kept
+    order = {}
+    counter = count()
+
+    def cityobject(coid, buf):
+        co = buf.value()
+        order[coid] = next(counter)
+        return co if cityobjects.keep(coid, co) else _DROPPED
+
+    def member(key, buf):
+        if key in skip:
+            return _skip_member(key, buf)
+        return _parse_member(key, buf)
+
+    def needed(coid, buf):
+        co = buf.value()
+        if coid not in missing:
+            return _DROPPED
+        cityobjects.keep(coid, co)
+        return co
+
+    j = _walk(data, check_duplicates, cityobject, member)
+    cos = j.get("CityObjects") if isinstance(j, dict) else None
+    if not isinstance(cos, dict):
+        return j
+    added = False
+    while True:
+        missing = {
+            coid
+            for coid in cityobjects.needed(cos)
+            if coid not in cos and coid in order
+        }
+        if len(missing) == 0:
+            break
+        # -- the text is parsed again, for the CityObjects missing only
+        cos.update(_walk(data, False, needed, _skip_member)["CityObjects"])
+        added = True
+    if added:
+        # -- in the order of the file
+        j["CityObjects"] = {coid: cos[coid] for coid in sorted(cos, key=order.get)}
+    return j
+
+
+def _unescape(key):
+    if b"\\" not in key:
+        return key
+    return json.loads(b'"' + key + b'"').encode()
+
+
+def _check_cityobjects(data, j):
+    """Raise a ValueError if an ID is twice in the CityObjects of the text.
+
+    Each ID has to be a key followed by an object in the text; if no ID is
+    found more than once like that, there is no duplicate. Otherwise (eg an
+    attribute has the same name as a CityObject) the text is checked exactly.
+    """
+    if not isinstance(j, dict) or not isinstance(j.get("CityObjects"), dict):
+        return
+    if isinstance(data, str):
+        data = data.encode()
+    counts = collections.Counter(
+        _unescape(m.group(1)) for m in _STRING.finditer(data) if m.group(2)
+    )
+    for coid in j["CityObjects"]:
+        if counts[coid.encode()] != 1:
+            _loads_json(data, True)
+            return
+
+
+def _loads_orjson(data, check_duplicates):
+    if isinstance(data, str):
+        data = data.encode()
+    # -- orjson refuses the BOM
+    if data[:3] == b"\xef\xbb\xbf":
+        data = data[3:]
+    try:
+        j = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # -- eg NaN or very large integers, that json accepts
+        return _loads_json(data, check_duplicates)
+    if check_duplicates:
+        _check_cityobjects(data, j)
+    return j
+
+
+def _loads_simdjson(data, check_duplicates):
+    if not isinstance(data, str) and data[:3] == b"\xef\xbb\xbf":
+        data = data[3:]
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    j = simdjson.loads(data)
+    if check_duplicates:
+        _check_cityobjects(data, j)
+    return j
+
+
+# -- the parsers, the first available one is the default
+PARSERS = collections.OrderedDict()
+if MODULE_ORJSON_AVAILABLE:
+    PARSERS["orjson"] = _loads_orjson
+if MODULE_SIMDJSON_AVAILABLE:
+    PARSERS["simdjson"] = _loads_simdjson
+PARSERS["json"] = _loads_json
+
+
+def register_parser(name, loads, default=False):
+    """Add a parser, loads(data, check_duplicates) gets a str or bytes."""
+    PARSERS[name] = loads
+    if default:
+        PARSERS.move_to_end(name, last=False)
+
+
+def loads(data, check_duplicates=True, parser=None, cityobjects=None, skip=()):
+    """Parse a JSON document (str or bytes, with or without BOM).
+
+    :param check_duplicates: raise a ValueError if an ID is used more than once
+        in the member "CityObjects" (the other objects are not checked)
+    :param parser: name of the parser (see PARSERS), None for the default one
+    :param cityobjects: filter of the CityObjects, with the methods keep(id, co)
+        (whether the CityObject is kept, it can be modified) and needed(cos)
+        (the IDs the CityObjects kept refer to, they are then kept too); the
+        CityObjects are then parsed one by one by json, whatever the parser
+    :param skip: names of the members of the root left out (with cityobjects)
+    """
+    if parser is None:
+        parser = next(iter(PARSERS))
+    if parser not in PARSERS:
+        raise ValueError(
+            "JSON parser '{}' not available, possible: {}".format(
+                parser, ", ".join(PARSERS)
+            )
+        )
+    # -- the cyclic garbage collector would run many times, for nothing, while
+    # -- the (millions of) lists of the model are created
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if cityobjects is not None:
+            return _loads_filtered(data, check_duplicates, cityobjects, skip)
+        return PARSERS[parser](data, check_duplicates)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def load(file, check_duplicates=True, parser=None, cityobjects=None, skip=()):
+    """Parse a JSON file, see :py:func:`loads`.
+
+    A file opened in binary mode is memory-mapped and parsed from the bytes, the
+    mapping is closed as soon as it is parsed; otherwise (text mode, compressed
+    file) the file is read.
+    """
+    if not isinstance(file, (io.BufferedReader, io.FileIO)):
+        return loads(file.read(), check_duplicates, parser, cityobjects, skip)
+    try:
+        mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        # -- eg a pipe or an empty file
+        return loads(file.read(), check_duplicates, parser, cityobjects, skip)
+    with mm:
+        data = memoryview(mm)
+        try:
+            return loads(data, check_duplicates, parser, cityobjects, skip)
+        except Exception as err:
+            # -- the frames of the tracebacks hold views on the mapping, it could
+            # -- not be closed
+            e = err
+            while e is not None:
+                traceback.clear_frames(e.__traceback__)
+                e = e.__context__
+            raise
+        finally:
+            data.release()
+
+
+_VERTEX_SEPARATORS = bytes.maketrans(b"[],", b"   ")
+_NUMBER_CHARACTERS = b"0123456789+-.eE \t\n\r"
+
+
+def parse_vertices(items):
+    """Parse the items of a JSON array of vertices, eg '[1,2,3],[4,5,6]', straight
+    to a NumPy array (n, 3), int64 if all the coordinates are integers, float64
+    otherwise.
+
+    The digits are converted in bulk by NumPy, the Python lists are never
+    created; if the text is not only vertices of 3 numbers, it is parsed by
+    json (and the errors raised by it).
+    """
+    if isinstance(items, str):
+        items = items.encode()
+    # -- the brackets and commas must be those of vertices of 3 coordinates
+    chars = np.frombuffer(items, dtype=np.uint8)
+    seps = chars[(chars == ord("[")) | (chars == ord("]")) | (chars == ord(","))]
+    n = (len(seps) + 1) // 5
+    array = None
+    if seps.tobytes() == (b"[,,]," * n)[:-1]:
+        numbers = items.translate(_VERTEX_SEPARATORS)
+        if len(numbers.translate(None, _NUMBER_CHARACTERS)) == 0:
+            isfloat = any(c in numbers for c in (b".", b"e", b"E"))
+            with warnings.catch_warnings():
+                # -- "string could not be read to its end", checked below
+                warnings.simplefilter("ignore", DeprecationWarning)
+                array = np.fromstring(
+                    numbers, dtype=np.float64 if isfloat else np.int64, sep=" "
+                )
+    if array is None or len(array) != 3 * n:
+        array = np.array(json.loads(b"[" + items + b"]"))
+        if array.dtype not in (np.int64, np.float64) or array.shape[1:] != (3,):
+            raise ValueError("Invalid vertices, they must have 3 coordinates")
+    return array.reshape(-1, 3)
+
+
+# -- incremental parsing ------------------------------------------------------
+
+
+class _TextBuffer:
+    """The text of a file, read piece by piece for the incremental parser."""
+
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+        self.fill()
+        if self.text.startswith("\ufeff"):
+            self.pos = 1
+
+    def fill(self):
+        """Read more text (at least as much as what is left), False at the end."""
+        if self.eof:
+            return False
+        more = self.file.read(max(self.size, len(self.text) - self.pos))
+        if not more:
+            self.eof = True
+            return False
+        self.text = self.text[self.pos :] + more
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """The next character that is not whitespace, "" at the end."""
+        # -- most of the time, there is no whitespace (compact JSON)
+        c = self.text[self.pos : self.pos + 1]
+        if c and c not in " \t\n\r":
+            return c
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text) or not self.fill():
+                return self.text[self.pos : self.pos + 1]
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise json.JSONDecodeError(f"Expecting '{c}'", self.text, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                v, end = _DECODER.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # -- a number could continue in the text not read yet
+            if end == len(self.text) and self.fill():
+                continue
+            self.pos = end
+            return v
+
+    def vertices(self, parse=None):
+        """Generates the array of vertices starting here, as NumPy arrays of the
+        whole vertices in the buffer (or what parse(items) returns)."""
+        if parse is None:
+            parse = parse_vertices
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            # -- the array ends at the first "]]", otherwise it goes on after
+            # -- the last vertex in the buffer
+            m = _VERTICES_END.search(self.text, self.pos)
+            end = m.start() + 1 if m else self.text.rfind("]", self.pos) + 1
+            if end <= self.pos:
+                if not self.fill():
+                    raise json.JSONDecodeError(
+                        "Unterminated array of vertices", self.text, self.pos
+                    )
+                continue
+            yield parse(self.text[self.pos : end])
+            self.pos = end
+            c = self.peek()
+            if c == "]":
+                self.pos += 1
+                return
+            self.expect(",")
+
+    def key(self):
+        if self.peek() != '"':
+            raise json.JSONDecodeError(
+                "Expecting property name enclosed in double quotes", self.text, self.pos
+            )
+        while True:
+            try:
+                k, end = json.decoder.scanstring(self.text, self.pos + 1)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            self.pos = end
+            self.expect(":")
+            return k
+
+    def items(self, start):
+        """Walks the array (start "[") or object (start "{") starting here, the
+        value of each item has to be read before the next one is asked for."""
+        close = "]" if start == "[" else "}"
+        self.expect(start)
+        if self.peek() == close:
+            self.pos += 1
+            return
+        while True:
+            yield
+            c = self.peek()
+            if c == close:
+                self.pos += 1
+                return
+            self.expect(",")
+
+
+def iterparse(file, buffer_size=1 << 20):
+    """Parse a CityJSON file incrementally, the whole document is never in memory.
+
+    The file can be opened in text or binary mode (UTF-8, with or without BOM).
+    Generates tuples (member, key, value):
+
+    - ("CityObjects", id, CityObject) for each CityObject;
+    - ("vertices", index of the first vertex, NumPy array (n, 3)) for the
+      vertices, in chunks of about buffer_size characters (see
+      :py:func:`parse_vertices`);
+    - (None, name, value) for each other member of the root.
+    """
+    wrapper = None
+    if isinstance(file, (io.RawIOBase, io.BufferedIOBase)):
+        file = wrapper = io.TextIOWrapper(file, encoding="utf-8-sig")
+    try:
+        buf = _TextBuffer(file, buffer_size)
+        for _ in buf.items("{"):
+            name = buf.key()
+            if name == "CityObjects" and buf.peek() == "{":
+                for _ in buf.items("{"):
+                    coid = buf.key()
+                    yield "CityObjects", coid, buf.value()
+            elif name == "vertices" and buf.peek() == "[":
+                start = 0
+                for chunk in buf.vertices():
+                    yield "vertices", start, chunk
+                    start += len(chunk)
+            else:
+                yield None, name, buf.value()
+        if buf.peek() != "":
+            raise json.JSONDecodeError("Extra data", buf.text, buf.pos)
+    finally:
+        # -- the file given is not closed with the wrapper
+        if wrapper is not None:
+            wrapper.detach()
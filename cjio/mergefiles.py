@@ -0,0 +1,261 @@
+"""Merge of CityJSON files without holding them in memory"""
+
+import copy
+import tempfile
+
+import numpy as np
+
+from cjio import jsonio, utils
+from cjio.cityjson import (
+    merge_transform,
+    quantize,
+    update_boundaries_indices,
+    update_geom_indices,
+    update_texture_indices,
+)
+
+# -- what is counted in each input, and offset in the next ones
+SIZES = [
+    "vertices",
+    "materials",
+    "textures",
+    "vertices-texture",
+    "templates",
+    "vertices-templates",
+]
+
+# -- number of vertices written at once
+CHUNK_SIZE = 10000
+
+
+class _Spool:
+    """Rows of numbers kept in a temporary file, to be written at the end."""
+
+    def __init__(self, file, dtype, ncols):
+        self.file = file
+        self.dtype = np.dtype(dtype)
+        self.ncols = ncols
+        self.count = 0
+
+    def append(self, rows):
+        a = np.ascontiguousarray(rows, dtype=self.dtype).reshape(-1, self.ncols)
+        self.file.write(a.tobytes())
+        self.count += len(a)
+
+    def write_json(self, out):
+        """Write the rows as the items of a JSON array."""
+        self.file.seek(0)
+        size = CHUNK_SIZE * self.ncols * self.dtype.itemsize
+        first = True
+        while True:
+            b = self.file.read(size)
+            if not b:
+                break
+            rows = np.frombuffer(b, dtype=self.dtype).reshape(-1, self.ncols)
+            out.write(("" if first else ",") + jsonio.dumps(rows.tolist())[1:-1])
+            first = False
+
+
+def _members(source, copied=False):
+    """The members of a city model or of a CityJSON file (path), as
+    :py:func:`jsonio.iterparse` generates them."""
+    if isinstance(source, str):
+        with utils.open_file(source, mode="rb") as f:
+            yield from jsonio.iterparse(f)
+        return
+    for k, v in source.j.items():
+        if k == "CityObjects":
+            for coid, co in v.items():
+                yield "CityObjects", coid, copy.deepcopy(co) if copied else co
+        elif k == "vertices":
+            yield "vertices", 0, source.vertices_array()
+        else:
+            yield None, k, copy.deepcopy(v) if copied else v
+
+
+def _offset_cityobject(co, offsets):
+    """Shift the indices of the geometries of a CityObject by what the inputs
+    before its own have."""
+    geoms = co.get("geometry", [])
+    if offsets["vertices"] > 0:
+        update_boundaries_indices(geoms, offsets["vertices"])
+    for g in geoms:
+        if g.get("type") == "GeometryInstance":
+            g["template"] += offsets["templates"]
+        for m in g.get("material", {}).values():
+            if "values" in m:
+                update_geom_indices(m["values"], offsets["materials"])
+            elif "value" in m:
+                m["value"] += offsets["materials"]
+        for t in g.get("texture", {}).values():
+            if "values" in t:
+                update_texture_indices(
+                    t["values"], offsets["textures"], offsets["vertices-texture"]
+                )
+
+
+def _merge_cityobject(co, other):
+    """The rules of :py:meth:`CityJSON.merge` for a CityObject with the same ID:
+    the attributes and the geometries (of another LoD) not present are added."""
+    if "attributes" in other:
+        attributes = co.setdefault("attributes", {})
+        for a, value in other["attributes"].items():
+            if a not in attributes:
+                attributes[a] = value
+    if "geometry" in co:
+        lods = {str(g.get("lod")) for g in co["geometry"]}
+        for g in other.get("geometry", []):
+            if str(g.get("lod")) not in lods:
+                co["geometry"].append(g)
+                lods.add(str(g.get("lod")))
+
+
+def merge_files(cm, paths, out):
+    """Merge the CityJSON files at 'paths' into the city model 'cm', like
+    :py:meth:`CityJSON.merge`, but the result is written to the file-like object
+    'out' as it is built, memory stays bounded whatever the number of files.
+
+    The files are read twice. The first time, the IDs of the CityObjects (as
+    hashes, in one array) and the numbers of vertices, materials, textures and
+    templates are collected. The second time each CityObject is written once
+    its indices are offset; only those with an ID that appears more than once
+    wait in memory until their last occurrence. The vertices are kept in a
+    temporary file until all the CityObjects are written.
+
+    Unlike :py:meth:`CityJSON.merge`, the duplicate and orphan vertices are not
+    removed (see :py:meth:`CityJSON.clean_vertices`).
+    """
+    sources = [cm, *paths]
+    # -- 1st pass: the sizes and the transform of each input, the IDs
+    sizes = []
+    hashes = []
+    for source in sources:
+        size = dict.fromkeys(SIZES, 0)
+        size["transform"] = None
+        ids = []
+        for member, key, value in _members(source):
+            if member == "CityObjects":
+                ids.append(hash(key))
+            elif member == "vertices":
+                size["vertices"] += len(value)
+            elif key == "type" and value != "CityJSON":
+                raise ValueError(f"Not a CityJSON file: {source}")
+            elif key == "transform":
+                size["transform"] = value
+            elif key == "appearance":
+                for k in ["materials", "textures", "vertices-texture"]:
+                    size[k] = len(value.get(k, []))
+            elif key == "geometry-templates":
+                size["templates"] = len(value.get("templates", []))
+                size["vertices-templates"] = len(value.get("vertices-templates", []))
+        sizes.append(size)
+        hashes.append(np.array(ids, dtype=np.int64))
+    unique, counts = np.unique(np.concatenate(hashes), return_counts=True)
+    del hashes
+    # -- the number of occurrences still to come of the IDs seen more than once
+    remaining = dict(zip(unique[counts > 1].tolist(), counts[counts > 1].tolist()))
+    del unique, counts
+    transform = merge_transform([s["transform"] for s in sizes if s["transform"]])
+
+    # -- 2nd pass: the CityObjects are written, the rest is kept for the end
+    first = [True]
+
+    def write_cityobject(coid, co):
+        sep = "" if first[0] else ","
+        out.write(sep + jsonio.dumps(coid) + ":" + jsonio.dumps(co))
+        first[0] = False
+
+    header = {
+        "type": "CityJSON",
+        "version": cm.j.get("version"),
+        "transform": transform,
+    }
+    out.write(jsonio.dumps(header)[:-1] + ',"CityObjects":{')
+    # -- the vertices are kept in temporary files until the CityObjects are written
+    with tempfile.TemporaryFile() as fv, tempfile.TemporaryFile() as ft:
+        vertices = _Spool(fv, np.int64, 3)
+        vtexture = _Spool(ft, np.float64, 2)
+        materials = []
+        textures = []
+        templates = []
+        vtemplates = []
+        lo = np.full(3, np.iinfo(np.int64).max)
+        hi = np.full(3, np.iinfo(np.int64).min)
+        deferred = {}
+        offsets = dict.fromkeys(SIZES, 0)
+        for source, size in zip(sources, sizes):
+            for member, key, value in _members(source, copied=source is cm):
+                if member == "CityObjects":
+                    _offset_cityobject(value, offsets)
+                    h = hash(key)
+                    if h not in remaining:
+                        write_cityobject(key, value)
+                        continue
+                    # -- (different IDs could have the same hash, they wait together)
+                    waiting = deferred.setdefault(h, {})
+                    if key in waiting:
+                        _merge_cityobject(waiting[key], value)
+                    else:
+                        waiting[key] = value
+                    remaining[h] -= 1
+                    if remaining[h] == 0:
+                        for coid, co in deferred.pop(h).items():
+                            write_cityobject(coid, co)
+                elif member == "vertices":
+                    v = quantize(value, size["transform"], transform)
+                    if len(v) > 0:
+                        lo = np.minimum(lo, v.min(axis=0))
+                        hi = np.maximum(hi, v.max(axis=0))
+                    vertices.append(v)
+                elif key == "appearance":
+                    materials += value.get("materials", [])
+                    textures += value.get("textures", [])
+                    vtexture.append(value.get("vertices-texture", []))
+                elif key == "geometry-templates":
+                    t = value.get("templates", [])
+                    update_boundaries_indices(t, offsets["vertices-templates"])
+                    templates += t
+                    vtemplates += value.get("vertices-templates", [])
+            for k in SIZES:
+                offsets[k] += size[k]
+        for waiting in deferred.values():
+            for coid, co in waiting.items():
+                write_cityobject(coid, co)
+
+        out.write('},"vertices":[')
+        vertices.write_json(out)
+        out.write("]")
+        if len(materials) > 0 or len(textures) > 0:
+            out.write(',"appearance":{')
+            if len(materials) > 0:
+                out.write('"materials":' + jsonio.dumps(materials))
+            if len(textures) > 0:
+                sep = "," if len(materials) > 0 else ""
+                out.write(sep + '"textures":' + jsonio.dumps(textures))
+                out.write(',"vertices-texture":[')
+                vtexture.write_json(out)
+                out.write("]")
+            out.write("}")
+    if len(templates) > 0:
+        t = {"templates": templates, "vertices-templates": vtemplates}
+        out.write(',"geometry-templates":' + jsonio.dumps(t))
+    # -- the other members of the city model, as CityJSON.merge() keeps them
+    rest = {
+        k: v
+        for k, v in cm.j.items()
+        if k not in header
+        and k not in ["CityObjects", "vertices", "appearance", "geometry-templates"]
+    }
+    metadata = rest["metadata"] = dict(rest.get("metadata", {}))
+    if vertices.count == 0:
+        metadata["geographicalExtent"] = [0, 0, 0, 0, 0, 0]
+    else:
+        s = transform["scale"]
+        t = transform["translate"]
+        bbox = lo.tolist() + hi.tolist()
+        metadata["geographicalExtent"] = [
+            a * b + c for a, b, c in zip(bbox, s + s, t + t)
+        ]
+    for k, v in rest.items():
+        out.write("," + jsonio.dumps(k) + ":" + jsonio.dumps(v))
+    out.write("}")
@@ -0,0 +1,137 @@
+"""Spatial index on the centroids of the CityObjects"""
+
+import math
+
+import numpy as np
+
+
+class GridIndex:
+    """Uniform grid over 2D points, stored in NumPy arrays.
+
+    The points are sorted by cell, and each cell is a slice of that order, thus
+    the candidates of a query are gathered with one slice per row of cells.
+    """
+
+    def __init__(self, ids, points, points_per_cell=4):
+        self.ids = list(ids)
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        n = len(self.points)
+        if n == 0:
+            self.minxy = np.zeros(2)
+            self.maxxy = np.zeros(2)
+            self.cellsize = 1.0
+            self.shape = (1, 1)
+            self.order = np.zeros(0, dtype=np.int64)
+            self.cellstart = np.zeros(2, dtype=np.int64)
+            return
+        self.minxy = self.points.min(axis=0)
+        self.maxxy = self.points.max(axis=0)
+        dx, dy = (self.maxxy - self.minxy).tolist()
+        ncells = max(1, n // points_per_cell)
+        if dx > 0 and dy > 0:
+            self.cellsize = math.sqrt(dx * dy / ncells)
+        else:
+            self.cellsize = max(dx, dy) / ncells
+        if self.cellsize <= 0:
+            self.cellsize = 1.0
+        ncols = int(dx // self.cellsize) + 1
+        nrows = int(dy // self.cellsize) + 1
+        self.shape = (nrows, ncols)
+        cx, cy = self._cell(self.points[:, 0], self.points[:, 1])
+        keys = cy * ncols + cx
+        self.order = np.argsort(keys, kind="stable")
+        self.cellstart = np.zeros(nrows * ncols + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=nrows * ncols), out=self.cellstart[1:])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, x, y):
+        nrows, ncols = self.shape
+        cx = np.floor((x - self.minxy[0]) / self.cellsize).astype(np.int64)
+        cy = np.floor((y - self.minxy[1]) / self.cellsize).astype(np.int64)
+        return np.clip(cx, 0, ncols - 1), np.clip(cy, 0, nrows - 1)
+
+    def _candidates(self, minx, miny, maxx, maxy):
+        # -- points in the cells overlapping the box, a superset of the answer
+        if (
+            len(self) == 0
+            or maxx < self.minxy[0]
+            or maxy < self.minxy[1]
+            or minx > self.maxxy[0]
+            or miny > self.maxxy[1]
+        ):
+            return np.zeros(0, dtype=np.int64)
+        (cx0, cx1), (cy0, cy1) = self._cell(
+            np.array([minx, maxx]), np.array([miny, maxy])
+        )
+        ncols = self.shape[1]
+        rows = np.arange(cy0, cy1 + 1) * ncols
+        starts = self.cellstart[rows + cx0].tolist()
+        ends = self.cellstart[rows + cx1 + 1].tolist()
+        return np.concatenate([self.order[a:b] for a, b in zip(starts, ends)])
+
+    def query_bbox(self, bbox):
+        """Indices of the points inside [minx, maxx) x [miny, maxy)."""
+        c = self._candidates(*bbox)
+        p = self.points[c]
+        inside = (
+            (p[:, 0] >= bbox[0])
+            & (p[:, 1] >= bbox[1])
+            & (p[:, 0] < bbox[2])
+            & (p[:, 1] < bbox[3])
+        )
+        return np.sort(c[inside])
+
+    def query_radius(self, x, y, radius):
+        """Indices of the points at a distance smaller than radius of (x, y)."""
+        c = self._candidates(x - radius, y - radius, x + radius, y + radius)
+        p = self.points[c]
+        dist = ((p[:, 0] - x) ** 2) + ((p[:, 1] - y) ** 2)
+        return np.sort(c[dist < radius**2])
+
+    def query_polygon(self, polygon):
+        """Indices of the points inside a polygon (list of (x, y), even-odd rule)."""
+        poly = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        if len(poly) < 3:
+            return np.zeros(0, dtype=np.int64)
+        lo = poly.min(axis=0)
+        hi = poly.max(axis=0)
+        c = self._candidates(lo[0], lo[1], hi[0], hi[1])
+        x = self.points[c, 0]
+        y = self.points[c, 1]
+        inside = np.zeros(len(c), dtype=bool)
+        for (x1, y1), (x2, y2) in zip(poly, np.roll(poly, -1, axis=0)):
+            crosses = (y1 > y) != (y2 > y)
+            if not crosses.any():
+                continue
+            with np.errstate(divide="ignore", invalid="ignore"):
+                xcross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (x < xcross)
+        return np.sort(c[inside])
+
+    def query_nearest(self, x, y, k=1):
+        """Indices of the k nearest points of (x, y), sorted by distance.
+
+        The search box is grown until the k-th nearest candidate is closer than
+        the half-size of the box, then no point outside can be closer.
+        """
+        if k <= 0 or len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        half = self.cellsize
+        reach = max(
+            abs(x - self.minxy[0]),
+            abs(x - self.maxxy[0]),
+            abs(y - self.minxy[1]),
+            abs(y - self.maxxy[1]),
+        )
+        while True:
+            c = self._candidates(x - half, y - half, x + half, y + half)
+            everything = half >= reach
+            if len(c) >= k or everything:
+                p = self.points[c]
+                dist = ((p[:, 0] - x) ** 2) + ((p[:, 1] - y) ** 2)
+                best = np.lexsort((c, dist))[:k]
+                if everything or dist[best[-1]] <= half**2:
+                    return c[best]
+            half *= 2
@@ -1,5 +1,9 @@
 """CityModel subset functions"""
 
+import numpy as np
+
+from cjio import geom_help
+
 
 def select_co_ids(j, IDs):
     IDs = list(IDs)
@@ -35,15 +39,14 @@ def select_co_ids(j, IDs):
 
 def process_geometry(j, j2):
     # -- update vertex indices
-    oldnewids = {}
-    newvertices = []
-    for each in j2["CityObjects"]:
-        if "geometry" in j2["CityObjects"][each]:
-            for geom in j2["CityObjects"][each]["geometry"]:
-                update_array_indices(
-                    geom["boundaries"], oldnewids, j["vertices"], newvertices, -1
-                )
-    j2["vertices"] = newvertices
+    geoms = [g for co in j2["CityObjects"].values() for g in co.get("geometry", [])]
+    flat, layout = geom_help.pack_boundaries(geoms)
+    newflat, used = geom_help.compact_indices(flat)
+    geom_help.unpack_boundaries(geoms, newflat, layout)
+    if isinstance(j["vertices"], np.ndarray):
+        j2["vertices"] = j["vertices"][used].tolist()
+    else:
+        j2["vertices"] = [j["vertices"][i] for i in used.tolist()]
 
 
 def process_templates(j, j2):
@@ -0,0 +1,220 @@
+"""Triangulation in worker processes that can crash without taking cjio down"""
+
+import collections
+import multiprocessing
+import time
+from itertools import chain
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from cjio import geom_help
+
+# -- seconds between two checks of the workers
+POLL_INTERVAL = 0.05
+
+
+class FaceGuard:
+    """Installed as geom_help.face_guard in a worker process: it numbers the faces
+    given to :py:func:`geom_help.triangulate_face`, publishes the number of the
+    one being triangulated in 'progress', and triangulates with mapbox-earcut
+    the faces in 'fallback', and not at all those in 'skip'.
+    """
+
+    def __init__(self, progress, fallback, skip, reasons):
+        self.progress = progress
+        self.fallback = fallback
+        self.skip = skip
+        self.reasons = reasons
+        self.count = 0
+        self.theid = None
+        self.report = []
+
+    def triangulate(self, face, vnp, sloppy=False):
+        n = self.count
+        self.count += 1
+        if n in self.skip:
+            self._record(n, face, "failed")
+            return (np.zeros(1), False)
+        earcut = sloppy or n in self.fallback
+        self.progress.value = n
+        if earcut:
+            re = geom_help.triangulate_face_mapbox_earcut(face, vnp)
+        else:
+            re = geom_help.triangulate_face_shewchuk(face, vnp)
+        self.progress.value = -1
+        if n in self.fallback:
+            self._record(n, face, "earcut" if re[1] else "failed")
+        return re
+
+    def _record(self, n, face, result):
+        self.report.append(
+            {
+                "id": self.theid,
+                "face": face,
+                "reason": self.reasons[n],
+                "result": result,
+            }
+        )
+
+
+def _join(parts):
+    if all(isinstance(p, str) for p in parts):
+        return "".join(parts)
+    return list(chain.from_iterable(parts))
+
+
+def _worker(conn, progress, func, ids, fallback, skip, reasons, initializer, initargs):
+    try:
+        if initializer is not None:
+            initializer(*initargs)
+        guard = FaceGuard(progress, fallback, skip, reasons)
+        geom_help.face_guard = guard
+        parts = []
+        # -- one CityObject at a time, to know the one of each face
+        for theid in ids:
+            guard.theid = theid
+            parts.append(func([theid]))
+        conn.send((True, _join(parts), guard.report))
+    # -- any error of func is raised again by the supervisor, in the main process
+    except Exception as e:  # noqa: BLE001
+        conn.send((False, e, None))
+    finally:
+        conn.close()
+
+
+class _Task:
+    """A chunk of CityObjects, and what its previous attempts taught."""
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.fallback = set()
+        self.skip = set()
+        self.reasons = {}
+        self.process = None
+        self.result = None
+
+    def start(self, ctx, func, initializer, initargs):
+        self.progress = ctx.RawValue("q", -1)
+        self.conn, child = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(
+            target=_worker,
+            args=(
+                child,
+                self.progress,
+                func,
+                self.ids,
+                self.fallback,
+                self.skip,
+                self.reasons,
+                initializer,
+                initargs,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self.face = -1
+        self.since = time.monotonic()
+
+
+class Supervisor:
+    """Runs the triangulation of chunks of CityObjects in worker processes that are
+    watched, so that a face that crashes the triangulator (Triangle can segfault
+    on invalid input) or takes more than 'timeout' seconds does not stop cjio.
+
+    The worker is then restarted on its chunk, and the face is triangulated with
+    mapbox-earcut (if 'fallback' and it is installed), or dropped if this fails
+    too. Each of these faces is added to 'report', as a dict with the "id" of
+    its CityObject, the "face", the "reason" ("crash" or "timeout") and the
+    "result" ("earcut" or "failed").
+    """
+
+    def __init__(self, timeout=None, fallback=True):
+        self.timeout = timeout
+        self.fallback = fallback and geom_help.MODULE_EARCUT_AVAILABLE
+        self.report = []
+
+    def map(self, func, chunks, jobs=1, initializer=None, initargs=()):
+        """Like :py:func:`utils.parallel_map`, func is run on each chunk of IDs of
+        CityObjects by at most 'jobs' workers, and the results are yielded in the
+        order of the chunks."""
+        if "fork" in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context("fork")
+        else:
+            ctx = multiprocessing.get_context()
+        chunks = iter(chunks)
+        pending = collections.deque()
+        running = []
+        exhausted = False
+        try:
+            while True:
+                # -- start workers, at most 4 chunks per process ahead of the result
+                while not exhausted and len(running) < jobs:
+                    if len(pending) >= 4 * jobs:
+                        break
+                    ids = next(chunks, None)
+                    if ids is None:
+                        exhausted = True
+                        break
+                    task = _Task(ids)
+                    task.start(ctx, func, initializer, initargs)
+                    pending.append(task)
+                    running.append(task)
+                while pending and pending[0].result is not None:
+                    yield pending.popleft().result
+                if not running:
+                    if exhausted and not pending:
+                        return
+                    continue
+                # -- until a worker sends its result (or dies), or the next check
+                wait([task.conn for task in running], POLL_INTERVAL)
+                for task in list(running):
+                    if self._check(task, ctx, func, initializer, initargs):
+                        running.remove(task)
+        finally:
+            for task in running:
+                task.process.kill()
+                task.process.join()
+
+    def _check(self, task, ctx, func, initializer, initargs):
+        """Checks a worker, restarts it if it crashed or is stuck on a face.
+        Returns True when the task has its result."""
+        if task.conn.poll():
+            try:
+                ok, result, report = task.conn.recv()
+            except EOFError:
+                ok = None
+            if ok is not None:
+                task.process.join()
+                if not ok:
+                    raise result
+                task.result = result
+                self.report += report
+                return True
+        if task.process.is_alive():
+            face = task.progress.value
+            now = time.monotonic()
+            if face != task.face:
+                task.face = face
+                task.since = now
+            if self.timeout is None or face < 0 or now - task.since < self.timeout:
+                return False
+            task.process.kill()
+            reason = "timeout"
+        else:
+            reason = "crash"
+        task.process.join()
+        face = task.progress.value
+        if face < 0:
+            raise RuntimeError(
+                f"A triangulation worker died (exit code {task.process.exitcode})"
+            )
+        if face in task.fallback or not self.fallback:
+            task.fallback.discard(face)
+            task.skip.add(face)
+        else:
+            task.fallback.add(face)
+        task.reasons[face] = reason
+        task.start(ctx, func, initializer, initargs)
+        return False
@@ -1,8 +1,27 @@
 """Various utility functions"""
 
+import bz2
+import collections
+import gzip
+import io
+import lzma
+import multiprocessing
 import os.path
+import queue
+import sys
+import threading
+
 import click
 
+# -- the compressions, recognised by the extension of the files
+COMPRESSIONS = {".gz": gzip, ".bz2": bz2, ".xz": lzma}
+# -- and by the first bytes of a stream (stdin)
+COMPRESSION_MAGIC = {
+    ".gz": b"\x1f\x8b",
+    ".bz2": b"BZh",
+    ".xz": b"\xfd7zXZ\x00",
+}
+
 
 def verify_filename(filename):
     """Verify if the provided output filename is a file or a directory"""
@@ -27,3 +46,137 @@ def verify_filename(filename):
         else:
             res["dir"] = False
     return res
+
+
+def parallel_map(func, items, jobs, initializer=None, initargs=(), inflight=None):
+    """Map func on the items with a pool of processes, the results are yielded in
+    the order of the items.
+
+    At most 'inflight' items (default: 4 per process) are submitted ahead of the
+    result being yielded, to cap the memory used. Where possible the processes are
+    forked, so that initargs (eg a city model) are inherited and not pickled.
+    """
+    if inflight is None:
+        inflight = 4 * jobs
+    if "fork" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("fork")
+    else:
+        ctx = multiprocessing.get_context()
+    with ctx.Pool(jobs, initializer, initargs) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= inflight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def chunks(items, size):
+    """Split an iterable in lists of 'size' items (the last one can be smaller)."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def split_compression(path):
+    """Returns the path without the extension of the compression (.gz, .bz2, .xz),
+    and this extension (None if the file is not compressed)."""
+    base, extension = os.path.splitext(path)
+    if extension.lower() in COMPRESSIONS:
+        return base, extension.lower()
+    return path, None
+
+
+class BackgroundWriter(io.RawIOBase):
+    """Writes to a file in a thread, eg to compress while the next part of the
+    output is serialised (zlib, bz2 and lzma release the GIL).
+
+    At most 'maxsize' pieces are waiting, the errors of the thread are raised
+    by the next write() or by close().
+    """
+
+    def __init__(self, target, maxsize=16):
+        self.target = target
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is None:
+                # -- any error, else the thread stops and write() blocks forever
+                try:
+                    self.target.write(data)
+                except BaseException as err:  # noqa: BLE001
+                    self.error = err
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(bytes(b))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self.queue.put(None)
+            self.thread.join()
+            self.target.close()
+            super().close()
+            if self.error is not None:
+                raise self.error
+
+
+def open_file(path, mode="r", compresslevel=None, threaded=False, encoding=None):
+    """Open a file, (de)compressed according to its extension (.gz, .bz2, .xz).
+
+    :param compresslevel: level of the compression (1-9), None for the default
+    :param threaded: compress in a background thread (see BackgroundWriter)
+    """
+    compression = split_compression(path)[1]
+    if compression is None:
+        return click.open_file(path, mode=mode, encoding=encoding)
+    kwargs = {}
+    if compresslevel is not None and "r" not in mode:
+        if compression == ".xz":
+            kwargs["preset"] = compresslevel
+        else:
+            kwargs["compresslevel"] = compresslevel
+    binmode = mode.replace("t", "").replace("b", "") + "b"
+    f = COMPRESSIONS[compression].open(path, binmode, **kwargs)
+    if threaded and "r" not in mode:
+        f = io.BufferedWriter(BackgroundWriter(f), buffer_size=1 << 20)
+    if "b" in mode:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding)
+
+
+def open_stdin():
+    """The standard input as text, decompressed if it starts like a compressed
+    stream."""
+    buffer = getattr(sys.stdin, "buffer", None)
+    if buffer is None:
+        return sys.stdin
+    peekable = hasattr(buffer, "peek")
+    if not peekable:
+        buffer = io.BufferedReader(buffer)
+    start = buffer.peek(6)
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if start.startswith(magic):
+            f = COMPRESSIONS[compression].open(buffer, "rb")
+            return io.TextIOWrapper(f, encoding="utf-8-sig")
+    if peekable:
+        return sys.stdin
+    return io.TextIOWrapper(buffer, encoding="utf-8-sig")
@@ -40,6 +40,7 @@ setup(
         "export": ["pandas", "mapbox-earcut", "triangle2"],
         "validate": ["cjvalpy>=0.3.0"],
         "reproject": ["pyproj>=3.0.0"],
+        "fastjson": ["orjson"],
     },
     entry_points="""
         [console_scripts]
@@ -2,9 +2,14 @@
 
 import pytest
 import copy
-from cjio import cityjson
+import numpy as np
+from cjio import cityjson, featureindex, geom_help, jsonio, supervisor
 from math import isclose
 import json
+import io
+import os
+import signal
+import time
 
 
 class TestCityJSON:
@@ -62,6 +67,80 @@ class TestCityJSON:
         _f = nr_cos[0]
         assert all(i == _f for i in nr_cos)
 
+    def test_subset_polygon(self, delft):
+        bbox = [84873.68, 447503.67, 84919.65, 447548.40]
+        polygon = [
+            (bbox[0], bbox[1]),
+            (bbox[2], bbox[1]),
+            (bbox[2], bbox[3]),
+            (bbox[0], bbox[3]),
+        ]
+        s1 = delft.get_subset_bbox(bbox)
+        s2 = delft.get_subset_polygon(polygon)
+        assert len(s1.j["CityObjects"]) > 0
+        assert set(s1.j["CityObjects"]) == set(s2.j["CityObjects"])
+
+    def test_get_nearest(self, delft):
+        x, y = 84900.0, 447520.0
+        dist = {}
+        for coid, co in delft.j["CityObjects"].items():
+            c = delft.get_centroid(coid)
+            if "parents" not in co and c is not None:
+                dist[coid] = (c[0] - x) ** 2 + (c[1] - y) ** 2
+        expected = sorted(dist, key=dist.get)[:5]
+        assert delft.get_nearest(x, y, 5) == expected
+        s = delft.get_subset_nearest(x, y, 5)
+        assert set(expected).issubset(s.j["CityObjects"])
+
+    def test_spatial_index_edits(self):
+        """The spatial index follows the edits of the vertices"""
+        data = {
+            "type": "CityJSON",
+            "version": "2.0",
+            "transform": {"scale": [1, 1, 1], "translate": [0, 0, 0]},
+            "CityObjects": {
+                "a": {
+                    "type": "Building",
+                    "geometry": [
+                        {
+                            "type": "MultiSurface",
+                            "lod": "1",
+                            "boundaries": [[[0, 1, 2]]],
+                        }
+                    ],
+                },
+                "b": {
+                    "type": "Building",
+                    "geometry": [
+                        {
+                            "type": "MultiSurface",
+                            "lod": "2",
+                            "boundaries": [[[3, 4, 5]]],
+                        }
+                    ],
+                },
+            },
+            "vertices": [
+                [0, 0, 0],
+                [3, 0, 0],
+                [0, 3, 0],
+                [100, 100, 0],
+                [103, 100, 0],
+                [100, 103, 0],
+            ],
+        }
+        cm = cityjson.CityJSON(j=data)
+        assert cm.get_nearest(101, 101) == ["b"]
+        # -- edited in place: same lists, same number of vertices
+        for v in cm.j["vertices"][:3]:
+            v[0] += 100
+            v[1] += 100
+        cm._spatialindex = None
+        assert cm.get_nearest(101, 101) == ["a"]
+        # -- the methods that modify the geometries drop the index
+        cm.filter_lod("2")
+        assert cm.get_nearest(101, 101) == ["b"]
+
     def test_subset_random(self, zurich_subset):
         subset = zurich_subset.get_subset_random(10)
         cnt = sum(
@@ -86,6 +165,23 @@ class TestCityJSON:
         for co in subset.j["CityObjects"]:
             assert subset.j["CityObjects"][co]["type"] in types
 
+    def test_read_filter(self, data_dir, zurich_subset):
+        p = os.path.join(data_dir, "zurich", "zurich_subset_lod2.json")
+        rf = cityjson.ReadFilter()
+        rf.select(ids=["UUID_583c776f-5b0c-4d42-9c37-5b94e0c21a30"])
+        rf.remove_attribute("Herkunft")
+        with open(p, "rb") as f:
+            cm = cityjson.reader(f, read_filter=rf)
+        # -- the children are kept, even if they come before their parent
+        expected = zurich_subset.get_subset_ids(
+            ["UUID_583c776f-5b0c-4d42-9c37-5b94e0c21a30"]
+        )
+        assert set(cm.j["CityObjects"]) == set(expected.j["CityObjects"])
+        for co in cm.j["CityObjects"].values():
+            assert "Herkunft" not in co.get("attributes", {})
+        subset = cm.get_subset_ids(["UUID_583c776f-5b0c-4d42-9c37-5b94e0c21a30"])
+        assert len(subset.j["vertices"]) == len(expected.j["vertices"])
+
     def test_calculate_bbox(self):
         """Test the calculate_bbox function"""
 
@@ -109,6 +205,68 @@ class TestCityJSON:
 
         assert bbox == [100, 100, 100, 100.001, 100.001, 100.001]
 
+    def test_vertices_array(self):
+        data = {"vertices": [[0.5, 1.0, 1.5], [2.0, 2.5, 3.0]]}
+        cm = cityjson.CityJSON(j=data)
+        vnp = cm.vertices_array()
+        assert vnp.dtype == np.float64
+        assert vnp.tolist() == data["vertices"]
+        assert cm.real_vertices().tolist() == data["vertices"]
+
+    def test_vertices_array_with_transform(self):
+        data = {
+            "vertices": [[0, 0, 0], [1, 2, -3]],
+            "transform": {"scale": [0.5, 0.5, 0.5], "translate": [10, 20, 30]},
+        }
+        cm = cityjson.CityJSON(j=data)
+        vnp = cm.vertices_array()
+        assert vnp.dtype == np.int64
+        assert vnp.tolist() == data["vertices"]
+        # -- a copy, the city model is not modified
+        vnp[0, 0] = 7
+        assert data["vertices"][0] == [0, 0, 0]
+        real = cm.real_vertices()
+        assert real.dtype == np.float64
+        assert real.tolist() == [[10, 20, 30], [10.5, 21, 28.5]]
+        assert data["vertices"] == [[0, 0, 0], [1, 2, -3]]
+
+    def test_update_bbox_each_cityobjects(self):
+        """The extent of a CityObject covers all its geometries"""
+        data = {
+            "type": "CityJSON",
+            "version": "2.0",
+            "transform": {"scale": [0.5, 0.5, 0.5], "translate": [10, 20, 30]},
+            "CityObjects": {
+                "a": {
+                    "type": "Building",
+                    "geometry": [
+                        {
+                            "type": "MultiSurface",
+                            "lod": "1",
+                            "boundaries": [[[0, 1, 2]]],
+                        },
+                        {
+                            "type": "MultiSurface",
+                            "lod": "2",
+                            "boundaries": [[[3, 4, 5]]],
+                        },
+                    ],
+                }
+            },
+            "vertices": [
+                [0, 0, 0],
+                [2, 0, 0],
+                [2, 2, 0],
+                [4, 4, 2],
+                [8, 4, 2],
+                [8, 6, 4],
+            ],
+        }
+        cm = cityjson.CityJSON(j=data)
+        cm.update_bbox_each_cityobjects(addifmissing=True)
+        extent = cm.j["CityObjects"]["a"]["geographicalExtent"]
+        assert extent == [10, 20, 30, 14, 23, 32]
+
     def test_de_compression(self, delft):
         cm = copy.deepcopy(delft)
         assert cm.decompress()
@@ -128,6 +286,17 @@ class TestCityJSON:
         assert cubec.compress(2)
         assert len(cube.j["vertices"]) == len(cubec.j["vertices"])
 
+    @pytest.mark.parametrize("digits", [0, 3, 9])
+    def test_round_decimal(self, digits):
+        # -- ties, near-ties the product of floats gets wrong, large values
+        a = [0.0015, 1.0625, -0.0004, 2.5, 0.5e-9, 123456.0005, 9007199.754741, 0.0]
+        a += [(i + 0.5) / 10**digits for i in range(-50, 50)]
+        p = "%." + str(digits) + "f"
+        expected = [int((p % x).replace(".", "")) for x in a]
+        assert cityjson.round_decimal(a, digits).tolist() == expected
+        with pytest.raises(ValueError):
+            cityjson.round_decimal([1e19], digits)
+
     def test_reproject(self, delft_1b):
         cm = copy.deepcopy(delft_1b)
         cm.reproject(4937)  # -- z values should stay the same
@@ -184,14 +353,109 @@ class TestCityJSON:
         assert y == pytest.approx(y_d)
         assert z == pytest.approx(z_d)
 
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_reproject_chunks(self, delft, monkeypatch, jobs):
+        # -- a CRS without grid to download
+        monkeypatch.setattr(cityjson, "REPROJECT_CHUNK_SIZE", 1000)
+        cm = copy.deepcopy(delft)
+        cm.set_epsg(32631)
+        geoms = [g for co in cm.j["CityObjects"].values() for g in co["geometry"]]
+        before = cm.real_vertices()[geom_help.pack_boundaries(geoms)[0]]
+        cm.reproject(4326, digit=8, jobs=jobs)
+        assert cm.get_epsg() == 4326
+        after = cm.real_vertices()[geom_help.pack_boundaries(geoms)[0]]
+        transformer = cityjson.get_transformer(32631, 4326)
+        for i in [0, len(before) // 2, len(before) - 1]:
+            expected = transformer.transform(*before[i])
+            assert np.allclose(after[i], expected, atol=1e-8)
+
     def test_convert_to_stl(self, delft):
         cm = copy.deepcopy(delft)
-        _ = cm.export2stl(sloppy=True)
+        stl = cm.export2stl(sloppy=True).getvalue()
+        # -- the real-world coordinates, rounded to the scale of the transform
+        assert cm.j["transform"]["scale"][0] == 0.001
+        real = {tuple(v) for v in cm.real_vertices().round(3).tolist()}
+        written = [
+            tuple(float(c) for c in line.split()[1:])
+            for line in stl.splitlines()
+            if line.startswith("vertex ")
+        ]
+        assert len(written) > 0
+        assert set(written) <= real
+
+    def test_export_read_only(self, rotterdam_subset):
+        cm = rotterdam_subset
+        j = copy.deepcopy(cm.j)
+        obj, _ = cm.export2obj(sloppy=True, mtl_fname="rotterdam.mtl")
+        stl = cm.export2stl(sloppy=True)
+        cm.export2glb()
+        assert cm.j == j
+        # -- the real-world coordinates are written, not the integers
+        v = cm.real_vertices()
+        lines = obj.getvalue().splitlines()
+        vlines = [line for line in lines if line.startswith("v ")]
+        written = np.array([line.split()[1:] for line in vlines], dtype=float)
+        assert np.allclose(written, v, atol=1e-3)
+        assert stl.getvalue().count("vertex ") > 0
+        x, y, z = stl.getvalue().split("vertex ")[1].split("\n")[0].split()
+        assert np.isclose(np.abs(v - [float(x), float(y), float(z)]).sum(1), 0).any()
 
     def test_triangulate(self, materials):
         cm = materials
         cm.triangulate(sloppy=False)
 
+    def test_triangulate_jobs(self, materials, rotterdam_subset, monkeypatch):
+        monkeypatch.setattr(cityjson, "TRIANGULATE_CHUNK_SIZE", 2)
+        for cm in [materials, rotterdam_subset]:
+            cm2 = copy.deepcopy(cm)
+            cm.triangulate(sloppy=False)
+            cm2.triangulate(sloppy=False, jobs=2)
+            assert cm2.j == cm.j
+        cm = rotterdam_subset
+        obj, _ = cm.export2obj(sloppy=True, mtl_fname="r.mtl")
+        obj2, _ = cm.export2obj(sloppy=True, mtl_fname="r.mtl", jobs=2)
+        assert obj2.getvalue() == obj.getvalue()
+        assert cm.export2stl(True, jobs=2).getvalue() == cm.export2stl(True).getvalue()
+
+    def test_triangulate_supervised(self, rotterdam_subset, monkeypatch):
+        cm = rotterdam_subset
+        faces = [
+            (theid, face)
+            for theid, co in cm.j["CityObjects"].items()
+            for g in co.get("geometry", [])
+            for face in g["boundaries"]
+            if len(face[0]) > 3
+        ]
+        (crash_id, crash), (slow_id, slow) = faces[0], faces[-1]
+        shewchuk = geom_help.triangulate_face_shewchuk
+
+        def bad_triangle(face, vnp):
+            if face == crash:
+                os.kill(os.getpid(), signal.SIGSEGV)
+            if face == slow:
+                time.sleep(60)
+            return shewchuk(face, vnp)
+
+        original = copy.deepcopy(cm)
+        expected = copy.deepcopy(cm)
+        expected.triangulate(sloppy=False)
+        monkeypatch.setattr(geom_help, "triangulate_face_shewchuk", bad_triangle)
+        sup = supervisor.Supervisor(timeout=0.5)
+        cm.triangulate(sloppy=False, jobs=2, supervisor=sup)
+        assert [(r["id"], r["reason"], r["result"]) for r in sup.report] == [
+            (crash_id, "crash", "earcut"),
+            (slow_id, "timeout", "earcut"),
+        ]
+        for theid, co in cm.j["CityObjects"].items():
+            if theid not in [crash_id, slow_id]:
+                assert co == expected.j["CityObjects"][theid]
+        # -- without fallback, the faces are dropped
+        monkeypatch.setattr(cityjson, "TRIANGULATE_CHUNK_SIZE", 1)
+        sup = supervisor.Supervisor(timeout=0.5, fallback=False)
+        stl = original.export2stl(sloppy=False, supervisor=sup)
+        assert [r["result"] for r in sup.report] == ["failed", "failed"]
+        assert stl.getvalue().endswith("endsolid")
+
     def test_is_triangulate(self, triangulated):
         cm = triangulated
         assert cm.is_triangulated()
@@ -206,6 +470,84 @@ class TestCityJSON:
 
             assert "CityObjects" in data
 
+    def test_write_json(self, rotterdam_subset):
+        for indent in (None, "\t"):
+            out = io.StringIO()
+            rotterdam_subset.write_json(out, indent)
+            assert out.getvalue() == jsonio.dumps(rotterdam_subset.j, indent)
+
+    def test_generate_features(self, dummy):
+        dummy.j["CityObjects"]["1243"]["geometry"][0]["template"] = 1
+        original = copy.deepcopy(dummy.j)
+        features = list(dummy.generate_features())
+        toplevel = [
+            k for k, co in original["CityObjects"].items() if "parents" not in co
+        ]
+        assert [f.j["id"] for f in features] == toplevel
+        for f in features:
+            for co in f.j["CityObjects"].values():
+                for g in co.get("geometry", []):
+                    if g["type"] == "GeometryInstance":
+                        # -- the templates are in the first object of the stream
+                        assert g["template"] == 1
+                    g["boundaries"] = []
+        assert dummy.j == original
+
+    def test_read_stdin_features(self, rotterdam_subset, monkeypatch):
+        jsonl = rotterdam_subset.export2jsonl().getvalue()
+        monkeypatch.setattr("sys.stdin", io.StringIO(jsonl))
+        features = list(cityjson.read_stdin_features())
+        assert len(features) == len(jsonl.splitlines()) - 1
+        for cm in features:
+            assert cm.j["transform"] == rotterdam_subset.j["transform"]
+            assert len(cm.j["CityObjects"]) >= 1
+        ids = set()
+        for cm in features:
+            ids.update(cm.j["CityObjects"])
+        assert ids == set(rotterdam_subset.j["CityObjects"])
+
+    def test_read_jsonl(self, rotterdam_subset, data_output_dir):
+        p = os.path.join(data_output_dir, "read.city.jsonl")
+        with open(p, "w") as f:
+            f.write(rotterdam_subset.export2jsonl().getvalue())
+        bbox = rotterdam_subset.get_bbox()
+        bbox = [(bbox[0] + bbox[3]) / 2, bbox[1], bbox[3], (bbox[1] + bbox[4]) / 2]
+        expected = rotterdam_subset.get_subset_bbox(bbox)
+        assert len(expected.j["CityObjects"]) > 0
+        with open(p, "rb") as f:
+            index = featureindex.FeatureIndex.open(p, f)
+        assert os.path.exists(featureindex.FeatureIndex.sidecar(p))
+        assert featureindex.FeatureIndex.open(p, None).stamp == index.stamp
+        for idx in [None, index]:
+            rf = cityjson.ReadFilter()
+            rf.select(bbox=bbox)
+            with open(p, "rb") as f:
+                cm = cityjson.read_jsonl(f, read_filter=rf, index=idx)
+            assert len(cm.j["CityObjects"]) < len(rotterdam_subset.j["CityObjects"])
+            subset = cm.get_subset_bbox(bbox)
+            assert set(subset.j["CityObjects"]) == set(expected.j["CityObjects"])
+        with open(p, "rb") as f:
+            cm = cityjson.read_jsonl(f)
+        assert set(cm.j["CityObjects"]) == set(rotterdam_subset.j["CityObjects"])
+        os.remove(p)
+        os.remove(featureindex.FeatureIndex.sidecar(p))
+
+    def test_read_file_features(self, dummy):
+        # -- the children before their parent, the vertices first
+        j = dict(dummy.j)
+        j["CityObjects"] = dict(reversed(list(dummy.j["CityObjects"].items())))
+        j = dict(vertices=j.pop("vertices"), **j)
+        f = io.StringIO(json.dumps(j))
+        features = list(cityjson.read_file_features(f))
+        expected = list(dummy.generate_features())
+        # -- in the order of the top-level CityObjects in the file
+        expected.reverse()
+        assert len(features) == len(expected)
+        for cm, feature in zip(features, expected):
+            assert cm.j["transform"] == dummy.j["transform"]
+            for k in ["CityObjects", "vertices", "appearance"]:
+                assert cm.j.get(k) == feature.j.get(k)
+
     def test_filter_lod(self, multi_lod):
         cm = multi_lod
         cm.filter_lod("1.3")
@@ -214,6 +556,37 @@ class TestCityJSON:
                 for geom in cm.j["CityObjects"][coid]["geometry"]:
                     assert geom["lod"] == "1.3"
 
+    def test_merge_quantized(self):
+        def model(coid, scale, translate, vertices):
+            j = {
+                "type": "CityJSON",
+                "version": "2.0",
+                "transform": {"scale": scale, "translate": translate},
+                "CityObjects": {
+                    coid: {
+                        "type": "Building",
+                        "geometry": [
+                            {"type": "MultiPoint", "lod": "1", "boundaries": [0, 1]}
+                        ],
+                    }
+                },
+                "vertices": vertices,
+            }
+            return cityjson.CityJSON(j=j)
+
+        cm1 = model("a", [0.01, 0.01, 0.01], [10.5, 20.25, 0.0], [[1, 2, 3], [4, 5, 6]])
+        cm2 = model("b", [0.001] * 3, [0.0, 0.0, -1.0], [[7, 8, 9], [10, 11, 12]])
+        assert cm1.merge([cm2])
+        assert cm1.j["transform"] == {
+            "scale": [0.001] * 3,
+            "translate": [0.0, 0.0, -1.0],
+        }
+        v = cm1.j["vertices"]
+        a = cm1.j["CityObjects"]["a"]["geometry"][0]["boundaries"]
+        b = cm1.j["CityObjects"]["b"]["geometry"][0]["boundaries"]
+        assert [v[i] for i in a] == [[10510, 20270, 1030], [10540, 20300, 1060]]
+        assert [v[i] for i in b] == [[7, 8, 9], [10, 11, 12]]
+
     def test_merge_materials(self, materials_two):
         """Testing #100
         Merging two files with materials. One has the member 'values', the other has the
@@ -232,3 +605,50 @@ class TestCityJSON:
             ]["default"]["value"]
             == 1
         )
+
+    def test_flatten_boundaries(self, delft):
+        for co in delft.j["CityObjects"].values():
+            for g in co.get("geometry", []):
+                depth = geom_help.boundaries_depth(g)
+                flat, offsets = geom_help.flatten_boundaries(g["boundaries"], depth)
+                assert len(offsets) == depth - 1
+                assert geom_help.unflatten_boundaries(flat, offsets) == g["boundaries"]
+
+    def test_remove_orphan_vertices(self, delft):
+        cm = copy.deepcopy(delft)
+        cm.j["vertices"] += [[0, 0, 0], [1, 1, 1]]
+        assert cm.remove_orphan_vertices() == 2
+        assert cm.j["vertices"] == delft.j["vertices"]
+        assert cm.j["CityObjects"] == delft.j["CityObjects"]
+
+    def test_remove_duplicate_vertices(self, cube):
+        cm = copy.deepcopy(cube)
+        nv = len(cm.j["vertices"])
+        g = cm.j["CityObjects"]["id-1"]["geometry"][0]
+        # -- duplicate the first vertex and make the first ring use the copy
+        cm.j["vertices"].append(list(cm.j["vertices"][0]))
+        ring = g["boundaries"][0][0][0]
+        ring[ring.index(0)] = nv
+        assert cm.remove_duplicate_vertices() == 1
+        assert cm.j["vertices"] == cube.j["vertices"]
+        assert all(isinstance(c, int) for v in cm.j["vertices"] for c in v)
+        assert g["boundaries"][0][0][0] == [0, 1, 2, 3]
+
+    def test_clean_vertices(self, zurich_subset):
+        cm = copy.deepcopy(zurich_subset)
+        cm.j["vertices"] += [*cm.j["vertices"][:10], [0, 0, 0]]
+        cm2 = copy.deepcopy(cm)
+        assert cm.clean_vertices() == (10, 1)
+        cm2.remove_duplicate_vertices()
+        cm2.remove_orphan_vertices()
+        assert cm.j == cm2.j
+
+    def test_cityobjects_table(self, delft):
+        table = delft.get_cityobjects_table()
+        assert table.ids == list(delft.j["CityObjects"])
+        for i, coid in enumerate(table.ids):
+            centroid = delft.get_centroid(coid)
+            if centroid is None:
+                assert table.count[i] == 0
+            else:
+                assert table.centroid[i].tolist() == pytest.approx(centroid)
@@ -1,8 +1,13 @@
+import json
+import lzma
 import os
 import os.path
-from click.testing import CliRunner
-from cjio import cjio, cityjson, __version__
+import signal
+
 import pytest
+from click.testing import CliRunner
+
+from cjio import __version__, cityjson, cjio, geom_help
 
 
 class TestCLI:
@@ -168,6 +173,24 @@ class TestCLI:
 
         os.remove(p_out)
 
+    def test_export_jsonl_jobs_cli(self, sample_input_path, data_output_dir):
+        p_out = os.path.join(data_output_dir, "delft.city.jsonl")
+        p_out2 = os.path.join(data_output_dir, "delft_jobs.city.jsonl")
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli, args=[sample_input_path, "export", "jsonl", p_out]
+        )
+        assert result.exit_code == 0
+        result = runner.invoke(
+            cjio.cli, args=[sample_input_path, "export", "--jobs", 2, "jsonl", p_out2]
+        )
+        assert result.exit_code == 0
+        with open(p_out) as f1, open(p_out2) as f2:
+            assert f1.read() == f2.read()
+
+        os.remove(p_out)
+        os.remove(p_out2)
+
     def test_export_wrong_file_cli(self, wrong_input_path):
         p_out = os.path.join("tests", "data", "delft_non.city.json")
         runner = CliRunner()
@@ -222,6 +245,70 @@ class TestCLI:
 
         os.remove(p_out)
 
+    def test_merge_jobs_cli(self, delft, data_dir, data_output_dir):
+        p_out = os.path.join(data_output_dir, "merge_jobs.city.json")
+        pattern = os.path.join(data_dir, "rotterdam", "rotterdam_*.json")
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli,
+            args=[
+                os.path.join(data_dir, "delft.json"),
+                "merge",
+                "--jobs",
+                "2",
+                pattern,
+                "save",
+                p_out,
+            ],
+        )
+
+        assert result.exit_code == 0
+        with open(p_out) as f:
+            cityobjects = json.load(f)["CityObjects"]
+        assert set(delft.j["CityObjects"]) < set(cityobjects)
+
+        os.remove(p_out)
+
+    def test_merge_output_cli(self, data_dir, data_output_dir):
+        p_in = os.path.join(data_dir, "delft.json")
+        p_out = os.path.join(data_output_dir, "merge_output.city.json")
+        p_ref = os.path.join(data_output_dir, "merge_reference.city.json")
+        pattern = os.path.join(data_dir, "rotterdam", "rotterdam_*.json")
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli, args=[p_in, "merge", "--output", p_out, pattern]
+        )
+        assert result.exit_code == 0
+        result = runner.invoke(cjio.cli, args=[p_in, "merge", pattern, "save", p_ref])
+        assert result.exit_code == 0
+
+        def real(j):
+            # -- the CityObjects with the coordinates instead of the indices
+            s = j["transform"]["scale"]
+            t = j["transform"]["translate"]
+
+            def coords(a):
+                if isinstance(a, list):
+                    return [coords(each) for each in a]
+                v = j["vertices"][a]
+                return [round(v[i] * s[i] + t[i], 3) for i in range(3)]
+
+            for co in j["CityObjects"].values():
+                for g in co.get("geometry", []):
+                    g["boundaries"] = coords(g["boundaries"])
+            return j["CityObjects"]
+
+        with open(p_out) as f:
+            j = json.load(f)
+        with open(p_ref) as f:
+            ref = json.load(f)
+        assert real(j) == real(ref)
+        assert j["appearance"] == ref["appearance"]
+        assert j["metadata"] == ref["metadata"]
+
+        os.remove(p_out)
+        os.remove(p_ref)
+
     def test_metadata_extended_remove_cli(
         self, sample_with_ext_metadata_input_path, data_output_dir
     ):
@@ -364,6 +451,30 @@ class TestCLI:
 
         os.remove(p_out)
 
+    def test_subset_nearest_cli(self, rotterdam_subset_path, data_output_dir):
+        p_out = os.path.join(data_output_dir, "subset_nearest.city.json")
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli,
+            args=[
+                rotterdam_subset_path,
+                "subset",
+                "--nearest",
+                90970,
+                435620,
+                3,
+                "save",
+                p_out,
+            ],
+        )
+
+        assert result.exit_code == 0
+        with open(p_out) as fo:
+            cos = json.load(fo)["CityObjects"]
+        assert sum(1 for co in cos.values() if "parents" not in co) == 3
+
+        os.remove(p_out)
+
     def test_subset_random_cli(self, rotterdam_subset_path, data_output_dir):
         p_out = os.path.join(data_output_dir, "subset_random.city.json")
         runner = CliRunner()
@@ -486,6 +597,82 @@ class TestCLI:
 
         os.remove(p_out)
 
+    def test_triangulate_supervised_cli(self, sample_input_path, data_output_dir):
+        p_out = os.path.join(data_output_dir, "triangulated.city.json")
+        p_expected = os.path.join(data_output_dir, "triangulated_expected.city.json")
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli, args=[sample_input_path, "triangulate", "save", p_expected]
+        )
+        assert result.exit_code == 0
+        result = runner.invoke(
+            cjio.cli,
+            args=[
+                sample_input_path,
+                "triangulate",
+                "--jobs",
+                "2",
+                "--supervised",
+                "--timeout",
+                "30",
+                "save",
+                p_out,
+            ],
+        )
+
+        assert result.exit_code == 0
+        with open(p_out) as f, open(p_expected) as f2:
+            assert f.read() == f2.read()
+
+        os.remove(p_out)
+        os.remove(p_expected)
+
+    def test_triangulate_supervised_stream_cli(
+        self, rotterdam_subset, data_output_dir, monkeypatch
+    ):
+        p_out = os.path.join(data_output_dir, "triangulated.city.jsonl")
+        jsonl = rotterdam_subset.export2jsonl().getvalue()
+        # -- a face of the last CityJSONFeature crashes the triangulation
+        feature = json.loads(jsonl.splitlines()[-1])
+        theid, co = next(
+            (theid, co)
+            for theid, co in feature["CityObjects"].items()
+            if co.get("geometry")
+        )
+        crash = [feature["vertices"][i] for i in co["geometry"][0]["boundaries"][0][0]]
+        shewchuk = geom_help.triangulate_face_shewchuk
+
+        def bad_triangle(face, vnp):
+            if vnp[face[0]].tolist() == crash:
+                os.kill(os.getpid(), signal.SIGSEGV)
+            return shewchuk(face, vnp)
+
+        monkeypatch.setattr(geom_help, "triangulate_face_shewchuk", bad_triangle)
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli,
+            args=[
+                "--stream",
+                "stdin",
+                "triangulate",
+                "--supervised",
+                "export",
+                "jsonl",
+                p_out,
+            ],
+            input=jsonl,
+        )
+
+        assert result.exit_code == 0
+        assert (
+            f"Triangulating a face of CityObject '{theid}' crashed, it was"
+            " triangulated with mapbox-earcut"
+        ) in result.output
+        with open(p_out) as f:
+            assert len(f.readlines()) == len(jsonl.splitlines())
+
+        os.remove(p_out)
+
     def test_upgrade_cli(self, sample_input_path, data_output_dir):
         p_out = os.path.join(data_output_dir, "upgrade.city.json")
         runner = CliRunner()
@@ -623,3 +810,126 @@ class TestCLI:
         )
         assert result.exit_code != 0
         assert "File type not supported" in result.output
+
+    def test_stream_cli(self, rotterdam_subset, data_output_dir):
+        p_out = os.path.join(data_output_dir, "stream.city.jsonl")
+        jsonl = rotterdam_subset.export2jsonl().getvalue()
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli,
+            args=[
+                "--stream",
+                "stdin",
+                "attribute_remove",
+                "identificatie",
+                "subset",
+                "--cotype",
+                "Building",
+                "export",
+                "jsonl",
+                p_out,
+            ],
+            input=jsonl,
+        )
+
+        assert result.exit_code == 0
+        with open(p_out) as f:
+            lines = f.readlines()
+        assert len(lines) == len(jsonl.splitlines())
+        for line in lines[1:]:
+            for co in json.loads(line)["CityObjects"].values():
+                assert "identificatie" not in co.get("attributes", {})
+
+        os.remove(p_out)
+
+    def test_stream_file_cli(self, delft, sample_input_path, data_output_dir):
+        p_out = os.path.join(data_output_dir, "stream_file.city.jsonl")
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli,
+            args=["--stream", sample_input_path, "export", "jsonl", p_out],
+        )
+
+        assert result.exit_code == 0
+        with open(p_out) as f:
+            lines = f.readlines()
+        expected = delft.export2jsonl().getvalue().splitlines()
+        assert [line.rstrip("\n") for line in lines[1:]] == expected[1:]
+
+        os.remove(p_out)
+
+    def test_jsonl_index_cli(self, delft, data_output_dir):
+        p_in = os.path.join(data_output_dir, "index.city.jsonl")
+        p_out = os.path.join(data_output_dir, "index.city.json")
+        with open(p_in, "w") as f:
+            f.write(delft.export2jsonl().getvalue())
+        coid = "b0a8da4cc-2d2a-11e6-9a38-393caa90be70"
+        runner = CliRunner()
+        for args in [[], ["--index"], ["--index"]]:
+            result = runner.invoke(
+                cjio.cli,
+                args=[*args, p_in, "subset", "--id", coid, "save", p_out],
+            )
+            assert result.exit_code == 0
+            with open(p_out) as f:
+                assert list(json.load(f)["CityObjects"]) == [coid]
+        assert os.path.exists(p_in + ".idx")
+
+        os.remove(p_in)
+        os.remove(p_in + ".idx")
+        os.remove(p_out)
+
+    def test_compressed_cli(self, delft, sample_input_path, data_output_dir):
+        p_out = os.path.join(data_output_dir, "compressed.city.json.gz")
+        p_jsonl = os.path.join(data_output_dir, "compressed.city.jsonl.xz")
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli,
+            args=[sample_input_path, "save", "--compress_level", "1", p_out],
+        )
+        assert result.exit_code == 0
+        result = runner.invoke(
+            cjio.cli,
+            args=[p_out, "export", "--compress_thread", "jsonl", p_jsonl],
+        )
+        assert result.exit_code == 0
+        with lzma.open(p_jsonl, "rt") as f:
+            lines = f.read().splitlines()
+        assert lines[1:] == delft.export2jsonl().getvalue().splitlines()[1:]
+        # -- and through stdin
+        with open(p_jsonl, "rb") as f:
+            result = runner.invoke(
+                cjio.cli, args=["--suppress_msg", "stdin", "info"], input=f.read()
+            )
+        assert result.exit_code == 0
+        # -- .xz and .bz2 input, also merged
+        paths = [p_out]
+        for extension in [".xz", ".bz2"]:
+            p = os.path.join(data_output_dir, "compressed.city.json" + extension)
+            result = runner.invoke(cjio.cli, args=[sample_input_path, "save", p])
+            assert result.exit_code == 0
+            result = runner.invoke(cjio.cli, args=[p, "info"])
+            assert result.exit_code == 0
+            paths.append(p)
+        p_merged = os.path.join(data_output_dir, "merged.city.json")
+        result = runner.invoke(
+            cjio.cli, args=[paths[1], "merge", paths[2], "save", p_merged]
+        )
+        assert result.exit_code == 0
+        assert os.path.exists(p_merged)
+
+        for p in [*paths, p_merged]:
+            os.remove(p)
+        os.remove(p_jsonl)
+
+    def test_stream_not_streamable_cli(self, rotterdam_subset):
+        jsonl = rotterdam_subset.export2jsonl().getvalue()
+        runner = CliRunner()
+        result = runner.invoke(
+            cjio.cli,
+            args=["--stream", "stdin", "info"],
+            input=jsonl,
+        )
+
+        assert result.exit_code != 0
+        assert "only operators working per feature" in result.output
@@ -0,0 +1,144 @@
+import copy
+import io
+import json
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from cjio import cityjson, jsonio
+
+
+class FloatEncoder(float):
+    __repr__ = staticmethod(lambda x: format(x, ".6f"))
+
+
+def dumps_6f(o, indent=None):
+    """json.dumps() with the floats written with 6 decimals, the pure Python way."""
+    c_make_encoder = json.encoder.c_make_encoder
+    json.encoder.c_make_encoder = None
+    json.encoder.float = FloatEncoder
+    try:
+        if indent is None:
+            return json.dumps(o, separators=(",", ":"))
+        return json.dumps(o, indent=indent)
+    finally:
+        json.encoder.c_make_encoder = c_make_encoder
+        del json.encoder.float
+
+
+class TestJsonio:
+    @pytest.mark.parametrize("indent", [None, "\t", 2])
+    def test_dumps(self, rotterdam_subset, indent):
+        j = rotterdam_subset.j
+        j["CityObjects"]["test"] = {
+            "type": "Building",
+            "attributes": {"height": 12.3456789, "nan": float("nan"), "flag": True},
+        }
+        assert jsonio.dumps(j, indent) == dumps_6f(j, indent)
+        assert "".join(jsonio.iterencode(j, indent, 7)) == dumps_6f(j, indent)
+
+    def test_dumps_floats(self, rotterdam_subset):
+        cm = copy.deepcopy(rotterdam_subset)
+        cm.decompress()
+        cm.j["vertices"][0] = [1, 2.5, 3]
+        assert jsonio.dumps(cm.j) == dumps_6f(cm.j)
+        assert jsonio.dumps(cm.j, "\t") == dumps_6f(cm.j, "\t")
+
+    def test_no_global_patch(self, rotterdam_subset):
+        jsonio.dumps(rotterdam_subset.j)
+        assert json.dumps(0.1) == "0.1"
+
+    @pytest.mark.parametrize("parser", list(jsonio.PARSERS))
+    def test_loads(self, rotterdam_subset, parser):
+        s = json.dumps(rotterdam_subset.j)
+        assert jsonio.loads(s, parser=parser) == json.loads(s)
+        bom = b"\xef\xbb\xbf" + s.encode()
+        assert jsonio.loads(bom, parser=parser) == json.loads(s)
+
+    @pytest.mark.parametrize("parser", list(jsonio.PARSERS))
+    def test_loads_duplicates(self, parser):
+        s = (
+            '{"type": "CityJSON", "CityObjects": {'
+            '"a": {"type": "Building", "attributes": {"h": 1, "h": 2}},'
+            '"b": {"type": "Building", "attributes": {"a": {}}},'
+            '"a": {"type": "Building"}}}'
+        )
+        with pytest.raises(ValueError, match="duplicate key for City Object IDs"):
+            jsonio.loads(s, parser=parser)
+        j = jsonio.loads(s, check_duplicates=False, parser=parser)
+        assert j["CityObjects"]["a"] == {"type": "Building"}
+        # -- the duplicates outside the CityObjects are not checked
+        s = s.replace('"a": {"type": "Building"}', '"c": {"type": "Building"}')
+        j = jsonio.loads(s, parser=parser)
+        assert list(j["CityObjects"]) == ["a", "b", "c"]
+        assert j["CityObjects"]["a"]["attributes"] == {"h": 2}
+
+    def test_loads_unknown_parser(self):
+        with pytest.raises(ValueError):
+            jsonio.loads("{}", parser="nope")
+
+    @pytest.mark.parametrize("filtered", [False, True])
+    def test_loads_bytes_pieces(self, rotterdam_subset, monkeypatch, filtered):
+        monkeypatch.setattr(jsonio, "BUFFER_SIZE", 1 << 16)
+        s = json.dumps(rotterdam_subset.j)
+        # -- mostly whitespace, the model parsed is much smaller than the text
+        data = ("\ufeff{" + " " * (8 << 20) + s[1:]).encode()
+        cityobjects = None
+        if filtered:
+            cityobjects = cityjson.ReadFilter()
+            cityobjects.select(ids=list(rotterdam_subset.j["CityObjects"])[:3])
+        tracemalloc.start()
+        try:
+            j = jsonio.loads(memoryview(data), parser="json", cityobjects=cityobjects)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # -- the text is decoded piece by piece, never all of it
+        assert peak < len(data) // 4
+        assert j["vertices"] == rotterdam_subset.j["vertices"]
+        assert set(j["CityObjects"]) <= set(rotterdam_subset.j["CityObjects"])
+        if filtered:
+            assert len(j["CityObjects"]) == 3
+        else:
+            assert j == rotterdam_subset.j
+
+    @pytest.mark.parametrize("parser", list(jsonio.PARSERS))
+    def test_load(self, rotterdam_subset, tmp_path, parser):
+        p = tmp_path / "load.city.json"
+        with open(p, "wb") as f:
+            f.write(b"\xef\xbb\xbf" + json.dumps(rotterdam_subset.j).encode())
+        with open(p, "rb") as f:
+            assert jsonio.load(f, parser=parser) == rotterdam_subset.j
+        # -- the file is memory-mapped, the errors must not keep it open
+        with open(p, "wb") as f:
+            f.write(b'{"CityObjects": {"a": {}, "a": {}}}')
+        with open(p, "rb") as f, pytest.raises(ValueError):
+            jsonio.load(f, parser=parser)
+
+    def test_iterparse(self, rotterdam_subset):
+        j = rotterdam_subset.j
+        f = io.BytesIO(b"\xef\xbb\xbf" + json.dumps(j, indent=2).encode())
+        j2 = {"CityObjects": {}, "vertices": []}
+        for member, key, value in jsonio.iterparse(f, buffer_size=64):
+            if member == "CityObjects":
+                j2["CityObjects"][key] = value
+            elif member == "vertices":
+                assert key == len(j2["vertices"])
+                j2["vertices"] += value.tolist()
+            else:
+                j2[key] = value
+        assert j2 == j
+        assert not f.closed
+
+    def test_parse_vertices(self):
+        a = jsonio.parse_vertices("[1, 2, 3],\n[-4,5,6]")
+        assert a.dtype == np.int64
+        assert a.tolist() == [[1, 2, 3], [-4, 5, 6]]
+        a = jsonio.parse_vertices(b"[1.5,2,3e2],[4,5,6]")
+        assert a.dtype == np.float64
+        assert a.tolist() == [[1.5, 2.0, 300.0], [4.0, 5.0, 6.0]]
+        with pytest.raises(ValueError):
+            jsonio.parse_vertices("[1,2],[3,4,5,6]")
+        with pytest.raises(ValueError):
+            jsonio.parse_vertices("[1,2,3],[4,5,null]")
@@ -40,3 +40,21 @@ class TestFileNamesPaths:
     def test_verify_filenames_invalid(self, invalid_path):
         with pytest.raises(ClickException):
             utils.verify_filename(invalid_path[0])
+
+
+class TestCompression:
+    @pytest.mark.parametrize("extension", [".gz", ".bz2", ".xz"])
+    @pytest.mark.parametrize("threaded", [False, True])
+    def test_open_file(self, tmp_path, extension, threaded):
+        p = str(tmp_path / ("out.city.jsonl" + extension))
+        text = "".join(f'{{"id": "{i}"}}\n' for i in range(10000))
+        with utils.open_file(p, "w", 1, threaded) as f:
+            f.write(text)
+        with open(p, "rb") as f:
+            assert f.read(6).startswith(utils.COMPRESSION_MAGIC[extension])
+        with utils.open_file(p, "r") as f:
+            assert f.read() == text
+
+    def test_split_compression(self):
+        assert utils.split_compression("a.city.json.GZ") == ("a.city.json", ".gz")
+        assert utils.split_compression("a.city.json") == ("a.city.json", None)